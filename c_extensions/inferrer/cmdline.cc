@@ -39,6 +39,7 @@ const char *gengetopt_args_info_help[] = {
   "  -p, --redis-port=INT     The port to connect to on the Redis backend  \n                             (default=`6379')",
   "  -q, --procqueue=STRING   The name of the processing queue to connect to",
   "      --dump_graph         Dump the AS graph for this tag rather than running a \n                             server  (default=off)",
+  "      --packed             Store inferred paths as packed arrays of 32-bit \n                             ASNs rather than text  (default=off)",
     0
 };
 
@@ -73,6 +74,7 @@ void clear_given (struct gengetopt_args_info *args_info)
   args_info->redis_port_given = 0 ;
   args_info->procqueue_given = 0 ;
   args_info->dump_graph_given = 0 ;
+  args_info->packed_given = 0 ;
 }
 
 static
@@ -88,6 +90,7 @@ void clear_args (struct gengetopt_args_info *args_info)
   args_info->procqueue_arg = NULL;
   args_info->procqueue_orig = NULL;
   args_info->dump_graph_flag = 0;
+  args_info->packed_flag = 0;
   
 }
 
@@ -103,6 +106,7 @@ void init_args_info(struct gengetopt_args_info *args_info)
   args_info->redis_port_help = gengetopt_args_info_help[4] ;
   args_info->procqueue_help = gengetopt_args_info_help[5] ;
   args_info->dump_graph_help = gengetopt_args_info_help[6] ;
+  args_info->packed_help = gengetopt_args_info_help[7] ;
   
 }
 
@@ -234,6 +238,8 @@ cmdline_parser_dump(FILE *outfile, struct gengetopt_args_info *args_info)
     write_into_file(outfile, "procqueue", args_info->procqueue_orig, 0);
   if (args_info->dump_graph_given)
     write_into_file(outfile, "dump_graph", 0, 0 );
+  if (args_info->packed_given)
+    write_into_file(outfile, "packed", 0, 0 );
   
 
   i = EXIT_SUCCESS;
@@ -529,6 +535,7 @@ cmdline_parser_internal (
         { "redis-port",	1, NULL, 'p' },
         { "procqueue",	1, NULL, 'q' },
         { "dump_graph",	0, NULL, 0 },
+        { "packed",	0, NULL, 0 },
         { 0,  0, 0, 0 }
       };
 
@@ -610,6 +617,18 @@ cmdline_parser_internal (
                 additional_error))
               goto failure;
           
+          }
+          /* Store inferred paths as packed arrays of 32-bit ASNs rather than text.  */
+          else if (strcmp (long_options[option_index].name, "packed") == 0)
+          {
+          
+          
+            if (update_arg((void *)&(args_info->packed_flag), 0, &(args_info->packed_given),
+                &(local_args_info.packed_given), optarg, 0, 0, ARG_FLAG,
+                check_ambiguity, override, 1, 0, "packed", '-',
+                additional_error))
+              goto failure;
+          
           }
           
           break;
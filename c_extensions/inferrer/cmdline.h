@@ -53,6 +53,8 @@ struct gengetopt_args_info
   const char *procqueue_help; /**< @brief The name of the processing queue to connect to help description.  */
   int dump_graph_flag;	/**< @brief Dump the AS graph for this tag rather than running a server (default=off).  */
   const char *dump_graph_help; /**< @brief Dump the AS graph for this tag rather than running a server help description.  */
+  int packed_flag;	/**< @brief Store inferred paths as packed arrays of 32-bit ASNs rather than text (default=off).  */
+  const char *packed_help; /**< @brief Store inferred paths as packed arrays of 32-bit ASNs rather than text help description.  */
   
   unsigned int help_given ;	/**< @brief Whether help was given.  */
   unsigned int version_given ;	/**< @brief Whether version was given.  */
@@ -61,6 +63,7 @@ struct gengetopt_args_info
   unsigned int redis_port_given ;	/**< @brief Whether redis-port was given.  */
   unsigned int procqueue_given ;	/**< @brief Whether procqueue was given.  */
   unsigned int dump_graph_given ;	/**< @brief Whether dump_graph was given.  */
+  unsigned int packed_given ;	/**< @brief Whether packed was given.  */
 
 } ;
 
@@ -197,6 +197,88 @@ ribtag_exists(redisContext *c, string ribtag)
   return result;
 }
 
+static double
+now_secs()
+{
+  struct timeval now;
+  gettimeofday(&now, NULL);
+  return now.tv_sec + now.tv_usec / 1e6;
+}
+
+/** Quote *str* as a JSON string. Control characters and
+ *  bytes outside ASCII are escaped, so the result is valid
+ *  JSON whatever *str* holds. **/
+static string
+json_string(const string &str)
+{
+  string quoted = "\"";
+  char esc[8];
+  for (unsigned char ch : str) {
+    if (ch == '"' || ch == '\\') {
+      quoted += '\\';
+      quoted += ch;
+    }
+    else if (ch < 0x20 || ch >= 0x7f) {
+      snprintf(esc, sizeof(esc), "\\u%04x", ch);
+      quoted += esc;
+    }
+    else {
+      quoted += ch;
+    }
+  }
+  return quoted + "\"";
+}
+
+/** Record how long inferring routes to *dest* took, and
+ *  what it produced, for 'inettopology asmap infer-stats'.
+ *
+ *  @param queued when *dest* was queued, or 0 if unknown
+ **/
+static void
+record_job(redisContext *c, string ribtag, string dest,
+           double queued, double started, double finished,
+           int sources, size_t bytes)
+{
+  char wait[32];
+  redisReply *r;
+
+  string key = "inference:jobs:" + ribtag;
+  if (queued > 0)
+    snprintf(wait, sizeof(wait), "%.3f", started - queued);
+  else
+    snprintf(wait, sizeof(wait), "null");
+
+  string tag_json = json_string(ribtag);
+  string dst_json = json_string(dest);
+  const char *fmt = "{\"tag\": %s, \"dst\": %s, \"pid\": %u, "
+                    "\"started\": %.3f, \"wait\": %s, \"compute\": %.3f, "
+                    "\"sources\": %d, \"bytes\": %lu}";
+
+  // Size the record first, so it's never cut short
+  int len = snprintf(NULL, 0, fmt,
+                     tag_json.c_str(), dst_json.c_str(), getpid(),
+                     started, wait, finished - started,
+                     sources, (unsigned long) bytes);
+  if (len < 0) {
+    fprintf(stderr, "Failed to format job record for %s\n", dest.c_str());
+    return;
+  }
+  vector<char> record(len + 1);
+  snprintf(record.data(), record.size(), fmt,
+           tag_json.c_str(), dst_json.c_str(), getpid(),
+           started, wait, finished - started,
+           sources, (unsigned long) bytes);
+
+  redisAppendCommand(c, "LPUSH %b %b", key.data(), key.size(),
+                     record.data(), (size_t) len);
+  redisAppendCommand(c, "LTRIM %b 0 %d", key.data(), key.size(),
+                     JOB_HISTORY - 1);
+  for (int _i = 0; _i < 2; _i++) {
+    if (redisGetReply(c,(void **)&r) == REDIS_OK)
+      freeReplyObject(r);
+  }
+}
+
 void known_path(redisContext *c, string nametag, string ribtag, int flags)
 {
   assert(c);
@@ -266,6 +348,8 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
       continue;
     }
     log.notice("Processing request for routes to %s",dest.c_str());
+    double started = now_secs();
+    double queued = destinationQueue.queued_at(dest);
 
     candidate_queue.clear();
     InitQueueResult iqr = init_active_queue(c,candidate_queue,dest,ribtag,log);
@@ -274,13 +358,24 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
 
     if (candidate_queue.size() == 0) {
       log.warn("No known routes to %s",dest.c_str());
-      redisReply *r = rCommand(c,"PUBLISH inference:query_status %s|%s",ribtag.c_str(),dest.c_str());
+      redisReply *r = rCommand(c,"PUBLISH inference:query_status:%s %s|%s",
+                                  ribtag.c_str(),ribtag.c_str(),dest.c_str());
       freeReplyObject(r);
+      record_job(c, ribtag, dest, queued, started, now_secs(), 0, 0);
+      destinationQueue.ack(dest);
       continue;
     }
 
+    // Keep our lease on dest, or it'll be handed to someone else
+    time_t lease_timer = time(0);
     while (candidate_queue.size() > 0) {
       //fprintf(stderr,"looping through candidates\n");
+      if (time(0) - lease_timer >= destinationQueue.lease / 3) {
+        if (!destinationQueue.touch(dest))
+          log.warn("Lease on %s ran out. It may be inferred twice.",
+                   dest.c_str());
+        lease_timer = time(0);
+      }
       int candidate = get_candidate(candidate_queue);
 
       //log.notice("Trying new candidate %s. %u remain in queue.",
@@ -343,6 +438,8 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
       }
     }
 
+    destinationQueue.touch(dest);
+
     PathSet::iterator origin_it;
     origin_it = rib_in->begin();
     redisReply *r; 
@@ -360,6 +457,7 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
     arglen[1] = strnlen(result_key,sizeof(result_key));
 
     int cmd_ctr = 0, total_ctr = 0;
+    size_t result_bytes = 0;
     for (; origin_it != rib_in->end(); origin_it++) {
       PathSet::pathset_t::iterator bpath_it = origin_it->second.begin();
       Path_ptr p = *bpath_it;
@@ -367,25 +465,29 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
         fprintf(stdout, "%s\n", p->cstr());
         continue;
       }
-      if (cmd_ctr < 100) {
-
-        args[2] = ASN_decode_new(origin_it->first);
-        arglen[2] = strnlen(args[2],sizeof(_asn_decoder_buf));
-        args[3] = p->cstr();
-        arglen[3] = p->cstrlen();
-
-        redisAppendCommandArgv(c, 4, args, arglen); 
-        delete [] args[2];
-        cmd_ctr++;
-        total_ctr++;
-      } 
-      else {
+      if (cmd_ctr >= 100) {
         for (int _i = 0; _i < cmd_ctr; _i++) {
           redisGetReply(c,(void **)&r);
           freeReplyObject(r);
         }
         cmd_ctr = 0;
       }
+
+      args[2] = ASN_decode_new(origin_it->first);
+      arglen[2] = strnlen(args[2],sizeof(_asn_decoder_buf));
+      if (FLAG_GET(flags,FLAG_PACKED_PATHS)) {
+        args[3] = p->packed(&arglen[3]);
+      }
+      else {
+        args[3] = p->cstr();
+        arglen[3] = p->cstrlen();
+      }
+
+      redisAppendCommandArgv(c, 4, args, arglen); 
+      result_bytes += arglen[2] + arglen[3];
+      delete [] args[2];
+      cmd_ctr++;
+      total_ctr++;
     }
     if (! FLAG_GET(flags,FLAG_DUMP_GRAPH)) {
       for (int _i = 0; _i < cmd_ctr; _i++) {
@@ -395,12 +497,15 @@ void known_path(redisContext *c, string nametag, string ribtag, int flags)
         }
         freeReplyObject(r);
       }
-      r = rCommand(c,"PUBLISH inference:query_status %s|%s",
-                   ribtag.c_str(),dest.c_str());
+      r = rCommand(c,"PUBLISH inference:query_status:%s %s|%s",
+                   ribtag.c_str(),ribtag.c_str(),dest.c_str());
       freeReplyObject(r);
       r = rCommand(c,"EXPIRE %s 600",result_key);
       freeReplyObject(r);
+      record_job(c, ribtag, dest, queued, started, now_secs(),
+                 total_ctr, result_bytes);
     }
+    destinationQueue.ack(dest);
     log.notice("Inferred Routes to %s. Took %u seconds",
                dest.c_str(),
                time(0)-dest_timer);
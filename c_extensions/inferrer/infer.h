@@ -3,6 +3,7 @@
 
 #include <assert.h>
 #include <time.h>
+#include <sys/time.h>
 #include "hiredis/hiredis.h"
 #include <iostream>
 #include <sstream>
@@ -25,6 +26,11 @@
 #define rCommand(c,cmd,...) (redisReply *) redisCommand((c),(cmd),##__VA_ARGS__)
 
 #define FLAG_DUMP_GRAPH 1
+#define FLAG_PACKED_PATHS 2
+
+/* Job records kept for each tag in inference:jobs:<tag>,
+ * newest first */
+#define JOB_HISTORY 10000
 
 #define FLAGS_INIT(flags) int flags = 0
 #define FLAG_SET(flags,flagname) flags |= (0x1 << ( flagname ))
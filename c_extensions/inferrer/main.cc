@@ -24,6 +24,9 @@ int main(int argc, char const *argv[])
   if (args.dump_graph_flag) {
     FLAG_SET(flags, FLAG_DUMP_GRAPH);
   }
+  if (args.packed_flag) {
+    FLAG_SET(flags, FLAG_PACKED_PATHS);
+  }
 
   known_path(c,string(args.procqueue_arg),string(args.ribtag_arg), flags);
 
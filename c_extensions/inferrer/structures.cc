@@ -1,24 +1,37 @@
 #include "structures.h"
 
-RQueue::RQueue(redisContext *c, string key, bool am_listener)
+static string
+load_script(redisContext *c, const char *script)
 {
-  this->key = key;
-  this->c = c;
-  this->am_listener = am_listener;
-
-  redisReply * r = rCommand(c,"SCRIPT LOAD %b", add_script,strlen(add_script));
+  redisReply * r = rCommand(c,"SCRIPT LOAD %b", script,strlen(script));
   assert(r);
   if (r->type != REDIS_REPLY_STRING) {
     fprintf(stderr,"Error loading script: %s",r->str);
     assert( r->type == REDIS_REPLY_STRING);
   }
   //Save the SHA hash for the script
-  add_script_sha = r->str;
+  string sha = r->str;
   freeReplyObject(r);
+  return sha;
+}
+
+RQueue::RQueue(redisContext *c, string key, bool am_listener, int lease)
+{
+  redisReply *r;
+  this->key = key;
+  this->c = c;
+  this->am_listener = am_listener;
+  this->lease = lease;
+
+  add_script_sha = load_script(c, add_script);
+  pop_script_sha = load_script(c, pop_script);
+  touch_script_sha = load_script(c, touch_script);
 
   snprintf(listener_key,128,"procqueue:%s:meta:have_listener",key.c_str());
   snprintf(k_dolist_set,64,"procqueue:%s:infilter",key.c_str());
   snprintf(k_dolist_list,64,"procqueue:%s:list",key.c_str());
+  snprintf(k_inprogress,64,"procqueue:%s:inprogress",key.c_str());
+  snprintf(k_enqueued,64,"procqueue:%s:enqueued",key.c_str());
 
   if (am_listener) {
     r = rCommand(c,"INCR %s",listener_key);
@@ -47,20 +60,52 @@ RQueue::~RQueue()
   }
 }
 
+/* Queue ARGV[1], unless it already is, and note that it was
+ * first queued at ARGV[2] */
 const char *RQueue::add_script= 
   "local sadd_result = nil; "
   "sadd_result = redis.call('SADD',KEYS[1],ARGV[1]); "
   "if sadd_result > 0 then "
   "  redis.call('LPUSH',KEYS[2],ARGV[1]); "
+  "  redis.call('HSETNX',KEYS[3],ARGV[1],ARGV[2]); "
   "end "
   "return sadd_result; ";
 
+/* Requeue anything whose lease (the score in KEYS[3]) ran out
+ * before ARGV[1], unless it's already queued again. Then take
+ * the next element, and lease it for ARGV[2] seconds. */
+const char *RQueue::pop_script=
+  "local expired = redis.call('ZRANGEBYSCORE',KEYS[3],'-inf',ARGV[1]); "
+  "for _, element in ipairs(expired) do "
+  "  redis.call('ZREM',KEYS[3],element); "
+  "  if redis.call('SADD',KEYS[2],element) == 1 then "
+  "    redis.call('RPUSH',KEYS[1],element); "
+  "  end "
+  "end "
+  "local element = redis.call('RPOP',KEYS[1]); "
+  "if not element then "
+  "  return false; "
+  "end "
+  "redis.call('SREM',KEYS[2],element); "
+  "redis.call('ZADD',KEYS[3],tonumber(ARGV[1]) + tonumber(ARGV[2]),element); "
+  "return element; ";
+
+/* Move the lease on ARGV[2] to ARGV[1], if it still has one */
+const char *RQueue::touch_script=
+  "if redis.call('ZSCORE',KEYS[1],ARGV[2]) then "
+  "  redis.call('ZADD',KEYS[1],ARGV[1],ARGV[2]); "
+  "  return 1; "
+  "end "
+  "return 0; ";
+
 void
 RQueue::clear()
 {
-  redisReply *r = rCommand( c,"DEL %s %s",
+  redisReply *r = rCommand( c,"DEL %s %s %s %s",
                             k_dolist_set,
-                            k_dolist_list);
+                            k_dolist_list,
+                            k_inprogress,
+                            k_enqueued);
 
   assert(r && r->type == REDIS_REPLY_INTEGER);
   freeReplyObject(r);
@@ -68,15 +113,38 @@ RQueue::clear()
 
 void
 RQueue::push(string val){
-  redisReply *r = rCommand(c, "EVALSHA %s %d %s %s %s",
+  struct timeval now;
+  gettimeofday(&now, NULL);
+  redisReply *r = rCommand(c, "EVALSHA %s %d %s %s %s %s %ld.%06ld",
                                add_script_sha.c_str(),
-                               2, k_dolist_set, k_dolist_list,
-                               val.c_str());
+                               3, k_dolist_set, k_dolist_list, k_enqueued,
+                               val.c_str(),
+                               (long) now.tv_sec, (long) now.tv_usec);
   assert(r);
 
   freeReplyObject(r);
 }
 
+string
+RQueue::lease_next()
+{
+  string element;
+  redisReply *r = rCommand(c, "EVALSHA %s %d %s %s %s %ld %d",
+                              pop_script_sha.c_str(),
+                              3, k_dolist_list, k_dolist_set, k_inprogress,
+                              (long) time(NULL), lease);
+  assert(r);
+  if (r->type == REDIS_REPLY_STRING)
+    element = string(r->str, r->len);
+  else if (r->type == REDIS_REPLY_ERROR)
+    fprintf(stderr, "Error popping from %s: %s\n", k_dolist_list, r->str);
+
+  freeReplyObject(r);
+  return element;
+}
+
+/* Pop and lease the next element, waiting up to two seconds
+ * for one to arrive. Returns "" if none did. */
 string 
 RQueue::pop() 
 {
@@ -84,32 +152,62 @@ RQueue::pop()
   redisReply *r;
 
   assert(c && !c->err);
-  r = rCommand(c,"BRPOP %s:%s:%s 2","procqueue",key.c_str(),"list");
-  if (r->type == REDIS_REPLY_INTEGER) {
-    freeReplyObject(r);
-    return "";
-  }
-  else if (r->type == REDIS_REPLY_ARRAY) {
-    if (r->elements <= 0) {
-      freeReplyObject(r);
-      return "";
-    }
-    element = string(r->element[1]->str);
-    freeReplyObject(r);
-  }
-  else if (r->type == REDIS_REPLY_NIL) {
-    freeReplyObject(r);
-    return "";
-  }
+  element = lease_next();
+  if (!element.empty())
+    return element;
 
-  //Remove it from the set tracker
-  r = rCommand(c,"SREM %s:%s:%s %s",
-                "procqueue",key.c_str(),"infilter",
-                element.c_str());
-  assert(r && r->type == REDIS_REPLY_INTEGER && r->integer == 1);
+  // Block until something is queued, leaving it where it is,
+  // so that it's only ever taken by the lease script.
+  r = rCommand(c,"BRPOPLPUSH %s %s 2",k_dolist_list,k_dolist_list);
+  assert(r);
   freeReplyObject(r);
 
-  return element;
+  return lease_next();
+}
+
+/* Finished with val. Drop its lease, and forget when it
+ * was queued. */
+void
+RQueue::ack(string val)
+{
+  redisReply *r = rCommand(c, "ZREM %s %s", k_inprogress, val.c_str());
+  assert(r);
+  freeReplyObject(r);
+  r = rCommand(c, "HDEL %s %s", k_enqueued, val.c_str());
+  assert(r);
+  freeReplyObject(r);
+}
+
+/* When val was first queued, in seconds since the epoch, or
+ * 0 if we don't know. Requeues after a lease runs out don't
+ * count, so this covers every attempt at it. */
+double
+RQueue::queued_at(string val)
+{
+  double when = 0;
+  redisReply *r = rCommand(c, "HGET %s %s", k_enqueued, val.c_str());
+  assert(r);
+  if (r->type == REDIS_REPLY_STRING)
+    when = atof(r->str);
+  freeReplyObject(r);
+  return when;
+}
+
+/* Renew the lease on val. Returns false if it had run out,
+ * in which case someone else may be working on it too. */
+bool
+RQueue::touch(string val)
+{
+  bool leased;
+  redisReply *r = rCommand(c, "EVALSHA %s %d %s %ld %s",
+                              touch_script_sha.c_str(),
+                              1, k_inprogress,
+                              (long) time(NULL) + lease,
+                              val.c_str());
+  assert(r);
+  leased = (r->type == REDIS_REPLY_INTEGER && r->integer == 1);
+  freeReplyObject(r);
+  return leased;
 }
 
 vector<string> *
@@ -326,6 +424,23 @@ Path::cstr(bool show_uncertain)
   return cbuf;
 }
 
+/* The whole path packed as described by PACKED_PATH_MAGIC.
+ * Its length is stored in *len, since it may contain NULs. */
+const char *
+Path::packed(size_t *len)
+{
+  pbuf.assign(PACKED_PATH_MAGIC, PACKED_PATH_MAGIC_LEN);
+  pbuf.reserve(PACKED_PATH_MAGIC_LEN + 4 * path.size());
+  for (asn_t x : path) {
+    pbuf.push_back((char)(x & 0xff));
+    pbuf.push_back((char)((x >> 8) & 0xff));
+    pbuf.push_back((char)((x >> 16) & 0xff));
+    pbuf.push_back((char)((x >> 24) & 0xff));
+  }
+
+  *len = pbuf.size();
+  return pbuf.data();
+}
 
 string
 Path::to_string()  const
@@ -21,25 +21,49 @@ typedef unordered_map<asn_t,linkinfo_t *> linkdict_t;
 
 class PathSet;
 
+/* Packed paths are this prefix followed by each ASN as a
+ * little-endian uint32, as encoded by ASN_encode. Text paths
+ * never start with a NUL, so the two can't be confused. See
+ * inettopology/asmap/infer/encoding.py */
+#define PACKED_PATH_MAGIC "\0AP1"
+#define PACKED_PATH_MAGIC_LEN 4
+
+/* Seconds an element popped from an RQueue is leased for. Must
+ * match ProcessingQueue.LEASE in inettopology/util/structures.py */
+#define RQUEUE_LEASE 30
+
 class RQueue {
   public:
 
-    RQueue(redisContext *c,string key,bool am_listener=true);
+    RQueue(redisContext *c,string key,bool am_listener=true,
+           int lease=RQUEUE_LEASE);
     ~RQueue();
     string pop();
     void push(string val);
+    void ack(string val);
+    bool touch(string val);
+    double queued_at(string val);
     void clear();
 
     bool am_listener;
     string key;
     redisContext *c;
     char listener_key[128];
+    int lease;
 
     static const char *add_script; 
+    static const char *pop_script;
+    static const char *touch_script;
 
     string add_script_sha;
+    string pop_script_sha;
+    string touch_script_sha;
+
+    char k_dolist_set[64], k_dolist_list[64], k_inprogress[64];
+    char k_enqueued[64];
 
-    char k_dolist_set[64], k_dolist_list[64];
+  private:
+    string lease_next();
 
 };
 
@@ -98,6 +122,7 @@ class Path {
     string to_string() const;
     const char * cstr(bool show_uncertain=false);
     size_t cstrlen();
+    const char * packed(size_t *len);
 
     list<asn_t> path;
     list<asn_t>::const_iterator sp_begin;
@@ -107,6 +132,7 @@ class Path {
     bool valley_free;
     bool have_loop;
     char cbuf[512];
+    string pbuf;
     bool cbuf_dirty;
     
     bool operator<(const Path &p) const;
@@ -140,3 +140,45 @@ TEST(PathTest, PrintEmptyPathIsOkay)
   ASSERT_STREQ("",p.cstr());
 }
 
+
+TEST(PathTest, PackedPathIsMagicThenLittleEndianASNs)
+{
+  std::vector<asn_t> x;
+  x.push_back(ASN_encode("1234"));
+  x.push_back(ASN_encode("5.3224"));
+  Path p(x);
+
+  size_t len;
+  const unsigned char *packed = (const unsigned char *)p.packed(&len);
+  ASSERT_EQ(PACKED_PATH_MAGIC_LEN + 8, len);
+  ASSERT_EQ(0, memcmp(PACKED_PATH_MAGIC, packed, PACKED_PATH_MAGIC_LEN));
+
+  packed += PACKED_PATH_MAGIC_LEN;
+  asn_t first = packed[0] | packed[1] << 8 | packed[2] << 16 | packed[3] << 24;
+  ASSERT_EQ(1234, first);
+  packed += 4;
+  asn_t second = packed[0] | packed[1] << 8 | packed[2] << 16 | packed[3] << 24;
+  ASSERT_EQ(ASN_encode("5.3224"), second);
+}
+
+TEST(PathTest, PackedEmptyPathIsJustMagic)
+{
+  Path p;
+  size_t len;
+  p.packed(&len);
+  ASSERT_EQ(PACKED_PATH_MAGIC_LEN, len);
+}
+
+TEST(PathTest, PackedLongPathIsComplete)
+{
+  std::vector<asn_t> x;
+  for (asn_t asn = 1; asn <= 300; asn++)
+    x.push_back(asn);
+  Path p(x);
+
+  size_t len;
+  const unsigned char *packed = (const unsigned char *)p.packed(&len);
+  ASSERT_EQ(PACKED_PATH_MAGIC_LEN + 4 * 300, len);
+  packed += PACKED_PATH_MAGIC_LEN + 4 * 299;
+  ASSERT_EQ(300, packed[0] | packed[1] << 8 | packed[2] << 16 | packed[3] << 24);
+}
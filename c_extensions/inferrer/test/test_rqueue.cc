@@ -25,8 +25,10 @@ class RQueueTest: public ::testing::Test
 
     virtual void TearDown() {
       if (c_ && !c_->err) { 
-        r = rCommand(c_,"DEL procqueue:%s:infilter procqueue:%s:list",
-                     testing.c_str(),testing.c_str());
+        r = rCommand(c_,"DEL procqueue:%s:infilter procqueue:%s:list "
+                        "procqueue:%s:inprogress procqueue:%s:enqueued",
+                     testing.c_str(),testing.c_str(),testing.c_str(),
+                     testing.c_str());
         freeReplyObject(r);
       }
       r = rCommand(c_,"DEL testing:list testing:list2");
@@ -275,3 +277,114 @@ TEST_F(RQueueTest, ClearEmptiesList)
   string res = _rqueue->pop();
   ASSERT_STREQ("",res.c_str());
 }
+
+TEST_F(RQueueTest, PopLeasesElement)
+{
+  ASSERT_REDIS(c_);
+
+  time_t now = time(NULL);
+  _rqueue->push("winner");
+  string res = _rqueue->pop();
+  ASSERT_STREQ("winner",res.c_str());
+
+  r = rCommand(c_,"ZSCORE %s winner",_rqueue->k_inprogress);
+  ASSERT_EQ(REDIS_REPLY_STRING,r->type);
+  long deadline = atol(r->str);
+  ASSERT_GE(deadline, now + _rqueue->lease);
+  ASSERT_LE(deadline, time(NULL) + _rqueue->lease);
+  freeReplyObject(r);
+}
+
+TEST_F(RQueueTest, AckRemovesLease)
+{
+  ASSERT_REDIS(c_);
+
+  _rqueue->push("winner");
+  string res = _rqueue->pop();
+  ASSERT_STREQ("winner",res.c_str());
+
+  _rqueue->ack(res);
+  r = rCommand(c_,"ZCARD %s",_rqueue->k_inprogress);
+  ASSERT_REDIS_INT(r,0);
+  freeReplyObject(r);
+
+  ASSERT_FALSE(_rqueue->touch(res));
+}
+
+TEST_F(RQueueTest, ExpiredLeaseRequeues)
+{
+  ASSERT_REDIS(c_);
+
+  RQueue *rq = new RQueue(c_, testing, false, 1);
+  rq->push("winner");
+  string res = rq->pop();
+  ASSERT_STREQ("winner",res.c_str());
+
+  // Still leased
+  res = rq->pop();
+  ASSERT_STREQ("",res.c_str());
+
+  sleep(2);
+  res = rq->pop();
+  ASSERT_STREQ("winner",res.c_str());
+  delete rq;
+}
+
+TEST_F(RQueueTest, RequeueIsDedupSafe)
+{
+  ASSERT_REDIS(c_);
+
+  RQueue *rq = new RQueue(c_, testing, false, 1);
+  rq->push("winner");
+  string res = rq->pop();
+  ASSERT_STREQ("winner",res.c_str());
+
+  // Asked for again while the first lease is running
+  rq->push("winner");
+  sleep(2);
+
+  res = rq->pop();
+  ASSERT_STREQ("winner",res.c_str());
+  rq->ack(res);
+  res = rq->pop();
+  ASSERT_STREQ("",res.c_str());
+  delete rq;
+}
+
+TEST_F(RQueueTest, TouchExtendsLease)
+{
+  ASSERT_REDIS(c_);
+
+  RQueue *rq = new RQueue(c_, testing, false, 3);
+  rq->push("winner");
+  string res = rq->pop();
+  ASSERT_STREQ("winner",res.c_str());
+
+  sleep(2);
+  ASSERT_TRUE(rq->touch(res));
+  sleep(2);
+
+  res = rq->pop();
+  ASSERT_STREQ("",res.c_str());
+  delete rq;
+}
+
+TEST_F(RQueueTest, QueuedAtIsFirstPushUntilAcked)
+{
+  ASSERT_REDIS(c_);
+
+  ASSERT_EQ(0, _rqueue->queued_at("winner"));
+
+  time_t before = time(NULL);
+  _rqueue->push("winner");
+  double queued = _rqueue->queued_at("winner");
+  ASSERT_GE(queued, before);
+  ASSERT_LE(queued, time(NULL) + 1);
+
+  string res = _rqueue->pop();
+  ASSERT_STREQ("winner",res.c_str());
+  ASSERT_EQ(queued, _rqueue->queued_at("winner"));
+
+  _rqueue->ack(res);
+  ASSERT_EQ(0, _rqueue->queued_at("winner"));
+}
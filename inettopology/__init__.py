@@ -1,6 +1,7 @@
 import argparse
 import pkg_resources
 import logging
+import sys
 logging.basicConfig(level=logging.WARN)
 
 
@@ -9,13 +10,31 @@ class SilentExit(RuntimeError):
 
 
 def run():
+  """ Build the commandline from the 'inettopology.modules'
+  entry points and run the selected command.
+
+  Only the module named on the commandline is loaded, so
+  running one module's commands doesn't pay for importing
+  the others. Modules are expected to keep their
+  __argparse__ free of heavy imports (gevent, networkx,
+  numpy, ...) and defer them until a command runs.
+  """
   mainparser = argparse.ArgumentParser()
   module_parsers = mainparser.add_subparsers()
 
   verbose_parser = argparse.ArgumentParser(add_help=False)
   verbose_parser.add_argument("-v", "--verbose", action='count', default=0)
 
-  for ep in pkg_resources.iter_entry_points(group='inettopology.modules'):
+  entry_points = list(pkg_resources.iter_entry_points(
+                      group='inettopology.modules'))
+  requested = sys.argv[1] if len(sys.argv) > 1 else None
+  load_all = requested not in [ep.name for ep in entry_points]
+
+  for ep in entry_points:
+    if not load_all and ep.name != requested:
+      module_parsers.add_parser(ep.name)
+      continue
+
     try:
       module = ep.load()
     except:
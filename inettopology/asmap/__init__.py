@@ -1,9 +1,3 @@
-try:
-  from gevent import monkey
-  monkey.patch_all()
-except ImportError:
-  pass
-
 __all__ = ['DBKEYS']
 _OBJ = lambda **kwargs: type('obj', (object,), kwargs)()
 
@@ -15,5 +9,6 @@ DBKEYS = _OBJ(
     TAG_LINKS=lambda sa, x: "{0}_as_links".format(x),
     INFERRED=lambda s, dest, tags: "inferred_to:{0}:tags:{1}".format(
                                    dest, "_".join(tags)),
-    INFERRED_KEYS='inferred:keylist'
+    INFERRED_KEYS='inferred:keylist',
+    QUERY_STATUS=lambda s, tag: "inference:query_status:{0}".format(tag)
 )
@@ -1,9 +1,7 @@
 import argparse
 import logging
 
-import inettopology.util
-import inettopology.util.structures as structures
-import inettopology.asmap.core
+from inettopology.util.general import RedisArgAction
 import inettopology.asmap.data
 import inettopology.asmap.infer
 import inettopology.asmap.extra
@@ -26,6 +24,16 @@ def run():
   args.func(args)
 
 
+def _clean(args):
+  import inettopology.asmap.core as core
+  core.clean(args)
+
+
+def _list_misc(args):
+  import inettopology.asmap.core as core
+  core.list_misc(args)
+
+
 def __argparse__(subp, parents=[]):
   """ Add all the relevant parsers to :subp:
 
@@ -33,7 +41,7 @@ def __argparse__(subp, parents=[]):
   :parents: as parent parsers.
   """
   gen_p = argparse.ArgumentParser(add_help=False)
-  gen_p.add_argument("--redis", action=structures.RedisArgAction,
+  gen_p.add_argument("--redis", action=RedisArgAction,
                      default={'host': 'localhost', 'port': 6379, 'db': 0},
                      help="Redis connection info for router server "
                           "(default: 'localhost:6379:0')")
@@ -56,13 +64,13 @@ def __argparse__(subp, parents=[]):
   clean_parser.add_argument("--rib_links",
                             help="Clean links from ROUTEVIEWS RIB files",
                             nargs='+')
-  clean_parser.set_defaults(func=inettopology.asmap.core.clean)
+  clean_parser.set_defaults(func=_clean)
 
   list_parser = subp.add_parser("list", help="List miscellaneous information",
                                 parents=parents)
   list_parser.add_argument("--tags", help="List the RIB tags that exist",
                            action="store_true")
-  list_parser.set_defaults(func=inettopology.asmap.core.list_misc)
+  list_parser.set_defaults(func=_list_misc)
 
 if __name__ == '__main__':
   run()
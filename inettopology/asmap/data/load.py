@@ -2,7 +2,6 @@ import itertools
 import os
 import re
 import json
-import redis
 
 import logging
 log = logging.getLogger(__name__)
@@ -11,95 +10,6 @@ from inettopology.asmap import DBKEYS
 import inettopology.util as utils
 import inettopology.util.structures as redis_structures
 
-load_help = """
-Load data from datafiles into the database.
-
-A couple different types of data files can be loaded,
-and each supports a few different options:
-"""
-
-aslinks_help = """
-CAIDA AS Links datafiles
-
-  --include-indirect    Include links CAIDA has flagged as
-                        'indirect'.
-
-"""
-
-ribfile_help = """
-Routeviews RIB files in text format as
-          output by 'bgpdump -M'
-
-  --tag                 (required) A tag for the routes parsed
-                        from this RIB file. Inference is performed
-                        against a specific tag, so this is important.
-
-"""
-
-asrel_help = """
-AS Relationships from various sources
-
-AS Relationship Information is established from three datasets
-all of which which are optional. First data from Gao inference is
-applied, then CAIDA data is overlaid, making corrections as necessary.
-Finally, sibling information parsed from WHOIS data is applied, making
-corrections again.
-"""
-
-
-def add_cmdline_args(subp, parents):
-  """ Add the commandline arguments for this module
-  to the subparser :subp:.
-
-  Include :parents: as parents of the parser """
-
-  read_parser = subp.add_parser("load",
-                                help=load_help,
-                                parents=parents)
-  subsub = read_parser.add_subparsers()
-  aslinks = subsub.add_parser('aslinks', help=aslinks_help)
-  aslinks.add_argument('aslinks', help='AS links datafile', metavar='PATH')
-  aslinks.add_argument("--include-indirect",
-                       help="Include indirect AS links",
-                       action="store_true")
-  aslinks.set_defaults(func=_load_data, datatype='aslinks')
-
-  ribfile = subsub.add_parser('ribfile', help=ribfile_help)
-  ribfile.add_argument("ribfile",
-                       help="RIB datafile",
-                       metavar='PATH')
-  ribfile.add_argument("-t", "--tag",
-                       required=True,
-                       help="RIB data tag")
-  ribfile.set_defaults(func=_load_data, datatype='ribfile')
-
-  asrel_parser = subsub.add_parser("asrels", help=asrel_help,
-                                   parents=parents)
-  asrel_parser.add_argument("--gao",
-                            help="Output file of GAO relationship inference",
-                            required=True)
-  asrel_parser.add_argument("--caida", help="CAIDA AS Relationship Datafile")
-  asrel_parser.add_argument("--siblings", help="WHOIS sibling match dataset")
-  asrel_parser.add_argument("--conflict-log",
-                            help="A file to log all conflicts to")
-
-  asrel_parser.set_defaults(func=_load_data, datatype='asrel')
-
-
-def _load_data(args):
-  r = redis.StrictRedis(**args.redis)
-
-  if not r.ping():
-    raise Exception("Failed to connect to Redis")
-
-  if args.datatype == 'aslinks':
-    read_aslinks(r, args.aslinks, args.include_indirect)
-  elif args.datatype == 'ribfile':
-    parse_routes(r, args.ribfile, args.tag)
-  elif args.datatype == 'asrel':
-    load_asrels(r, args.gao, args.caida, args.siblings,
-                conflict_log=args.conflict_log)
-
 
 def read_aslinks(r, filename, include_indirect):
   """ aslinks - CAIDA AS Links datafiles
@@ -1,10 +1,8 @@
 
-import inettopology.util.structures as redis_structures
 import inettopology.util as utils
 from inettopology.asmap import DBKEYS
 
 import json
-import networkx as nx
 import ast
 
 import logging
@@ -67,6 +65,12 @@ def c2p_heuristic(transit, as1, as2, L=5):
 
 
 def mk_graph(args):
+  try:
+    import networkx as nx
+  except ImportError:
+    logger.error("'networkx' not found. Try 'pip install networkx'")
+    return
+  import inettopology.util.structures as redis_structures
 
   rinfo = redis_structures.ConnectionInfo(**args.redis)
   r = rinfo.instantiate()
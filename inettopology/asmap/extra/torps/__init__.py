@@ -13,6 +13,26 @@ def _analyze(args):
   analyzer.main(args)
 
 
+def _convert_trace(args):
+  import inettopology.asmap.extra.torps.trace as trace
+  trace.convert(args.datafile, args.output)
+
+
+def _export_results(args):
+  import inettopology.asmap.extra.torps.process as processor
+  processor.export_results(args)
+
+
+def _export_records(args):
+  import inettopology.asmap.extra.torps.records as records
+  records.export(args)
+
+
+def _build_path_table(args):
+  import inettopology.asmap.extra.torps.pathtable as pathtable
+  pathtable.build(args)
+
+
 def _postprocess(args):
   import inettopology.asmap.extra.torps.process as processor
   processor.analyze(args)
@@ -45,6 +65,25 @@ def __argparse__(subp, parents):
                                    "These are organizations of IXPS",
                               required=True)
 
+  missing_parser.add_argument("--path-cache", metavar="CACHEFILE",
+                              help="A path cache shared between runs. "
+                                   "Paths found in it aren't looked up, "
+                                   "and paths which are looked up are "
+                                   "added to it")
+
+  missing_parser.add_argument("--output-format", choices=("text", "jsonl"),
+                              default="text",
+                              help="Write pipe-delimited text records, or "
+                                   "JSON lines with integer-encoded paths "
+                                   "and IXPs (default: text)")
+
+  missing_parser.add_argument("--plan-lookups", action="store_true",
+                              help="Read every endpoint pair first, then "
+                                   "look them up grouped by destination, "
+                                   "so the server infers the paths to "
+                                   "each destination as few times as "
+                                   "possible")
+
   missing_parser.add_argument("datafile", help="Endpoints file", nargs="+")
   missing_parser.set_defaults(func=_process_missing)
 
@@ -72,26 +111,108 @@ def __argparse__(subp, parents):
                            required=True)
 
   meg = pre_parser.add_mutually_exclusive_group(required=True)
-  meg.add_argument("--client_as_file",
+  meg.add_argument("--client_as_file", action="append",
                    help='A file containing one line per AS where clients are '
                         "located. Each client in the simulation will be "
                         "chosen as having originated from one of those ASes "
-                        "at random"
+                        "at random. May be given more than once; each file "
+                        "is preprocessed as a separate set of clients"
                    )
 
-  meg.add_argument("--client_as",
-                   help="The client AS for all samples in this trace")
+  meg.add_argument("--client_as", action="append",
+                   help="The client AS for all samples in this trace. "
+                        "May be given more than once; each AS is "
+                        "preprocessed as a separate client")
+
+  pre_parser.add_argument("--output-prefix",
+                          help="Write the output for each client to "
+                               "'<prefix>.<client>.aspaths.out' instead of "
+                               "stdout. Required with more than one client")
 
   pre_parser.add_argument("--load_paths",
                           help="Load already processed paths from this file")
-  pre_parser.add_argument("datafile", help="Simulation output file", nargs="+")
+  pre_parser.add_argument("--path-cache", metavar="CACHEFILE",
+                          help="A path cache shared between runs. "
+                               "Paths found in it aren't looked up, "
+                               "and paths which are looked up are "
+                               "added to it. Parallel runs can share "
+                               "the same cache")
+
+  pre_parser.add_argument("--output-format", choices=("text", "jsonl"),
+                          default="text",
+                          help="Write pipe-delimited text records, or "
+                               "JSON lines with integer-encoded paths "
+                               "and IXPs (default: text). "
+                               "torps.export_records turns JSON lines "
+                               "back into text")
+
+  pre_parser.add_argument("--plan-lookups", action="store_true",
+                          help="Hold back path lookups until every trace "
+                               "file has been read, then send them "
+                               "grouped by destination, so the server "
+                               "infers the paths to each destination as "
+                               "few times as possible")
+
+  pre_parser.add_argument("--checkpoint", metavar="CHECKPOINTFILE",
+                          help="Periodically save this run's state here, so "
+                               "it can be continued with --resume")
+
+  pre_parser.add_argument("--checkpoint-interval", type=int, default=300,
+                          metavar="SECONDS",
+                          help="How often to checkpoint (default: 300)")
+
+  pre_parser.add_argument("--resume", action="store_true",
+                          help="Continue from the state saved in --checkpoint")
+
+  pre_parser.add_argument("datafile", nargs="+",
+                          help="Simulation output file, or a trace "
+                               "directory created by torps.convert_trace")
   pre_parser.set_defaults(func=_preprocess)
 
+  convert_parser = subp.add_parser("torps.convert_trace",
+                                   help="Convert a simulation output file "
+                                        "to a columnar binary trace which "
+                                        "torps.preprocess and torps.analyze "
+                                        "can read without parsing text. "
+                                        "Requires numpy",
+                                   parents=parents)
+
+  convert_parser.add_argument("datafile", help="Simulation output file")
+  convert_parser.add_argument("output",
+                              help="The directory to write the trace to")
+  convert_parser.set_defaults(func=_convert_trace)
+
+  export_parser = subp.add_parser("torps.export_records",
+                                  help="Write the records in preprocessed "
+                                       "files, in either output format, "
+                                       "as text",
+                                  parents=parents)
+
+  export_parser.add_argument("datafile", nargs="+",
+                             help="Preprocessed files")
+  export_parser.add_argument("output", help="The text file to write")
+  export_parser.set_defaults(func=_export_records)
+
+  table_parser = subp.add_parser("torps.build_path_table",
+                                 help="Collect the paths in preprocessed "
+                                      "files into a binary path table, "
+                                      "which torps.analyze and "
+                                      "torps.find_adversaries load "
+                                      "much faster",
+                                 parents=parents)
+
+  table_parser.add_argument("datafile", nargs="+",
+                            help="Files containing preprocessed paths")
+  table_parser.add_argument("output", help="The path table to write")
+  table_parser.set_defaults(func=_build_path_table)
+
   post_parser = subp.add_parser("torps.analyze",
                                 help="Count bad things in trace files",
                                 parents=parents)
 
-  post_parser.add_argument("datafile", help="The datafile to process")
+  post_parser.add_argument("datafile",
+                           help="The datafile to process, or a trace "
+                                "directory created by torps.convert_trace")
 
   post_parser.add_argument("--samples",
                            help="The number of samples in the file",
@@ -104,7 +225,9 @@ def __argparse__(subp, parents):
                            default=0)
 
   post_parser.add_argument("--paths", metavar="PATHFILE",
-                           help="A file containing preprocessed paths",
+                           help="A file containing preprocessed paths, "
+                                "or a path table built by "
+                                "torps.build_path_table",
                            required=True)
 
   post_parser.add_argument("--badguys",
@@ -116,9 +239,53 @@ def __argparse__(subp, parents):
                            help="A short identification tag for this file",
                            dest="filetag")
 
-  post_parser.add_argument("--output_dir")
+  post_parser.add_argument("--jobs", type=int, default=1,
+                           help="Split the trace into shards and analyze "
+                                "them with this many processes")
+
+  post_parser.add_argument("--results", metavar="RESULTFILE",
+                           help="Write every adversary's results to this "
+                                ".npz file, checkpointing it as the "
+                                "analysis runs")
+
+  post_parser.add_argument("--checkpoint-interval", type=int, default=300,
+                           metavar="SECONDS",
+                           help="How often to checkpoint --results "
+                                "and --checkpoint (default: 300)")
+
+  post_parser.add_argument("--checkpoint", metavar="CHECKPOINTFILE",
+                           help="Periodically save this run's state here, so "
+                                "it can be continued with --resume")
+
+  post_parser.add_argument("--resume", action="store_true",
+                           help="Continue from the state saved in --checkpoint")
+
+  post_parser.add_argument("--output_dir",
+                           help="Write each adversary's results to a "
+                                "text file in this directory")
   post_parser.set_defaults(func=_postprocess)
 
+  export_parser = subp.add_parser("torps.export_results",
+                                  help="Write the text results files for "
+                                       "a torps.analyze --results file",
+                                  parents=parents)
+
+  export_parser.add_argument("datafile", metavar="RESULTFILE",
+                             help="The --results file to export")
+
+  export_parser.add_argument("--sample-start",
+                             help="Pretend the samples start at this number "
+                                  "(even if they start at 0)",
+                             type=int,
+                             default=0)
+
+  export_parser.add_argument("--tag",
+                             help="A short identification tag for this file",
+                             dest="filetag")
+
+  export_parser.add_argument("--output_dir", required=True)
+  export_parser.set_defaults(func=_export_results)
+
   analyze_parser = subp.add_parser("torps.find_adversaries",
                                    help="Find adversaries who pose "
                                         "threats to clients",
@@ -128,7 +295,8 @@ def __argparse__(subp, parents):
   analyze_parser.add_argument(
       "--paths",
       metavar="PATHFILE",
-      help="A datafile preprocesses AS paths. "
+      help="A datafile preprocesses AS paths, or a path table built "
+           "by torps.build_path_table. "
            "Any missing can be logged to a file.")
 
   analyze_parser.add_argument("--output-prefix",
@@ -143,4 +311,22 @@ def __argparse__(subp, parents):
   analyze_parser.add_argument("--log-missing",
                               help="Log missing paths to this file")
 
+  analyze_parser.add_argument("--indexed", action="store_true",
+                              help="Index the '@PATH' lines of each datafile "
+                                   "first, saving the index next to it, and "
+                                   "read paths as streams need them instead "
+                                   "of holding streams until their paths "
+                                   "turn up")
+
+  analyze_parser.add_argument("--checkpoint", metavar="CHECKPOINTFILE",
+                              help="Periodically save this run's state here, so "
+                                   "it can be continued with --resume")
+
+  analyze_parser.add_argument("--checkpoint-interval", type=int, default=300,
+                              metavar="SECONDS",
+                              help="How often to checkpoint (default: 300)")
+
+  analyze_parser.add_argument("--resume", action="store_true",
+                              help="Continue from the state saved in --checkpoint")
+
   analyze_parser.set_defaults(func=_analyze)
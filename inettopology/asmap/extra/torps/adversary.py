@@ -0,0 +1,321 @@
+import os
+import time
+import array
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# (result type, badguys key, PathTable attribute)
+ADVERSARY_TYPES = (
+    ('as_result', 'AS', 'path'),
+    ('ixp_result', 'IXP', 'ixps'),
+    ('metaixp_result', 'MetaIXP', 'metaixps'),
+)
+
+NO_TIME = np.iinfo(np.int64).max
+
+
+class AdversaryTable(object):
+  """ Per-sample results for every top-k adversary built from
+  one ordered list of adversary :members:.
+
+  A path is seen by the top-k adversary iff one of its members
+  is among the first k, i.e. iff the smallest rank of any of
+  its members is below k. Rather than testing each adversary,
+  every path is reduced to that rank once, and each stream is
+  recorded in the row for its rank. Cumulative sums (counters)
+  and minimums (first observation times) along the rank axis
+  then give the results for all k at once.
+  """
+
+  def __init__(self, members, ranks, samples):
+    self.members = members
+    self.ranks = ranks
+    width = len(members) + 1
+    self.hits = dict()
+    self.first = dict()
+    for side in ('guard', 'exit', 'comp', 'any'):
+      self.hits[side] = np.zeros((samples, width), dtype=np.int64)
+      self.first[side] = np.full((samples, width), NO_TIME, dtype=np.int64)
+    self.streams = np.zeros(samples, dtype=np.int64)
+
+  def add(self, samples, timestamps, guard_pids, exit_pids):
+    guard_rank = self.ranks[guard_pids]
+    exit_rank = self.ranks[exit_pids]
+    for side, rank in (('guard', guard_rank),
+                       ('exit', exit_rank),
+                       ('comp', np.maximum(guard_rank, exit_rank)),
+                       ('any', np.minimum(guard_rank, exit_rank))):
+      np.add.at(self.hits[side], (samples, rank), 1)
+      np.minimum.at(self.first[side], (samples, rank), timestamps)
+    np.add.at(self.streams, samples, 1)
+
+  @classmethod
+  def restore(cls, members, arrays, prefix):
+    """ Rebuild a table from the arrays saved by
+    AdversaryEngine.state under :prefix:. The result can
+    be read and merged into, but not added to.
+    """
+    table = cls.__new__(cls)
+    table.members = members
+    table.ranks = None
+    table.streams = arrays[prefix + 'streams']
+    table.hits = dict()
+    table.first = dict()
+    for side in ('guard', 'exit', 'comp', 'any'):
+      table.hits[side] = arrays[prefix + 'hits_' + side]
+      table.first[side] = arrays[prefix + 'first_' + side]
+    return table
+
+  def clear(self):
+    for side in self.hits:
+      self.hits[side].fill(0)
+      self.first[side].fill(NO_TIME)
+    self.streams.fill(0)
+
+  def merge(self, other):
+    """ Fold in the results of :other:, a table for the same
+    members built from a different set of streams.
+    """
+    for side in self.hits:
+      self.hits[side] += other.hits[side]
+      np.minimum(self.first[side], other.first[side], out=self.first[side])
+    self.streams += other.streams
+
+  def __len__(self):
+    return len(self.members)
+
+  def result(self, k):
+    """ Return a dict of per-sample arrays for the adversary
+    made up of the first :k: members: the guard, exit and
+    comp(romise) counts and first times, and the good count.
+    Times are NO_TIME if never seen.
+    """
+    result = dict()
+    for side in ('guard', 'exit', 'comp'):
+      result['{0}_ctr'.format(side)] = self.hits[side][:, :k].sum(axis=1)
+      result['{0}_time'.format(side)] = self.first[side][:, :k].min(axis=1)
+    result['good_ctr'] = self.streams - self.hits['any'][:, :k].sum(axis=1)
+    return result
+
+
+class AdversaryEngine(object):
+  """ Evaluate every client's top-k AS, IXP and MetaIXP
+  adversaries from :badguys: against streams, in batches.
+
+  Paths are identified by their ID in :paths:, a PathTable.
+  Streams are buffered by :observe: and evaluated
+  :batch_size: at a time.
+  """
+
+  def __init__(self, badguys, paths, samples, batch_size=65536):
+    self.samples = samples
+    self.batch_size = batch_size
+    self.clients = list(badguys)
+    self.paths = paths
+
+    self.stream_count = np.zeros(samples, dtype=np.int64)
+    self.fail_count = np.zeros(samples, dtype=np.int64)
+
+    self.tables = dict()
+    for client in self.clients:
+      self.tables[client] = dict()
+      for rtype, key, attr in ADVERSARY_TYPES:
+        if key not in badguys[client]:
+          continue
+        members = list()
+        for member in badguys[client][key]:
+          if member not in members:
+            members.append(member)
+        self.tables[client][rtype] = AdversaryTable(
+            members, self._ranks(members, paths, attr), samples)
+
+    self._samples = array.array('l')
+    self._timestamps = array.array('l')
+    self._exit_pids = array.array('l')
+    self._guard_pids = dict((client, array.array('l'))
+                            for client in self.clients)
+
+  @staticmethod
+  def _ranks(members, paths, attr):
+    """ The smallest rank among :members: of anything on each
+    path, or len(members) if nothing is.
+    """
+    member_rank = np.empty(len(paths.members), dtype=np.int64)
+    member_rank.fill(len(members))
+    for rank, member in enumerate(members):
+      member_id = paths.members.get(member)
+      if member_id is not None:
+        member_rank[member_id] = rank
+
+    offsets = np.frombuffer(paths.offsets[attr], dtype=np.uint32)
+    values = np.frombuffer(paths.values[attr], dtype=np.uint32)
+    owners = np.repeat(np.arange(len(paths)), np.diff(offsets))
+
+    ranks = np.empty(len(paths), dtype=np.int64)
+    ranks.fill(len(members))
+    np.minimum.at(ranks, owners, member_rank[values])
+    return ranks
+
+  def counters(self):
+    """ Return everything this engine has counted, in a form
+    which can be sent to another process and passed to
+    :merge:. That's just the arrays from :state:, so its
+    size doesn't depend on the number of paths.
+    """
+    return self.state()
+
+  def clear(self):
+    """ Discard everything counted so far """
+    del self._samples[:]
+    del self._timestamps[:]
+    del self._exit_pids[:]
+    for client in self.clients:
+      del self._guard_pids[client][:]
+      for table in self.tables[client].itervalues():
+        table.clear()
+    self.stream_count.fill(0)
+    self.fail_count.fill(0)
+
+  def merge(self, counters):
+    """ Add the :counters: of another engine, built from the
+    same badguys and paths, to this one's.
+    """
+    self.stream_count += counters['stream_count']
+    self.fail_count += counters['fail_count']
+    for client in self.clients:
+      for rtype, table in self.tables[client].iteritems():
+        prefix = "{0}:{1}:".format(client, rtype)
+        table.merge(AdversaryTable.restore(table.members, counters, prefix))
+
+  def state(self):
+    """ Return every array this engine has counted into, keyed
+    '<client>:<result type>:<array>' for the adversary tables,
+    along with the client and member lists needed to read
+    them back.
+    """
+    self.flush()
+    arrays = {'stream_count': self.stream_count,
+              'fail_count': self.fail_count,
+              'clients': np.array(self.clients)}
+    for client in self.clients:
+      for rtype, table in self.tables[client].iteritems():
+        prefix = "{0}:{1}:".format(client, rtype)
+        arrays[prefix + 'members'] = np.array(table.members)
+        arrays[prefix + 'streams'] = table.streams
+        for side in table.hits:
+          arrays[prefix + 'hits_' + side] = table.hits[side]
+          arrays[prefix + 'first_' + side] = table.first[side]
+    return arrays
+
+  def load_state(self, arrays):
+    """ Replace everything counted so far with :arrays:, as
+    returned by :state:, from an engine for the same badguys
+    and paths.
+    """
+    self.clear()
+    self.stream_count[:] = arrays['stream_count']
+    self.fail_count[:] = arrays['fail_count']
+    for client in self.clients:
+      for rtype, table in self.tables[client].iteritems():
+        prefix = "{0}:{1}:".format(client, rtype)
+        table.streams[:] = arrays[prefix + 'streams']
+        for side in table.hits:
+          table.hits[side][:] = arrays[prefix + 'hits_' + side]
+          table.first[side][:] = arrays[prefix + 'first_' + side]
+
+  def path_id(self, key):
+    """ The ID of the path '<src>::<dst>', or -1 if it's unknown """
+    return self.paths.lookup_key(key)
+
+  def observe(self, sample, timestamp, exit_pid, guard_pids):
+    """ Record a stream. :guard_pids: maps each client to the
+    ID of its path to the guard.
+    """
+    self._samples.append(sample)
+    self._timestamps.append(timestamp)
+    self._exit_pids.append(exit_pid)
+    for client in self.clients:
+      self._guard_pids[client].append(guard_pids[client])
+
+    if len(self._samples) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self._samples:
+      return
+
+    samples = np.array(self._samples, dtype=np.int64)
+    timestamps = np.array(self._timestamps, dtype=np.int64)
+    exit_pids = np.array(self._exit_pids, dtype=np.int64)
+    np.add.at(self.stream_count, samples, 1)
+
+    for client in self.clients:
+      guard_pids = np.array(self._guard_pids[client], dtype=np.int64)
+      complete = (guard_pids >= 0) & (exit_pids >= 0)
+      np.add.at(self.fail_count, samples[~complete], 1)
+
+      for table in self.tables[client].itervalues():
+        table.add(samples[complete], timestamps[complete],
+                  guard_pids[complete], exit_pids[complete])
+
+      del self._guard_pids[client][:]
+
+    del self._samples[:]
+    del self._timestamps[:]
+    del self._exit_pids[:]
+
+
+class ResultSink(object):
+  """ Checkpoint the results counted by :engine: to a single
+  .npz file, :filename:, holding every adversary table.
+
+  :maybe_checkpoint: writes one at most every :interval:
+  seconds. Checkpoints are written to a temporary file and
+  renamed into place, so :filename: always holds a complete
+  set of results.
+  """
+
+  def __init__(self, engine, filename, interval=300):
+    self.engine = engine
+    self.filename = filename
+    self.interval = interval
+    self.last = time.time()
+
+  def maybe_checkpoint(self):
+    if time.time() - self.last >= self.interval:
+      self.checkpoint()
+
+  def checkpoint(self):
+    tmpname = "{0}.tmp".format(self.filename)
+    with open(tmpname, 'wb') as fout:
+      np.savez(fout, **self.engine.state())
+    os.rename(tmpname, self.filename)
+    self.last = time.time()
+    log.info("Checkpointed results to {0}".format(self.filename))
+
+
+class SavedResults(object):
+  """ Results loaded from a ResultSink checkpoint, with the
+  same attributes as the AdversaryEngine which wrote them.
+  """
+
+  def __init__(self, filename):
+    with open(filename, 'rb') as fin:
+      arrays = dict(np.load(fin).items())
+
+    self.stream_count = arrays['stream_count']
+    self.fail_count = arrays['fail_count']
+    self.samples = len(self.stream_count)
+    self.clients = arrays['clients'].tolist()
+    self.tables = dict()
+    for client in self.clients:
+      self.tables[client] = dict()
+      for rtype, key, attr in ADVERSARY_TYPES:
+        prefix = "{0}:{1}:".format(client, rtype)
+        if prefix + 'members' in arrays:
+          members = arrays[prefix + 'members'].tolist()
+          self.tables[client][rtype] = AdversaryTable.restore(
+              members, arrays, prefix)
@@ -1,11 +1,20 @@
 import sys
-import itertools
+import array
 from datetime import datetime
 import time
 import argparse
 import logging
 import operator
 
+from inettopology.asmap.extra.torps.pathtable import PathTable, PathIndex
+import inettopology.asmap.extra.torps.checkpoint as checkpoint
+import inettopology.asmap.extra.torps.records as records
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
 EARLIEST_TS = None
 
 log = logging.getLogger(__name__)
@@ -51,47 +60,162 @@ def confirm(prompt=None, resp=False):
             return False
 
 
+class MemberCounter(object):
+  """ Stream counts and first observation times for the
+  members of a PathTable, indexed by member ID.
+  """
+
+  def __init__(self):
+    self.counts = np.zeros(0, dtype=np.int64)
+    self.first = np.zeros(0, dtype=np.float64)
+    self.seen = np.zeros(0, dtype=bool)
+
+  def _grow(self, size):
+    if size <= len(self.counts):
+      return
+    extra = size - len(self.counts)
+    self.counts = np.concatenate((self.counts,
+                                  np.zeros(extra, dtype=np.int64)))
+    self.first = np.concatenate((self.first,
+                                 np.full(extra, np.nan)))
+    self.seen = np.concatenate((self.seen, np.zeros(extra, dtype=bool)))
+
+  def add(self, ids, counts, times):
+    """ Count :counts: streams for each of :ids:, which are in
+    the order they were observed, at :times:.
+    """
+    if not len(ids):
+      return
+    self._grow(ids.max() + 1)
+    self.counts += np.bincount(ids, weights=counts,
+                               minlength=len(self.counts)).astype(np.int64)
+    ids, first = np.unique(ids, return_index=True)
+    new = ~self.seen[ids]
+    self.first[ids[new]] = times[first[new]]
+    self.seen[ids] = True
+
+  def __len__(self):
+    return int(self.seen.sum())
+
+  def __iter__(self):
+    """ Yield (id, count, first observation) """
+    for member in np.flatnonzero(self.seen):
+      yield member, self.counts[member], self.first[member]
+
+
+class PairMatrix(object):
+  """ A sparse matrix of stream counts and first observation
+  times for pairs of member IDs, stored as sorted arrays of
+  keys ((row << 32) | column) and their values.
+
+  Batches are kept aside and only merged in once they add up
+  to as many entries as the matrix holds, so each entry is
+  re-sorted a logarithmic number of times.
+  """
+
+  def __init__(self):
+    self.keys = np.zeros(0, dtype=np.int64)
+    self.counts = np.zeros(0, dtype=np.int64)
+    self.first = np.zeros(0, dtype=np.float64)
+    self._pending = []
+    self._pending_len = 0
+
+  def add(self, rows, cols, counts, times):
+    if not len(rows):
+      return
+    keys = (rows.astype(np.int64) << 32) | cols
+    self._pending.append((keys, counts, times))
+    self._pending_len += len(keys)
+    if self._pending_len >= len(self.keys):
+      self.compact()
+
+  def compact(self):
+    if not self._pending:
+      return
+    keys, counts, times = zip(*self._pending)
+    keys = np.concatenate((self.keys,) + keys)
+    counts = np.concatenate((self.counts,) + counts)
+    times = np.concatenate((self.first,) + times)
+
+    # The matrix comes first and batches are in order, so the
+    # first occurrence of a key holds its earliest observation
+    self.keys, first, inverse = np.unique(keys, return_index=True,
+                                          return_inverse=True)
+    self.counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    self.first = times[first]
+    self._pending = []
+    self._pending_len = 0
+
+  def __len__(self):
+    self.compact()
+    return len(self.keys)
+
+  def __iter__(self):
+    """ Yield ((row, column), count, first observation) """
+    self.compact()
+    for key, count, first in zip(self.keys.tolist(), self.counts,
+                                 self.first):
+      yield (key >> 32, key & 0xffffffff), count, first
+
+
 class Stats(object):
-  """Docstring for Stats """
+  """ Counts of the streams whose guard and exit paths share
+  ASes, IXPs or metaIXPs.
 
-  def __init__(self, pairs=False):
+  Everything is counted by member ID in :paths:, a PathTable.
+  Streams are buffered by :update: and counted :batch_size:
+  at a time, by intersecting the member lists of their paths
+  in bulk.
+  """
+
+  # (stat type, PathTable attribute)
+  MEMBER_STATS = (("as", "path"), ("ixp", "ixps"), ("meta_ixp", "metaixps"))
+  PAIR_STATS = (("as_pair", "path"), ("ixp_pair", "ixps"))
+
+  def __init__(self, paths, pairs=False, batch_size=65536):
+    self.paths = paths
     self.stream_ctr = 0
     self.streams_comp_as = 0
     self.streams_comp_ixp = 0
     self.streams_comp_both = 0
     self.pairs = pairs
+    self.batch_size = batch_size
 
     self.ctr = {
         "as_pair": {
-            "both": dict()
+            "both": PairMatrix()
         },
         "ixp_pair": {
-            "both": dict()
+            "both": PairMatrix()
         },
         "as": {
-            "exit": dict(),
-            "guard": dict(),
-            "both": dict()
+            "exit": MemberCounter(),
+            "guard": MemberCounter(),
+            "both": MemberCounter()
         },
         "ixp": {
-            "exit": dict(),
-            "guard": dict(),
-            "both": dict()
+            "exit": MemberCounter(),
+            "guard": MemberCounter(),
+            "both": MemberCounter()
         },
         "meta_ixp": {
-            "exit": dict(),
-            "guard": dict(),
-            "both": dict()
+            "exit": MemberCounter(),
+            "guard": MemberCounter(),
+            "both": MemberCounter()
         }
     }
 
+    self._guard_pids = array.array('l')
+    self._exit_pids = array.array('l')
+    self._counts = array.array('l')
+    self._times = array.array('d')
+
   def __str__(self):
-    return "{{ 'streams': %d, 'as_comp': %d, 'ixp_comp': %d, 'both_comp': %d, 'stats': %s }}" % (
+    return "{{ 'streams': %d, 'as_comp': %d, 'ixp_comp': %d, 'both_comp': %d }}" % (
            self.stream_ctr,
            self.streams_comp_as,
            self.streams_comp_ixp,
-           self.streams_comp_both,
-           self.ctr)
+           self.streams_comp_both)
 
   def __repr__(self):
     return str(self)
@@ -106,8 +230,15 @@ class Stats(object):
     for i in xrange(min(lim, len(sorted_dict) - 1)):
       stream.write("{0} {1} {2}\n".format(prepend, *sorted_dict[i]))
 
+  def _name(self, stattype, element):
+    members = self.paths.members
+    if stattype.endswith("_pair"):
+      return "%s, %s" % (members[element[0]], members[element[1]])
+    return members[element]
+
   def print_stats(self, prefix):
     global EARLIEST_TS
+    self.flush()
 
     with open("{0}.globals.dat".format(prefix), 'w') as fout:
       fout.write("n_streams streams_comp_as "
@@ -119,7 +250,6 @@ class Stats(object):
     for stattype, stats in self.ctr.iteritems():
       with open("{0}.{1}.dat".format(prefix, stattype), 'w') as fout:
         columns = [key for key in stats]
-        printed = set()
         if EARLIEST_TS is None:
           fout.write("id {0}\n".format(
                      " ".join(map(lambda x: "{0}".format(x), columns))))
@@ -129,91 +259,128 @@ class Stats(object):
                                   columns))
                      ))
 
+        values = dict()
+        for column in columns:
+          values[column] = dict((element, (count, first))
+                                for element, count, first in stats[column])
+
+        printed = set()
         for column in columns:
-          for stat_element in stats[column]:
+          for stat_element in values[column]:
             if stat_element not in printed:
               printed.add(stat_element)
 
               row = []
               for column in columns:
-                elem = stats[column].get(stat_element)
+                elem = values[column].get(stat_element)
                 if elem is not None:
                   if EARLIEST_TS is None:
-                    row.append("{0}".format(elem['count']))
+                    row.append("{0}".format(elem[0]))
                   else:
-                    row.append("{0} {1}".format(
-                        elem['count'],
-                        time.mktime(elem['first_obs'].timetuple())))
+                    row.append("{0} {1}".format(elem[0], elem[1]))
                 else:
                   if EARLIEST_TS is None:
                     row.append("0")
                   else:
                     row.append("0 -1")
               fout.write("{0} {1}\n".format(
-                         stat_element,
+                         self._name(stattype, stat_element),
                          " ".join(row)))
 
-  def observe(self, obstype, objid, position, stream):
-    count = int(stream.count)
-
-    if obstype not in self.ctr or objid is None:
-      raise Exception
-    if objid not in self.ctr[obstype][position]:
-      self.ctr[obstype][position][objid] = {'count': count,
-                                            'first_obs': stream.ts}
-    else:
-      self.ctr[obstype][position][objid]['count'] += count
-
-  def update(self, stream, meta_ixps):
+  def update(self, stream, meta_ixps=None):
     """Update stats based on the stream object passed to us
 
-    :stream: a Stream object
+    :stream: a Stream object, with both of its paths
     :returns: Nothing
 
     """
     self.stream_ctr += stream.count
-    gpath = stream.guard_path
-    epath = stream.exit_path
-    as_comp = False
-    ixp_comp = False
-
-    for AS in gpath.path & epath.path:
-      as_comp = True
-      self.streams_comp_as += stream.count
-      self.observe("as", AS, "both", stream)
-
-    #for g_as, e_as in itertools.izip_longest(gpath.path, epath.path):
-      #if g_as is not None:
-        #self.observe("as", g_as, "guard", stream)
-      #if e_as is not None:
-        #self.observe("as", e_as, "exit", stream)
-
-    for ixp in gpath.ixps & epath.ixps:
-      ixp_comp = True
-      self.streams_comp_ixp += stream.count
-      self.observe("ixp", ixp, "both", stream)
-
-    #for g_ixp, e_ixp in itertools.izip_longest(gpath.ixps, epath.ixps):
-      #if g_ixp is not None:
-        #self.observe("ixp", g_ixp, "guard", stream)
-      #if e_ixp is not None:
-        #self.observe("ixp", e_ixp, "exit", stream)
-
-    if as_comp and ixp_comp:
-      self.streams_comp_both += stream.count
-
-    for ixp in gpath.metaixps & epath.metaixps:
-      self.observe("meta_ixp", ixp, "both", stream)
-
-    #for g_ixp, e_ixp in itertools.izip_longest(gpath.metaixps, epath.metaixps):
-      #self.observe("meta_ixp", g_ixp, "guard", stream)
-      #self.observe("meta_ixp", e_ixp, "exit", stream)
+    self._guard_pids.append(stream.guard_path.pid)
+    self._exit_pids.append(stream.exit_path.pid)
+    self._counts.append(stream.count)
+    self._times.append(time.mktime(stream.ts.timetuple())
+                       if stream.ts is not None else float('nan'))
+
+    if len(self._counts) >= self.batch_size:
+      self.flush()
+
+  def _members(self, pids, attr):
+    """ Return the (stream, member ID) pairs for the members of
+    each of :pids:, the paths of a batch of streams, sorted and
+    without duplicates.
+    """
+    offsets = np.frombuffer(self.paths.offsets[attr], dtype=np.uint32)
+    values = self.paths.values[attr]
+    values = (np.frombuffer(values, dtype=np.uint32) if len(values)
+              else np.zeros(0, dtype=np.uint32))
+
+    starts = offsets[pids].astype(np.int64)
+    lengths = offsets[pids + 1] - starts
+    ends = np.cumsum(lengths)
+    index = (np.arange(ends[-1] if len(ends) else 0)
+             + np.repeat(starts - (ends - lengths), lengths))
+
+    keys = np.repeat(np.arange(len(pids), dtype=np.int64), lengths) << 32
+    keys = np.unique(keys | values[index])
+    return keys >> 32, keys & 0xffffffff
+
+  def flush(self):
+    if not self._counts:
+      return
+
+    guard_pids = np.array(self._guard_pids, dtype=np.int64)
+    exit_pids = np.array(self._exit_pids, dtype=np.int64)
+    counts = np.array(self._counts, dtype=np.int64)
+    times = np.array(self._times, dtype=np.float64)
+
+    members = dict()
+    compromised = dict()
+    for stattype, attr in self.MEMBER_STATS:
+      guard = members[attr, 'guard'] = self._members(guard_pids, attr)
+      exit = members[attr, 'exit'] = self._members(exit_pids, attr)
+
+      # (stream, member) pairs on both sides of a stream
+      common = np.intersect1d((guard[0] << 32) | guard[1],
+                              (exit[0] << 32) | exit[1],
+                              assume_unique=True)
+      streams = common >> 32
+      self.ctr[stattype]["both"].add(common & 0xffffffff,
+                                     counts[streams], times[streams])
+      compromised[stattype] = np.unique(streams)
+
+      # Counted once per shared member, not once per stream
+      if stattype == "as":
+        self.streams_comp_as += int(counts[streams].sum())
+      elif stattype == "ixp":
+        self.streams_comp_ixp += int(counts[streams].sum())
+
+    both = np.intersect1d(compromised["as"], compromised["ixp"],
+                          assume_unique=True)
+    self.streams_comp_both += int(counts[both].sum())
 
     if self.pairs:
-      for pair in itertools.product(gpath.path, epath.path):
-        self.observe("as_pair", "%s, %s" % (pair[0], pair[1]), "both", stream)
-      for pair in itertools.product(gpath.ixps, epath.ixps):
-        self.observe("ixp_pair", "%s, %s" %(pair[0], pair[1]), "both", stream)
+      for stattype, attr in self.PAIR_STATS:
+        g_streams, g_members = members[attr, 'guard']
+        e_streams, e_members = members[attr, 'exit']
+
+        # Pair every guard side member with each exit side
+        # member of the same stream
+        e_lengths = np.bincount(e_streams, minlength=len(counts))
+        e_starts = np.cumsum(e_lengths) - e_lengths
+        repeats = e_lengths[g_streams]
+        streams = np.repeat(g_streams, repeats)
+        ends = np.cumsum(repeats)
+        within = (np.arange(ends[-1] if len(ends) else 0)
+                  - np.repeat(ends - repeats, repeats))
+        self.ctr[stattype]["both"].add(
+            np.repeat(g_members, repeats),
+            e_members[e_starts[streams] + within],
+            counts[streams], times[streams])
+
+    del self._guard_pids[:]
+    del self._exit_pids[:]
+    del self._counts[:]
+    del self._times[:]
 
 
 class Stream(object):
@@ -244,24 +411,6 @@ class Stream(object):
       return True
     return False
 
-class Path(object):
-  def __init__(self, origin, dest, path, ixps, metaixps, rawdata):
-    self.base_data = rawdata
-    self.origin = origin
-    self.dest = dest
-    self.path = frozenset(path.split())
-    if ixps == "-":
-      self.ixps = frozenset([])
-    else:
-      ixpids = [ixp for ixp in ixps.split() ]
-      self.ixps = frozenset(ixpids)
-    if metaixps is None or metaixps == "-":
-      self.metaixps = frozenset([])
-    else:
-      ixpids = [ixp for ixp in metaixps.split() ]
-      self.metaixps = frozenset(ixpids)
-
-
 class WaitList(dict):
   def __init__(self, stats):
     self.stats =stats
@@ -309,13 +458,18 @@ class WaitList(dict):
       if stream.update(key, answer):
         # if it returns true, we can update stats from it
         self.stats.update(stream)
-      self.waiting_streams.remove(stream)
+      self.waiting_streams.discard(stream)
 
     del self[key]
 
-def process_datafile(fh, stats, args, paths):
+def process_datafile(fh, stats, args, paths, waiting=None, progress=None,
+                     names=None):
   """@todo: Docstring for process_datafile
 :stats: The stats object to record information in
+  :waiting: Streams still waiting for paths, if resuming
+  :progress: Called with the WaitList between lines
+  :names: IXP names read from :fh: so far, if it holds JSON
+          records (see records.text_lines)
   :returns: @todo
 
   """
@@ -324,10 +478,13 @@ def process_datafile(fh, stats, args, paths):
   IXP_STATS_FILE = "{0.output_prefix}.ixp_stats.dat".format(args)
   AS_PAIR_FILE = "{0.output_prefix}.as_pair_stats.dat".format(args)
   IXP_PAIR_FILE = "{0.output_prefix}.ixp_pair_stats.dat".format(args)
-  waiting = WaitList(stats)
+  if waiting is None:
+    waiting = WaitList(stats)
   meta_ixps = None
 
-  for i, line in enumerate(fh):
+  # readline() rather than iteration, so fh.tell() stays exact
+  lines = records.text_lines(iter(fh.readline, ''), names)
+  for i, line in enumerate(lines):
     if (stats.stream_ctr > 0
             and stats.stream_ctr % 1000 == 0) or len(paths) % 1000 == 0:
       log.info("Read %d paths, %d streams, %i lines"
@@ -337,30 +494,22 @@ def process_datafile(fh, stats, args, paths):
 
     if ltype == "@STREAM_CTR":
       done = False
-      guard_link = fields[1]
-      exit_link = fields[2]
-      count = fields[3]
-      if len(fields) > 4:
-        timestamp = datetime.fromtimestamp(float(fields[4]))
-        if not EARLIEST_TS or timestamp < EARLIEST_TS:
-          EARLIEST_TS = timestamp
+      stream = parse_stream(fields)
+      guard_link = stream.guard_link
+      exit_link = stream.exit_link
+      guard_pid = paths.lookup_key(guard_link)
+      if guard_pid >= 0:
+        stream.update(guard_link, paths.view(guard_pid))
       else:
-        timestamp = None
-
-      stream = Stream(guard_link, exit_link, count, timestamp)
-      try:
-        stream.update(guard_link, paths[guard_link])
-      except KeyError:
         # No path found yet
         waiting.add(guard_link, stream)
-        pass
 
-      try:
-        done = stream.update(exit_link, paths[exit_link])
-      except KeyError:
+      exit_pid = paths.lookup_key(exit_link)
+      if exit_pid >= 0:
+        done = stream.update(exit_link, paths.view(exit_pid))
+      else:
         # No path found yet
         waiting.add(exit_link, stream)
-        pass
 
       if done:
         stats.update(stream, meta_ixps)
@@ -368,13 +517,29 @@ def process_datafile(fh, stats, args, paths):
       break
 
     elif ltype == "@PATH":
-      origin, dest = fields[1].split("::")
-      paths[fields[1]] = Path(origin, dest,
-                              fields[2], fields[3],
-                              fields[4] if len(fields) > 4 else None,
-                              line.strip())
-      waiting.process(fields[1], paths[fields[1]])
+      key, pid = paths.add_line(line)
+      waiting.process(key, paths.view(pid))
+
+    if progress is not None:
+      progress(waiting)
 
+  write_output(stats, args, waiting)
+
+
+def parse_stream(fields):
+  """ Return a Stream for the fields of a '@STREAM_CTR' line """
+  global EARLIEST_TS
+  if len(fields) > 4:
+    timestamp = datetime.fromtimestamp(float(fields[4]))
+    if not EARLIEST_TS or timestamp < EARLIEST_TS:
+      EARLIEST_TS = timestamp
+  else:
+    timestamp = None
+  return Stream(fields[1], fields[2], fields[3], timestamp)
+
+
+def write_output(stats, args, missing):
+  """ Write :stats:, and the keys of any :missing: paths """
   if args.output_prefix:
     stats.print_stats(args.output_prefix)
 
@@ -383,7 +548,56 @@ def process_datafile(fh, stats, args, paths):
     #stats.printout(sys.stdout)
   if args.log_missing:
     with open(args.log_missing, 'w') as fout:
-      waiting.log_missing(fout)
+      for key in missing:
+        fout.write("{0}\n".format(key))
+
+
+def process_indexed(fh, stats, args, paths, index, missing=None,
+                    progress=None):
+  """ Like process_datafile, but read the path for each stream
+  from :index:, a PathIndex of :fh:, when it isn't in :paths:
+  already, rather than waiting for it to come up. Only the
+  '@STREAM_CTR' lines of :fh: are parsed.
+
+  A path which appears more than once in :fh: is read from
+  its first '@PATH' line.
+
+  :missing: Keys with no path in :fh:, if resuming
+  :progress: Called with :missing: between lines
+  """
+  if missing is None:
+    missing = set()
+
+  def resolve(key):
+    pid = paths.lookup_key(key)
+    if pid < 0:
+      pid = index.read_into(paths, key)
+    if pid < 0:
+      missing.add(key)
+      return None
+    return paths.view(pid)
+
+  for i, line in enumerate(iter(fh.readline, '')):
+    if line.startswith("@STREAM_CTR|"):
+      if stats.stream_ctr > 0 and stats.stream_ctr % 1000 == 0:
+        log.info("Read %d paths, %d streams, %i lines"
+                 % (len(paths), stats.stream_ctr, i))
+
+      stream = parse_stream(line.strip().split("|"))
+      guard_path = resolve(stream.guard_link)
+      exit_path = resolve(stream.exit_link)
+      if guard_path is not None and exit_path is not None:
+        stream.guard_path = guard_path
+        stream.exit_path = exit_path
+        stats.update(stream)
+    elif line.startswith("@PAIR_COUNTER"):
+      break
+
+    if progress is not None:
+      progress(missing)
+
+  index.close()
+  write_output(stats, args, missing)
 
 
 def main(args):
@@ -393,28 +607,68 @@ def main(args):
   :returns: @todo
 
   """
-  paths = dict()
-
-  stats = Stats(args.pairs)
-  if args.supplement_paths:
-    with open(args.supplement_paths) as fin:
-      for line in fin:
-        fields = line.strip().split("|")
-        if fields[0] != '@PATH':
-          log.debug("Skipping non-path line: {0}".format(line))
-        else:
-          origin, dest = fields[1].split("::")
-          paths[fields[1]] = Path(origin, dest, fields[2],
-                                  fields[3], fields[4], line.strip())
+  global EARLIEST_TS
+  if np is None:
+    log.error("'numpy' not found. Try 'pip install numpy'")
+    sys.exit(1)
+
+  ckpt = checkpoint.from_args(args)
+  state = ckpt.load() if args.resume else None
+
+  if state is not None:
+    stats = state['stats']
+    paths = state['paths']
+    EARLIEST_TS = state['earliest_ts']
+  else:
+    if args.paths:
+      paths = PathTable.load(args.paths)
+    else:
+      paths = PathTable()
+    stats = Stats(paths, args.pairs)
+
+  for file_index, datafile in enumerate(args.datafile):
+    # The WaitList, or with --indexed the set of missing keys
+    waiting = None
+    # IXP names defined so far, if the file holds JSON records
+    names = dict()
+    if state is not None:
+      if file_index < state['file_index']:
+        continue
+      if file_index == state['file_index']:
+        waiting = state['waiting']
+        names = state.get('names', names)
 
-  for datafile in args.datafile:
     f = None
     try:
       f = open(datafile)
     except IOError, e:
       log.error("Failed to open data file '{0}' [{1}]".format(datafile, e))
     else:
-      process_datafile(f, stats, args, paths)
+      if args.indexed and records.is_jsonl(datafile):
+        log.error("--indexed can't read '{0}', which holds JSON records. "
+                  "Convert it with torps.export_records, or leave out "
+                  "--indexed".format(datafile))
+        sys.exit(1)
+      if waiting is not None:
+        f.seek(state['offset'])
+
+      def progress(waiting):
+        if ckpt.due():
+          ckpt.save({'file_index': file_index,
+                     'offset': f.tell(),
+                     'stats': stats,
+                     'paths': paths,
+                     'waiting': waiting,
+                     'names': names,
+                     'earliest_ts': EARLIEST_TS})
+
+      if ckpt is None:
+        progress = None
+      if args.indexed:
+        process_indexed(f, stats, args, paths, PathIndex.for_file(datafile),
+                        waiting, progress)
+      else:
+        process_datafile(f, stats, args, paths, waiting, progress, names)
     finally:
       if f:
         f.close()
@@ -1,10 +1,13 @@
 #import socket
 import sys
+import collections
+import time
 import gevent
 import gevent.queue
 import gevent.event
 import gevent.socket
 import json
+import inettopology.asmap.infer.encoding as encoding
 
 class ASQueryError(Exception):
     pass
@@ -15,13 +18,78 @@ class ConnectionError(ASQueryError):
 class RequestError(ASQueryError):
     pass
 
+
+class AdaptiveLimit(object):
+  """ An additive-increase/multiplicative-decrease limit on
+  the number of queries in flight.
+
+  The limit grows by roughly one query per round trip while
+  latency stays within :tolerance: times the recent median,
+  and is cut by :backoff: when queries time out or fail. It
+  is cut at most once per median round trip, so a burst of
+  failures from one window only counts once.
+  """
+
+  def __init__(self, initial, minimum, maximum,
+               backoff=0.5, tolerance=2.0, window=500):
+    self.limit = float(initial)
+    self.minimum = minimum
+    self.maximum = maximum
+    self.backoff = backoff
+    self.tolerance = tolerance
+    self.in_flight = 0
+    self.latencies = collections.deque(maxlen=window)
+    self.failures = 0
+    self._last_decrease = 0
+    self._slot = gevent.event.Event()
+    self._slot.set()
+
+  def acquire(self, timeout=None):
+    """ Wait for a free slot. Returns False if none
+    became free within :timeout: seconds """
+    while self.in_flight >= int(self.limit):
+      self._slot.clear()
+      if not self._slot.wait(timeout):
+        return False
+    self.in_flight += 1
+    return True
+
+  def release(self):
+    self.in_flight -= 1
+    self._slot.set()
+
+  def success(self, latency):
+    median = self.percentile(50)
+    self.latencies.append(latency)
+    if median is None or latency <= median * self.tolerance:
+      self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+      self._slot.set()
+
+  def failure(self):
+    self.failures += 1
+    now = time.time()
+    if now - self._last_decrease < (self.percentile(50) or 1.0):
+      return
+    self._last_decrease = now
+    self.limit = max(self.minimum, self.limit * self.backoff)
+
+  def percentile(self, pct):
+    if len(self.latencies) == 0:
+      return None
+    ordered = sorted(self.latencies)
+    idx = min(len(ordered) - 1, int(len(ordered) * pct / 100.0))
+    return ordered[idx]
+
+
 class ASQuerier(object):
 
     _req = {
             'type':'request',
             'tag':None,
             'src':None,
-            'dst':None
+            'dst':None,
+            'deadline':None,
+            'encoding':'json'
            }
     _s = None
 
@@ -31,23 +99,52 @@ class ASQuerier(object):
                       .format(self.workqueue.qsize()))
       gevent.joinall(self.workers)
 
-    def __init__(self,  log=None, host="localhost", port=9323, max_outstanding = 20):
+    def __init__(self,  log=None, host="localhost", port=9323,
+                 max_outstanding=20, min_outstanding=1, timeout=180,
+                 wire_encoding='json'):
         """
         Initialize a query interface to make requests to the path
         inference server located at host:port.
+
+        The number of queries in flight adapts between
+        *min_outstanding* and *max_outstanding* based on how
+        quickly the server answers (see AdaptiveLimit).
+
+        Responses are sent as *wire_encoding*, either 'json'
+        or 'msgpack'. Either way, callbacks get paths as text.
         """
+        self._unpack = json.loads
+        if wire_encoding == 'msgpack':
+          try:
+            import msgpack
+          except ImportError:
+            raise ASQueryError("'msgpack' not found. "
+                               "Try 'pip install msgpack-python'")
+          self._unpack = msgpack.unpackb
+        elif wire_encoding != 'json':
+          raise ASQueryError("Unknown wire encoding '{0}'"
+                             .format(wire_encoding))
+        self.wire_encoding = wire_encoding
 
         self._addr = (host,port)
         self._s = None
         self._sync = None
         self.log = log
+        self.timeout = timeout
         self._shutdown = gevent.event.Event()
         self._shutdown.clear()
+        self.limit = AdaptiveLimit(max(min_outstanding, max_outstanding / 4),
+                                   min_outstanding, max_outstanding)
         self.workqueue = gevent.queue.Queue(maxsize = max_outstanding)
+        # Queries submitted whose callbacks haven't run yet
+        self._pending = 0
+        # Queries taken off the queue, waiting for a slot
+        self._waiting = 0
+        self._idle = gevent.event.Event()
+        self._idle.set()
         self.workers = []
         for i in xrange(max_outstanding):
-          self.workers.append(gevent.Greenlet(ASQuerier.__worker,self._addr,self.log,self.workqueue,self._shutdown))
-          #self.workers[i].link_value(callback)
+          self.workers.append(gevent.Greenlet(ASQuerier.__worker,self))
           self.workers[i].start()
 
         gevent.sleep(0.1)
@@ -58,70 +155,129 @@ class ASQuerier(object):
     def max(self):
       return self.workqueue.maxsize
 
+    def drain(self):
+      """ Wait until every query submitted so far has been
+      answered and its callback has run """
+      self._idle.wait()
+
+    def stats(self):
+      """ Return the current concurrency limit, the number
+      of queries in flight and queued, and latency percentiles
+      over the recent window """
+      return {'concurrency': int(self.limit.limit),
+              'in_flight': self.limit.in_flight,
+              'queued': self.workqueue.qsize() + self._waiting,
+              'failures': self.limit.failures,
+              'p50': self.limit.percentile(50),
+              'p90': self.limit.percentile(90),
+              'p99': self.limit.percentile(99)}
+
     @staticmethod
-    def __worker(addr,log,workqueue,shutdown_event):
-    #def __worker(s,tag,src,dst,addr_type):
+    def __worker(querier):
+      log = querier.log
       log.info("Worker {0} started".format(id(gevent.getcurrent())))
 
       while True:
         try:
-          callback,tag,src,dst,addr_type  = workqueue.get(timeout=10)
+          callback,tag,src,dst,addr_type  = querier.workqueue.get(timeout=10)
         except gevent.queue.Empty:
-          if shutdown_event.isSet():
+          if querier._shutdown.isSet():
             log.info("Worker {0} shutting down".format(id(gevent.getcurrent())))
             return
           continue
 
-        data= {"type":"error","msg":"Incomplete"}
-        log.info("Worker got request for path {0}->{1}".format(src,dst))
-        s = gevent.socket.create_connection(addr)
-
-        if addr_type != "defined":
-          src = (src,addr_type)
-          dst = (dst,addr_type)
+        # Only take a slot once there's a query to send, so idle
+        # workers don't count as in flight
+        querier._waiting += 1
+        try:
+          querier.limit.acquire()
+        finally:
+          querier._waiting -= 1
 
         try:
-          req = ASQuerier._req
-          req.update(tag=tag,src=src,dst=dst)
+          try:
+            data = ASQuerier.__query(querier, tag, src, dst, addr_type)
+          finally:
+            querier.limit.release()
+          callback(data)
+        finally:
+          querier._pending -= 1
+          if querier._pending == 0:
+            querier._idle.set()
 
-          s.sendall(json.dumps(req))
+    @staticmethod
+    def __query(querier, tag, src, dst, addr_type):
+      """ Perform a single query and feed its outcome
+      into the concurrency limit """
+      log = querier.log
+      data= {"type":"error","msg":"Incomplete"}
+      log.info("Worker got request for path {0}->{1}".format(src,dst))
 
-          gevent.socket.wait_read(s.fileno(),timeout=180)
+      if addr_type != "defined":
+        src = (src,addr_type)
+        dst = (dst,addr_type)
 
-          resp = s.recv(2048)
-          try:
+      started = time.time()
+      s = None
+      try:
+        s = gevent.socket.create_connection(querier._addr)
+        # Ask the server to give up a little before we do, so we
+        # hear that it did rather than timing out ourselves.
+        req = dict(ASQuerier._req, tag=tag, src=src, dst=dst,
+                   deadline=max(querier.timeout - 1, 1),
+                   encoding=querier.wire_encoding)
+
+        s.sendall(json.dumps(req))
+
+        # The server closes the connection once it's answered
+        chunks = []
+        while True:
+          gevent.socket.wait_read(s.fileno(),timeout=querier.timeout)
+          chunk = s.recv(65536)
+          if not chunk:
+            break
+          chunks.append(chunk)
+        resp = "".join(chunks)
+
+        try:
+          # Errors found before the server knew what we wanted
+          # are always JSON
+          if resp.startswith("{"):
             data = json.loads(resp)
-          except ValueError:
-            data = {'type':'error',
-                    'msg':"Failed to read response '{0}'".
-                                  format(resp)
-                   }
-
-          if data['type'] != "error" and 'path' not in data:
-            data = {'type':'error',
-                    'msg':"Response not understood '{0}'"
-                                  .format(resp)
-                   }
-
-        except Exception as e:
-          sys.stderr.write("Caught exception {0}.\n".format(e))
-          sys.stderr.write("Returning data {1}\n".format(data))
-        finally:
+          else:
+            data = querier._unpack(resp)
+        except Exception:
+          data = {'type':'error',
+                  'msg':"Failed to read response '{0}'".
+                                format(resp)
+                 }
+
+        if isinstance(data.get('path'), list):
+          data['path'] = " ".join(encoding.decode_asn(asn)
+                                  for asn in data['path'])
+
+        if data['type'] != "error" and 'path' not in data:
+          data = {'type':'error',
+                  'msg':"Response not understood '{0}'"
+                                .format(resp)
+                 }
+
+      except Exception as e:
+        sys.stderr.write("Caught exception {0}.\n".format(e))
+        sys.stderr.write("Returning data {0}\n".format(data))
+        querier.limit.failure()
+        return data
+      finally:
+        if s is not None:
           s.close()
-          callback(data)
-          #return data
 
-    @staticmethod
-    def watch_ready(q):
+      if data['type'] == 'error' and (data.get('busy')
+                                      or "didn't respond" in data['msg']):
+        querier.limit.failure()
+        return data
 
-      while True:
-        if q.ready_event.isSet() and q.outstanding > q.max:
-          q.ready_event.clear()
-        elif q.outstanding < max/4:
-          q.ready_event.set()
-        else:
-          pass
-        gevent.sleep(0.1)
+      querier.limit.success(time.time() - started)
+      return data
 
     def query_mixed(self,tag,src,dst,callback):
       """
@@ -133,18 +289,7 @@ class ASQuerier(object):
       (address, type), where type can be either 'AS'
       or 'IP'.
       """
-      self.workqueue.put((callback,tag,src,dst,"defined"))
-      return
-      #self.ready_event.wait()
-      self.outstanding +=1
-      s = gevent.socket.create_connection(self._addr)
-      gr = gevent.spawn(ASQuerier.__worker,s,tag,src,dst,addr_type="defined")
-      gr.link_value(lambda x: callback(x.value))
-      gr.link(self.mark_completed)
-      gevent.sleep(0)
-
-    def mark_completed(self, *args):
-      self.outstanding -= 1
+      self.__submit((callback,tag,src,dst,"defined"))
 
     def query_by_ip(self,tag,src,dst,callback):
       """ Request the query server for the
@@ -153,15 +298,7 @@ class ASQuerier(object):
 
       Returns the path.
       """
-      #self.ready_event.wait()
-      self.workqueue.put((callback,tag,src,dst,"IP"))
-      return
-      self.outstanding +=1
-      s = gevent.socket.create_connection(self._addr)
-      gr = gevent.spawn(ASQuerier.__worker,s,tag,src,dst,addr_type="IP")
-      gr.link_value(lambda x: callback(x.value))
-      gr.link(self.mark_completed)
-      gevent.sleep(0)
+      self.__submit((callback,tag,src,dst,"IP"))
 
     def query_by_as(self,tag,src,dst,callback):
       """
@@ -171,13 +308,10 @@ class ASQuerier(object):
 
       Returns the path.
       """
-      #self.ready_event.wait()
-      self.workqueue.put((callback,tag,src,dst,"AS"))
-      return
-      self.outstanding +=1
-      s = gevent.socket.create_connection(self._addr)
-      gr = gevent.spawn(ASQuerier.__worker,s,tag,src,dst,addr_type="AS")
-      gr.link_value(lambda x: callback(x.value))
-      gr.link(self.mark_completed)
-      gevent.sleep(0)
+      self.__submit((callback,tag,src,dst,"AS"))
+
+    def __submit(self, item):
+      self._pending += 1
+      self._idle.clear()
+      self.workqueue.put(item)
 
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import array
+import copy_reg
+import cPickle as pickle
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _rebuild_array(typecode, data):
+  arr = array.array(typecode)
+  arr.fromstring(data)
+  return arr
+
+
+def _reduce_array(arr):
+  return _rebuild_array, (arr.typecode, arr.tostring())
+
+# Arrays otherwise pickle as a list of Python ints
+copy_reg.pickle(array.array, _reduce_array)
+
+
+class Checkpointer(object):
+  """ Periodically snapshot the state of a long run to
+  :filename:, so that it can be resumed after a crash.
+
+  Snapshots are pickled to a temporary file and renamed
+  into place, so :filename: always holds the last complete
+  one. :due: says whether :interval: seconds have passed
+  since the last snapshot.
+  """
+
+  def __init__(self, filename, interval=300):
+    self.filename = filename
+    self.interval = interval
+    self.last = time.time()
+
+  def due(self):
+    return time.time() - self.last >= self.interval
+
+  def save(self, state):
+    tmpname = "{0}.tmp".format(self.filename)
+    with open(tmpname, 'wb') as fout:
+      pickle.dump(state, fout, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpname, self.filename)
+    self.last = time.time()
+    log.info("Saved checkpoint to {0}".format(self.filename))
+
+  def load(self):
+    with open(self.filename, 'rb') as fin:
+      state = pickle.load(fin)
+    log.info("Resuming from checkpoint {0}".format(self.filename))
+    return state
+
+
+def from_args(args):
+  """ Return a Checkpointer for --checkpoint, or None. Exits
+  if --resume is given without one.
+  """
+  if args.resume and not args.checkpoint:
+    log.error("--resume requires --checkpoint")
+    sys.exit(1)
+  if not args.checkpoint:
+    return None
+  return Checkpointer(args.checkpoint, args.checkpoint_interval)
@@ -1,31 +1,78 @@
+import os
+import array
+import struct
 import logging
 
 log = logging.getLogger(__name__)
 
-from inettopology.util.general import pairwise
+MAGIC = "TORPS-IXPINDEX 1\n"
+# ASNs, IXPs, pairs and pair members, then the two string blobs
+HEADER = struct.Struct("=6Q")
+INDEX_SUFFIX = ".ixpidx"
+
+# Distinct paths to remember annotations for
+MEMO_SIZE = 100000
 
 
 class IxpDataHandler(object):
+  """ Identify the IXPs and MetaIXPs along AS paths.
+
+  The IXP dataset is compiled into an index from pairs of
+  interned ASNs, packed into one integer, to a bitmask of the
+  IXPs they peer at. The compiled index is cached next to
+  :ixp_file: and reused while neither dataset has changed.
+  Annotations are remembered for up to MEMO_SIZE distinct
+  paths.
+  """
 
   def __init__(self, ixp_file, metaixp_file):
-    self.ixps = dict()
     self.metaixps = dict()
+    self.asns = dict()
+    self.ixp_names = list()
+    self.peerings = dict()
+    self._memo = dict()
 
-    self.load_ixp_data(ixp_file)
     self.load_metaixp_data(metaixp_file)
 
+    stamp = self._stamp(ixp_file, metaixp_file)
+    cachefile = ixp_file + INDEX_SUFFIX
+    if not self.load_index(cachefile, stamp):
+      self.load_ixp_data(ixp_file)
+      try:
+        self.save_index(cachefile, stamp)
+      except (IOError, OSError) as e:
+        log.warn("Couldn't save IXP index to {0} [{1}]".format(cachefile, e))
+
+    self.ixp_metaixps = [self.lookup_metaixp(ixp) for ixp in self.ixp_names]
+
+  @staticmethod
+  def _stamp(*filenames):
+    stats = [os.stat(filename) for filename in filenames]
+    return " ".join("{0}:{1}".format(stat.st_size, int(stat.st_mtime))
+                    for stat in stats)
+
+  def _asn(self, asn):
+    try:
+      return self.asns[asn]
+    except KeyError:
+      asn_id = self.asns[asn] = len(self.asns)
+      return asn_id
+
   def load_ixp_data(self, filename):
+    ixp_ids = dict()
     with open(filename) as fin:
 
       for line in fin:
         fields = line.split()
         if fields[3] == "bad":
           continue
-        peering = tuple(fields[1:3])
-        if peering in self.ixps:
-          self.ixps[peering].add(fields[0])
-        else:
-          self.ixps[peering] = set([fields[0]])
+        try:
+          ixp_id = ixp_ids[fields[0]]
+        except KeyError:
+          ixp_id = ixp_ids[fields[0]] = len(self.ixp_names)
+          self.ixp_names.append(fields[0])
+        peering = (self._asn(fields[1]) << 32) | self._asn(fields[2])
+        self.peerings[peering] = self.peerings.get(peering, 0) | (1 << ixp_id)
 
   def load_metaixp_data(self, filename):
     with open(filename) as fin:
@@ -33,6 +80,99 @@ class IxpDataHandler(object):
         fields = line.split()
         self.metaixps[fields[0]] = "%s_%s" % (fields[2], fields[1])
 
+  def save_index(self, filename, stamp):
+    asns = sorted(self.asns, key=self.asns.get)
+    asn_blob = "\n".join(asns)
+    ixp_blob = "\n".join(self.ixp_names)
+
+    keys = array.array('L')
+    offsets = array.array('I', [0])
+    members = array.array('I')
+    for peering, mask in self.peerings.iteritems():
+      keys.append(peering)
+      members.extend(self._bits(mask))
+      offsets.append(len(members))
+
+    tmpname = "{0}.tmp".format(filename)
+    with open(tmpname, 'wb') as fout:
+      fout.write(MAGIC)
+      fout.write("{0}\n".format(stamp))
+      fout.write(HEADER.pack(len(asns), len(self.ixp_names), len(keys),
+                             len(members), len(asn_blob), len(ixp_blob)))
+      fout.write(asn_blob)
+      fout.write(ixp_blob)
+      keys.tofile(fout)
+      offsets.tofile(fout)
+      members.tofile(fout)
+    os.rename(tmpname, filename)
+    log.info("Saved IXP index to {0}".format(filename))
+
+  def load_index(self, filename, stamp):
+    """ Load the index saved by :save_index: to :filename:.
+    Returns False if it's missing or was compiled from other
+    data than :stamp: describes.
+    """
+    try:
+      with open(filename, 'rb') as fin:
+        if fin.readline() != MAGIC or fin.readline() != stamp + "\n":
+          return False
+        data = fin.read()
+    except IOError:
+      return False
+
+    n_asns, n_ixps, n_keys, n_members, asn_len, ixp_len = (
+        HEADER.unpack_from(data))
+    pos = HEADER.size
+    asns = data[pos:pos + asn_len].split("\n") if n_asns else []
+    pos += asn_len
+    self.ixp_names = data[pos:pos + ixp_len].split("\n") if n_ixps else []
+    pos += ixp_len
+
+    def take_array(typecode, count):
+      arr = array.array(typecode)
+      arr.fromstring(data[pos:pos + count * arr.itemsize])
+      return arr, pos + count * arr.itemsize
+
+    keys, pos = take_array('L', n_keys)
+    offsets, pos = take_array('I', n_keys + 1)
+    members, pos = take_array('I', n_members)
+
+    self.asns = dict((asn, i) for i, asn in enumerate(asns))
+    for i, peering in enumerate(keys):
+      mask = 0
+      for ixp_id in members[offsets[i]:offsets[i + 1]]:
+        mask |= 1 << ixp_id
+      self.peerings[peering] = mask
+
+    log.info("Loaded IXP index for {0} peerings from {1}"
+             .format(len(self.peerings), filename))
+    return True
+
+  @staticmethod
+  def _bits(mask):
+    while mask:
+      low = mask & -mask
+      yield low.bit_length() - 1
+      mask ^= low
+
+  def _annotate(self, as_path):
+    asns = self.asns
+    peerings = self.peerings
+    mask = 0
+    prev = None
+    for asn in as_path.split():
+      asn_id = asns.get(asn)
+      if prev is not None and asn_id is not None:
+        mask |= peerings.get((prev << 32) | asn_id, 0)
+      prev = asn_id
+
+    path_ixps = set()
+    path_metaixps = set()
+    for ixp_id in self._bits(mask):
+      path_ixps.add(self.ixp_names[ixp_id])
+      path_metaixps.add(self.ixp_metaixps[ixp_id])
+    return (path_ixps, path_metaixps)
+
   def identify_ixps(self, as_path):
     """Identify the IXP and MetaIXPs that occur along a given AS path
 
@@ -42,15 +182,14 @@ class IxpDataHandler(object):
     if as_path is None:
       return ([], [])
 
-    path_ixps = set()
-
-    for pair in pairwise(as_path.split()):
-      if pair in self.ixps:
-        path_ixps |= self.ixps[pair]
-
-    path_metaixps = set([self.lookup_metaixp(ixp) for ixp in path_ixps])
-
-    return (path_ixps, path_metaixps)
+    memo = self._memo
+    try:
+      return memo[as_path]
+    except KeyError:
+      if len(memo) >= MEMO_SIZE:
+        memo.clear()
+      annotation = memo[as_path] = self._annotate(as_path)
+      return annotation
 
   def lookup_metaixp(self, ixp):
     try:
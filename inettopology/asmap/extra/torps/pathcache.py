@@ -0,0 +1,80 @@
+import sqlite3
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PathCache(object):
+  """ A persistent cache of inferred paths which can be
+  shared by several preprocessing runs.
+
+  Paths are keyed by (tag, src, dst) and stored along with
+  their IXP and metaIXP annotations, in the same form they
+  take on '@PATH' lines. The cache is an SQLite database in
+  WAL mode, so parallel runs can all read it while one of
+  them writes. Writes are batched and committed every
+  :commit_every: paths.
+  """
+
+  schema = """
+  CREATE TABLE IF NOT EXISTS paths (
+    tag TEXT NOT NULL,
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    path TEXT NOT NULL,
+    ixps TEXT NOT NULL,
+    metaixps TEXT NOT NULL,
+    PRIMARY KEY (tag, src, dst)
+  )
+  """
+
+  def __init__(self, filename, tag, commit_every=500):
+    self.tag = tag
+    self.commit_every = commit_every
+    self.hits = 0
+    self.misses = 0
+    self._pending = dict()
+
+    self._db = sqlite3.connect(filename, timeout=60)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute(PathCache.schema)
+    self._db.commit()
+
+  def get(self, src, dst):
+    """ Return the (path, ixps, metaixps) stored for the
+    path from :src: to :dst:, or None if it isn't cached.
+    """
+    try:
+      entry = self._pending[(src, dst)]
+    except KeyError:
+      entry = self._db.execute(
+          "SELECT path, ixps, metaixps FROM paths "
+          "WHERE tag = ? AND src = ? AND dst = ?",
+          (self.tag, src, dst)).fetchone()
+
+    if entry is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return entry
+
+  def put(self, src, dst, path, ixps, metaixps):
+    self._pending[(src, dst)] = (path, ixps, metaixps)
+    if len(self._pending) >= self.commit_every:
+      self.flush()
+
+  def flush(self):
+    if not self._pending:
+      return
+    self._db.executemany(
+        "INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?, ?)",
+        [(self.tag, src, dst) + entry
+         for (src, dst), entry in self._pending.iteritems()])
+    self._db.commit()
+    log.debug("Committed {0} paths to the path cache"
+              .format(len(self._pending)))
+    self._pending.clear()
+
+  def close(self):
+    self.flush()
+    self._db.close()
@@ -0,0 +1,333 @@
+import os
+import array
+import struct
+import logging
+
+from inettopology.asmap.extra.torps.streams import Interner
+import inettopology.asmap.extra.torps.records as records
+
+log = logging.getLogger(__name__)
+
+MAGIC = "TORPS-PATHTABLE 1\n"
+# endpoints, members, paths, then the length of each
+# attribute's member list, then the two string blobs
+HEADER = struct.Struct("=8Q")
+
+ATTRS = ('path', 'ixps', 'metaixps')
+
+INDEX_MAGIC = "TORPS-PATHINDEX 1"
+INDEX_SUFFIX = ".pathidx"
+
+
+def _split_members(field):
+  if field is None or field == "-":
+    return []
+  return field.split()
+
+
+class PathView(object):
+  """ The path with ID :pid: in a PathTable, with the same
+  attributes the old per-line Path objects had. Member sets
+  are built when asked for.
+  """
+
+  __slots__ = ('table', 'pid')
+
+  def __init__(self, table, pid):
+    self.table = table
+    self.pid = pid
+
+  @property
+  def origin(self):
+    return self.table.endpoints[self.table.srcs[self.pid]]
+
+  @property
+  def dest(self):
+    return self.table.endpoints[self.table.dsts[self.pid]]
+
+  @property
+  def path(self):
+    return frozenset(self.table.members_of(self.pid, 'path'))
+
+  @property
+  def ixps(self):
+    return frozenset(self.table.members_of(self.pid, 'ixps'))
+
+  @property
+  def metaixps(self):
+    return frozenset(self.table.members_of(self.pid, 'metaixps'))
+
+
+class PathTable(object):
+  """ A compact table of the paths on '@PATH' lines.
+
+  Endpoints, and the ASes, IXPs and metaIXPs on each path, are
+  interned to integer IDs. Each path's members are stored as
+  a slice of one flat array per attribute, given by an array
+  of offsets, and paths are found through an index on their
+  (src, dst) endpoint ID pair.
+
+  A table can be saved to a binary file, in native byte
+  order, and loaded again with a single read.
+  """
+
+  def __init__(self):
+    self.endpoints = Interner()
+    self.members = Interner()
+    self.srcs = array.array('I')
+    self.dsts = array.array('I')
+    self.offsets = dict((attr, array.array('I', [0])) for attr in ATTRS)
+    self.values = dict((attr, array.array('I')) for attr in ATTRS)
+    self._index = dict()
+
+  def __len__(self):
+    return len(self.srcs)
+
+  def add(self, src, dst, path, ixps, metaixps):
+    """ Add the path from :src: to :dst:, given as the fields
+    of an '@PATH' line, and return its ID. A path added again
+    replaces the earlier one.
+    """
+    pid = len(self.srcs)
+    src_id = self.endpoints.id(src)
+    dst_id = self.endpoints.id(dst)
+    self.srcs.append(src_id)
+    self.dsts.append(dst_id)
+    for attr, field in zip(ATTRS, (path, ixps, metaixps)):
+      values = self.values[attr]
+      values.extend(self.members.id(m) for m in _split_members(field))
+      self.offsets[attr].append(len(values))
+
+    self._index[(src_id << 32) | dst_id] = pid
+    return pid
+
+  def add_line(self, line):
+    """ Add the path on an '@PATH' line. Returns its key and
+    ID, or None if :line: isn't a path.
+    """
+    fields = line.strip().split("|")
+    if fields[0] != '@PATH':
+      return None
+    src, dst = fields[1].split("::")
+    pid = self.add(src, dst, fields[2], fields[3],
+                   fields[4] if len(fields) > 4 else None)
+    return fields[1], pid
+
+  def lookup(self, src, dst):
+    """ The ID of the path from :src: to :dst:, or -1 """
+    src_id = self.endpoints.get(src)
+    dst_id = self.endpoints.get(dst)
+    if src_id is None or dst_id is None:
+      return -1
+    return self._index.get((src_id << 32) | dst_id, -1)
+
+  def lookup_key(self, key):
+    """ The ID of the path '<src>::<dst>', or -1 """
+    src, dst = key.split("::")
+    return self.lookup(src, dst)
+
+  def member_ids(self, pid, attr):
+    offsets = self.offsets[attr]
+    return self.values[attr][offsets[pid]:offsets[pid + 1]]
+
+  def members_of(self, pid, attr):
+    return [self.members[m] for m in self.member_ids(pid, attr)]
+
+  def view(self, pid):
+    return PathView(self, pid)
+
+  def save(self, filename):
+    endpoint_blob = "\n".join(self.endpoints.values)
+    member_blob = "\n".join(self.members.values)
+    with open(filename, 'wb') as fout:
+      fout.write(MAGIC)
+      fout.write(HEADER.pack(len(self.endpoints), len(self.members),
+                             len(self),
+                             *([len(self.values[attr]) for attr in ATTRS] +
+                               [len(endpoint_blob), len(member_blob)])))
+      fout.write(endpoint_blob)
+      fout.write(member_blob)
+      self.srcs.tofile(fout)
+      self.dsts.tofile(fout)
+      for attr in ATTRS:
+        self.offsets[attr].tofile(fout)
+        self.values[attr].tofile(fout)
+
+  @classmethod
+  def load_binary(cls, filename):
+    with open(filename, 'rb') as fin:
+      data = fin.read()
+
+    pos = len(MAGIC)
+    header = HEADER.unpack_from(data, pos)
+    pos += HEADER.size
+    n_endpoints, n_members, n_paths = header[:3]
+    n_values = dict(zip(ATTRS, header[3:6]))
+    endpoint_len, member_len = header[6:]
+
+    def take_strings(length, count):
+      blob = data[pos:pos + length]
+      return blob.split("\n") if count else []
+
+    def take_array(count):
+      arr = array.array('I')
+      arr.fromstring(data[pos:pos + count * arr.itemsize])
+      return arr, pos + count * arr.itemsize
+
+    table = cls()
+    table.endpoints = Interner(take_strings(endpoint_len, n_endpoints))
+    pos += endpoint_len
+    table.members = Interner(take_strings(member_len, n_members))
+    pos += member_len
+    table.srcs, pos = take_array(n_paths)
+    table.dsts, pos = take_array(n_paths)
+    for attr in ATTRS:
+      table.offsets[attr], pos = take_array(n_paths + 1)
+      table.values[attr], pos = take_array(n_values[attr])
+
+    for pid in xrange(n_paths):
+      table._index[(table.srcs[pid] << 32) | table.dsts[pid]] = pid
+    return table
+
+  @classmethod
+  def load(cls, filename):
+    """ Load a table saved by :save:, or read the '@PATH'
+    records of a preprocessed paths file, in either format.
+    """
+    with open(filename, 'rb') as fin:
+      binary = fin.read(len(MAGIC)) == MAGIC
+
+    if binary:
+      table = cls.load_binary(filename)
+    else:
+      table = cls()
+      with open(filename) as fin:
+        for line in records.text_lines(fin):
+          if table.add_line(line) is None:
+            log.debug("Skipping non-path line: {0}".format(line))
+
+    log.info("Loaded {0} paths from {1}".format(len(table), filename))
+    return table
+
+
+class PathIndex(object):
+  """ The byte offset of the first '@PATH' line for each
+  '<src>::<dst>' key in a preprocessed paths file, so paths
+  can be read from it as they're needed.
+
+  Indexes are saved next to the file they index, and only
+  reused while that file's size and modification time are
+  unchanged.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.offsets = dict()
+    self._fin = None
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __contains__(self, key):
+    return key in self.offsets
+
+  def _stamp(self):
+    stat = os.stat(self.filename)
+    return "{0} {1} {2}".format(INDEX_MAGIC, stat.st_size,
+                                int(stat.st_mtime))
+
+  def build(self):
+    if records.is_jsonl(self.filename):
+      raise ValueError("Can't index {0}, which holds JSON records. "
+                       "Convert it with torps.export_records first"
+                       .format(self.filename))
+    offset = 0
+    with open(self.filename) as fin:
+      for line in iter(fin.readline, ''):
+        if line.startswith("@PATH|"):
+          key = line.split("|", 2)[1]
+          if key not in self.offsets:
+            self.offsets[key] = offset
+        elif line.startswith("@PAIR_COUNTER"):
+          break
+        offset += len(line)
+    log.info("Indexed {0} paths in {1}".format(len(self), self.filename))
+
+  def save(self, indexfile):
+    tmpname = "{0}.tmp".format(indexfile)
+    with open(tmpname, 'w') as fout:
+      fout.write("{0}\n".format(self._stamp()))
+      for key, offset in self.offsets.iteritems():
+        fout.write("{0} {1}\n".format(key, offset))
+    os.rename(tmpname, indexfile)
+
+  def load(self, indexfile):
+    """ Read the index saved in :indexfile:. Returns False,
+    leaving this index empty, if it's missing or stale.
+    """
+    try:
+      fin = open(indexfile)
+    except IOError:
+      return False
+    with fin:
+      if fin.readline().rstrip("\n") != self._stamp():
+        return False
+      for line in fin:
+        key, offset = line.split()
+        self.offsets[key] = int(offset)
+    return True
+
+  @classmethod
+  def for_file(cls, filename):
+    """ Return the index for :filename:, loading it if it was
+    saved already, and building and saving it otherwise.
+    """
+    index = cls(filename)
+    indexfile = filename + INDEX_SUFFIX
+    if index.load(indexfile):
+      log.info("Loaded {0} path offsets from {1}"
+               .format(len(index), indexfile))
+      return index
+
+    index.build()
+    try:
+      index.save(indexfile)
+    except (IOError, OSError) as e:
+      log.warn("Couldn't save path index to {0} [{1}]".format(indexfile, e))
+    return index
+
+  def read_into(self, table, key):
+    """ Read the path for :key: into :table:. Returns its ID,
+    or -1 if the file has no path for :key:.
+    """
+    offset = self.offsets.get(key)
+    if offset is None:
+      return -1
+    if self._fin is None:
+      self._fin = open(self.filename)
+    self._fin.seek(offset)
+    return table.add_line(self._fin.readline())[1]
+
+  def close(self):
+    if self._fin is not None:
+      self._fin.close()
+      self._fin = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_fin'] = None
+    return state
+
+
+def build(args):
+  table = PathTable()
+  for fname in args.datafile:
+    count = 0
+    with open(fname) as fin:
+      for line in records.text_lines(fin):
+        if table.add_line(line) is not None:
+          count += 1
+    if count == 0:
+      log.error("Found no paths in {0}".format(fname))
+    log.info("Read {0} paths after {1}".format(len(table), fname))
+  table.save(args.output)
@@ -0,0 +1,100 @@
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# How long the inferrer keeps the paths it computes to a
+# destination (the EXPIRE in c_extensions/inferrer/infer.cc)
+RESULT_TTL = 600
+
+
+class LookupPlanner(object):
+  """ Collect path lookups, and dispatch them grouped by
+  (tag, destination).
+
+  The inference server computes the paths from every source
+  to a destination at once, and expires them after
+  RESULT_TTL seconds. Lookups for a destination spread
+  through a large file can make it do that again and again,
+  where sending them together needs it done once.
+
+  Groups are dispatched largest first. Within a group, and
+  between groups of the same size, lookups keep the order
+  they were added in.
+  """
+
+  def __init__(self, ttl=RESULT_TTL):
+    self.ttl = ttl
+    self.groups = dict()
+    self.order = list()
+
+  def __len__(self):
+    return len(self.order)
+
+  def add(self, tag, dst, request):
+    """ Plan :request:, a lookup of the path to :dst: among the
+    paths tagged :tag:. """
+    key = (tag, dst)
+    try:
+      self.groups[key].append(request)
+    except KeyError:
+      self.groups[key] = [request]
+    self.order.append(key)
+
+  def plan(self):
+    """ Return the groups' keys in the order to dispatch them """
+    first = dict()
+    for i, key in enumerate(self.order):
+      first.setdefault(key, i)
+    return sorted(self.groups,
+                  key=lambda key: (-len(self.groups[key]), first[key]))
+
+  def dispatch(self, submit):
+    """ Call :submit: with every planned request, group by
+    group, then log how many inferences that saved. """
+    if not self.order:
+      return
+
+    keys = self.plan()
+    start = time.time()
+    for key in keys:
+      for request in self.groups[key]:
+        submit(request)
+    self.report(keys, time.time() - start)
+
+    self.groups.clear()
+    del self.order[:]
+
+  def _inferences(self, order, rate):
+    """ Count the inferences needed to answer lookups for the
+    destinations in :order:, made at :rate: per second """
+    inferred = dict()
+    count = 0
+    for i, key in enumerate(order):
+      now = i / rate
+      if key not in inferred or now - inferred[key] > self.ttl:
+        inferred[key] = now
+        count += 1
+    return count
+
+  def report(self, keys, elapsed):
+    """ Log the inferences lookups in file order would have
+    needed, against those needed in planned order, given the
+    rate the planned lookups were made at. """
+    planned = list()
+    for key in keys:
+      planned.extend([key] * len(self.groups[key]))
+
+    if elapsed > 0:
+      rate = len(planned) / elapsed
+      unplanned = self._inferences(self.order, rate)
+      needed = self._inferences(planned, rate)
+    else:
+      unplanned = needed = len(keys)
+
+    log.info("Dispatched {0} lookups to {1} destinations at {2:.1f}/s. "
+             "Estimated inferences: {3} in file order, {4} planned; "
+             "{5} saved"
+             .format(len(planned), len(keys),
+                     len(planned) / elapsed if elapsed > 0 else 0,
+                     unplanned, needed, unplanned - needed))
@@ -7,6 +7,12 @@ import sys
 import random
 import logging
 import inettopology.asmap.extra.torps.ixps as ixps
+import inettopology.asmap.extra.torps.trace as trace
+import inettopology.asmap.extra.torps.checkpoint as checkpoint
+import inettopology.asmap.extra.torps.records as records
+from inettopology.asmap.extra.torps.streams import (Interner, PairCounter,
+                                                   StreamCounter)
+from inettopology.asmap.extra.torps.planner import LookupPlanner
 
 log = logging.getLogger(__name__)
 
@@ -31,33 +37,68 @@ PROC_FINISHED = 0
 """
 
 ixp_data = None
+path_cache = None
 
 
-def mk_callback(ptype, endpoints, timestamp, sample):
+def print_path(outputs, endpoints, path, ixpline, metaixpline):
+  for out in outputs:
+    out.path(endpoints, path, ixpline, metaixpline)
+
+
+def print_cached_path(endpoints, outputs):
+  """ Print the path between :endpoints: to :outputs: if
+  it's in the path cache. Returns True if it was.
+  """
+  if path_cache is None:
+    return False
+
+  entry = path_cache.get(*endpoints)
+  if entry is None:
+    return False
+
+  print_path(outputs, endpoints, *entry)
+  return True
+
+
+def mk_callback(ptype, endpoints, timestamp, sample, outputs):
   def callback(data):
     global PROC_FINISHED
     global ixp_data
 
     if data['type'] == "error":
-      print("@ERROR|{0}:{1}|{2}".format(timestamp, sample, data['msg']))
+      for out in outputs:
+        out.error("{0}:{1}".format(timestamp, sample), data['msg'])
       return
 
     path_ixps, path_mixps = ixp_data.identify_ixps(data['path'])
     ixpline = " ".join(path_ixps) if len(path_ixps) > 0 else "-"
     metaixpline = " ".join(path_mixps) if len(path_mixps) > 0 else "-"
 
-    print("@PATH|{0}::{1}|{2}|{3}|{4}".format(
-          endpoints[0],
-          endpoints[1],
-          data['path'],
-          ixpline,
-          metaixpline))
+    print_path(outputs, endpoints, data['path'], ixpline, metaixpline)
+    if path_cache is not None and data['path'] is not None:
+      path_cache.put(endpoints[0], endpoints[1],
+                     data['path'], ixpline, metaixpline)
 
     PROC_FINISHED += 1
 
   return callback
 
 
+def open_path_cache(args):
+  global path_cache
+  if args.path_cache:
+    from inettopology.asmap.extra.torps.pathcache import PathCache
+    path_cache = PathCache(args.path_cache, args.tag)
+    log.info("Using path cache {0}".format(args.path_cache))
+
+
+def close_path_cache():
+  if path_cache is not None:
+    log.info("Path cache: {0} hits, {1} misses"
+             .format(path_cache.hits, path_cache.misses))
+    path_cache.close()
+
+
 def lookup_missing(args):
   import inettopology.asmap.extra.torps.aspath as aspath
   global ixp_data
@@ -68,9 +109,27 @@ def lookup_missing(args):
     log.error("Failed to load IXP data [{0}]".format(e))
     sys.exit(1)
 
+  open_path_cache(args)
+
   # Instantiate the query engine
   log.info("Starting querier")
   searcher = aspath.ASQuerier(log=log, max_outstanding=20)
+  out = records.open_writer(sys.stdout, args.output_format)
+
+  def lookup(e1, e2):
+    if e1.find(".") != -1:
+      # This is an ip-ip path
+      searcher.query_by_ip(args.tag, e1, e2,
+                           mk_callback("Exit-Destination",
+                                       (e1, e2),
+                                       "N/A", "N/A", [out]))
+    else:
+      searcher.query_mixed(args.tag, (e1, 'AS'), (e2, 'IP'),
+                           mk_callback("Client-Guard",
+                                       (e1, e2),
+                                       "N/A", "N/A", [out]))
+
+  planner = LookupPlanner() if args.plan_lookups else None
 
   try:
     for fname in args.datafile:
@@ -81,26 +140,116 @@ def lookup_missing(args):
           except Exception as e:
             log.error("Error on line {0}: {1}".format(i, e))
             continue
-          if e1.find(".") != -1:
-            # This is an ip-ip path
-            searcher.query_by_ip(args.tag, e1, e2,
-                                 mk_callback("Exit-Destination",
-                                             (e1, e2),
-                                             "N/A", "N/A"))
+          if print_cached_path((e1, e2), [out]):
+            continue
+          if planner is not None:
+            planner.add(args.tag, e2, (e1, e2))
           else:
-            searcher.query_mixed(args.tag, (e1, 'AS'), (e2, 'IP'),
-                                 mk_callback("Client-Guard",
-                                             (e1, e2),
-                                             "N/A", "N/A"))
+            lookup(e1, e2)
+
+    if planner is not None:
+      planner.dispatch(lambda request: lookup(*request))
 
   except KeyboardInterrupt:
     log.warn("Shutting down")
     searcher.shutdown()
     pass
   searcher.shutdown()
+  close_path_cache()
+  out.close()
+
+
+class ClientGroup(object):
+  """ A population of clients whose streams are tracked
+  and written out together.
+
+  Each sample in a trace is assigned a client AS, which is
+  either :fixed_as: or picked at random from :possible_ases:
+  the first time the sample is seen.
+  """
+
+  def __init__(self, name, out, endpoints,
+               fixed_as=None, possible_ases=None):
+    self.name = name
+    self.out = out
+    self.fixed_as = fixed_as
+    self.possible_ases = possible_ases
+    self.sample_as_map = dict()
+    self.streams = StreamCounter()
+    self.lookups = PairCounter(endpoints)
+
+  def client_as(self, sample):
+    if self.fixed_as is not None:
+      return self.fixed_as
+
+    try:
+      return self.sample_as_map[sample]
+    except KeyError:
+      client_as = random.choice(self.possible_ases)
+      self.sample_as_map[sample] = client_as
+      self.out.client_mapping(sample, client_as)
+      return client_as
+
+
+def load_client_groups(args, endpoints, offsets=None):
+  """ Build a ClientGroup for every --client_as or
+  --client_as_file given. With more than one group, each
+  writes to its own file under --output-prefix.
+
+  If :offsets: are given, each group's existing output is
+  truncated to its offset and appended to, rather than
+  started over.
+  """
+  groups = list()
+  if args.client_as_file:
+    for fname in args.client_as_file:
+      try:
+        with open(fname) as fin:
+          possible_ases = [line.strip() for line in fin if line.strip()]
+      except IOError as e:
+        log.error("Failed to open client AS file [{0}]".format(e))
+        sys.exit(1)
+      name = os.path.splitext(os.path.basename(fname))[0]
+      groups.append((name, {'possible_ases': possible_ases}))
+  else:
+    for client_as in args.client_as:
+      groups.append((client_as, {'fixed_as': client_as}))
+
+  if len(groups) > 1 and not args.output_prefix:
+    log.error("Preprocessing for more than one client requires "
+              "--output-prefix")
+    sys.exit(1)
+
+  client_groups = list()
+  for i, (name, kwargs) in enumerate(groups):
+    if args.output_prefix:
+      fname = "{0}.{1}.aspaths.out".format(args.output_prefix, name)
+      if offsets is None:
+        out = open(fname, 'w')
+      else:
+        out = open(fname, 'r+')
+        out.truncate(offsets[i])
+        out.seek(offsets[i])
+    else:
+      out = sys.stdout
+    out = records.open_writer(out, args.output_format)
+    client_groups.append(ClientGroup(name, out, endpoints, **kwargs))
+  return client_groups
 
 
 def preprocess(args):
+  """ Identify the AS path for both ends of every stream in
+  the trace files, for every client group at once.
+
+  Each trace file is read once. Exit-destination lookups are
+  shared between all of the client groups and their paths are
+  written to every group's output. Client-guard lookups and
+  stream counts are kept per group.
+
+  Endpoints, pairs and streams are tracked with the compact
+  counters in torps.streams, so memory grows with the number
+  of distinct streams rather than the length of the trace.
+  """
   import inettopology.asmap.extra.torps.aspath as aspath
   global PROC_STARTED
   global PROC_FINISHED
@@ -112,490 +261,460 @@ def preprocess(args):
     log.error("Failed to load IXP data [{0}]".format(e))
     sys.exit(1)
 
-  # Load the client ASes that we're going to use
-  if args.client_as_file:
-    possible_client_ases = list()
-    sample_as_map = dict()
-    try:
-      fin = open(args.client_as_file)
-    except IOError as e:
-      log.error("Failed to open client AS file [{0}]".format(e))
-      sys.exit(1)
-
-    for line in fin:
-      possible_client_ases.append(line.strip())
+  ckpt = checkpoint.from_args(args)
+  if ckpt is not None and not args.output_prefix:
+    log.error("--checkpoint requires --output-prefix")
+    sys.exit(1)
 
-    fin.close()
+  state = ckpt.load() if args.resume else None
+  if state is None:
+    endpoints = Interner()
+    groups = load_client_groups(args, endpoints)
+    # Don't repeat lookups
+    exit_lookups = PairCounter(endpoints)
+    preloaded = set()
+    planner = LookupPlanner()
+  else:
+    endpoints = state['endpoints']
+    groups = load_client_groups(args, endpoints, state['offsets'])
+    for group, (sample_as_map, streams, lookups) in zip(groups,
+                                                        state['groups']):
+      group.sample_as_map = sample_as_map
+      group.streams = streams
+      group.lookups = lookups
+    exit_lookups = state['exit_lookups']
+    preloaded = state['preloaded']
+    planner = state.get('planner') or LookupPlanner()
+    PROC_STARTED = state['proc_started']
+  all_outputs = [group.out for group in groups]
+  if state is not None:
+    for out, writer_state in zip(all_outputs, state['writers']):
+      out.restore(writer_state)
+
+  open_path_cache(args)
 
   # Instantiate the query engine
   log.info("Starting querier")
   searcher = aspath.ASQuerier(log=log, max_outstanding=20)
 
-  # Don't repeat lookups
-  completed_lookups = dict()
+  def lookup_exit(exit, destination, timestamp, sample):
+    exit_pair = (exit, destination)
+    searcher.query_by_ip(args.tag, exit, destination,
+                         mk_callback("Exit-Destination", exit_pair,
+                                     timestamp, sample, all_outputs))
+    log.debug("Querying for path {0}".format(exit_pair))
+
+  def lookup_guard(group_index, client_as, guard, timestamp, sample):
+    guard_pair = (client_as, guard)
+    searcher.query_mixed(args.tag, (client_as, 'AS'), (guard, 'IP'),
+                         mk_callback("Client-Guard", guard_pair,
+                                     timestamp, sample,
+                                     [groups[group_index].out]))
+    log.debug("Querying for path {0}".format(guard_pair))
+
+  def lookup(request):
+    if request[0] == 'exit':
+      lookup_exit(*request[1:])
+    else:
+      lookup_guard(*request[1:])
+
   skipped = 0
 
-  if args.load_paths:
+  def save_checkpoint(file_index, position, read, skipped):
+    """ Snapshot once every outstanding lookup has been
+    written out, so outputs and counters agree """
+    searcher.drain()
+    if path_cache is not None:
+      path_cache.flush()
+    for out in all_outputs:
+      out.flush()
+    ckpt.save({'file_index': file_index,
+               'position': position,
+               'read': read,
+               'skipped': skipped,
+               'proc_started': PROC_STARTED,
+               'endpoints': endpoints,
+               'exit_lookups': exit_lookups,
+               'preloaded': preloaded,
+               'planner': planner,
+               'groups': [(group.sample_as_map, group.streams, group.lookups)
+                          for group in groups],
+               'offsets': [out.tell() for out in all_outputs],
+               'writers': [out.state() for out in all_outputs]})
+
+  if args.load_paths and state is None:
     with open(args.load_paths) as fin:
-      for line in fin:
-        print(line.strip())
+      for line in records.text_lines(fin):
+        for out in all_outputs:
+          out.text(line)
         fields = line.strip().split("|")
         if fields[0] == "@PATH":
           src, dest = fields[1].split("::")
-          completed_lookups[(src, dest)] = 1
+          preloaded.add((src, dest))
 
-    log.info("Loaded {0} existing paths".format(len(completed_lookups)))
-  #track streams
-  unique_streams = dict()
-  fctr = 0
+    log.info("Loaded {0} existing paths".format(len(preloaded)))
 
   try:
     # Do this for every file in sequence so our cache sticsk around
-    for fname in args.datafile:
+    for fctr, fname in enumerate(args.datafile, 1):
+      if state is not None and fctr - 1 < state['file_index']:
+        continue
+
       try:
-        fin = open(fname)
+        data = trace.open_trace(fname)
       except IOError as e:
         log.error("Failed to open file [{0}]".format(e))
         sys.exit(1)
 
       read = 1
-      fctr += 1
       skipped = 0
+      position = 0
+      if state is not None and fctr - 1 == state['file_index']:
+        read = state['read']
+        skipped = state['skipped']
+        position = state['position']
+
+      for sample, timestamp, guard, middle, exit, destination in data.rows(position):
+        if ckpt is not None and ckpt.due():
+          save_checkpoint(fctr - 1, position, read, skipped)
+        position = data.position
 
-      next(fin)
-      for line in fin:
-        sample, timestamp, guard, middle, exit, destination = line.split()[:6]
+        PROC_STARTED += 2
 
-        if destination != "0":
         # We really only care if there are things on both ends.
         # Otherwise it's irrelevant
-          if args.client_as_file:
-            try:
-              client_as = sample_as_map[sample]
-            except KeyError:
-              client_as = random.choice(possible_client_ases)
-              sample_as_map[sample] = client_as
-              print("@CLIENT_MAPPING|{0}|{1}".format(sample, client_as))
-          else:
-            client_as = args.client_as
-
-          # Count how many lines we've read
-          read += 1
-
-          log.debug("Have {0} outstanding path lookups".format(len(searcher)))
-
-          if (read % 1000 == 0):
-            log.info("File {4}/{5} :: Read/PreviouslySeen/UniqueStreams/Paths: {0}/{1}/{2}/{3}"
-                     .format(read, skipped, len(unique_streams), len(completed_lookups), fctr, len(args.datafile)))
-
-          if (client_as, guard, exit, destination) not in unique_streams:
+        if destination == "0":
+          continue
 
-            if (client_as, guard) not in completed_lookups:
-              searcher.query_mixed(args.tag, (client_as, 'AS'), (guard, 'IP'),
-                                   mk_callback("Client-Guard", (client_as, guard), timestamp, sample))
-              log.debug("Querying for path {0}".format((client_as, guard)))
-              completed_lookups[(client_as, guard)] = 1
+        # Count how many lines we've read
+        read += 1
+
+        log.debug("Have {0} outstanding path lookups".format(len(searcher)))
+
+        if (read % 1000 == 0):
+          log.info("File {4}/{5} :: Read/PreviouslySeen/UniqueStreams/Paths: {0}/{1}/{2}/{3}"
+                   .format(read, skipped,
+                           sum(len(group.streams) for group in groups),
+                           len(exit_lookups) + sum(len(group.lookups) for group in groups),
+                           fctr, len(args.datafile)))
+          log.info("Querier :: concurrency {concurrency}, in flight {in_flight}, "
+                   "p50 {p50}s, p99 {p99}s, failures {failures}"
+                   .format(**searcher.stats()))
+
+        exit_pair = (exit, destination)
+        exit_slot, new_pair = exit_lookups.add(exit, destination)
+        if new_pair:
+          if exit_pair not in preloaded and not print_cached_path(exit_pair, all_outputs):
+            request = ('exit', exit, destination, timestamp, sample)
+            if args.plan_lookups:
+              planner.add(args.tag, destination, request)
             else:
-              log.debug("Skipping lookup for path {0} because we've seen it before"
-                        .format((client_as, guard)))
-              completed_lookups[(client_as, guard)] += 1
-
-            if (exit, destination) not in completed_lookups:
-              searcher.query_by_ip(args.tag, exit, destination,
-                                   mk_callback("Exit-Destination", (exit, destination), timestamp, sample))
-              log.debug("Querying for path {0}".format((exit, destination)))
-              completed_lookups[(exit, destination)] = 1
-            else:
-              completed_lookups[(exit, destination)] += 1
-              log.debug("Skipping lookup for path {0} because we've seen it before"
-                        .format((exit, destination)))
-
-              unique_streams[(client_as, guard, exit, destination)] = {'ctr': 1, 'first_observation':timestamp}
-
-          else:
-            unique_streams[(client_as, guard, exit, destination)]['ctr'] += 1
-            completed_lookups[(client_as, guard)] += 1
-            completed_lookups[(exit, destination)] += 1
+              lookup(request)
+
+        for group_index, group in enumerate(groups):
+          client_as = group.client_as(sample)
+
+          guard_pair = (client_as, guard)
+          guard_slot, new_pair = group.lookups.add(client_as, guard)
+          if new_pair:
+            if guard_pair not in preloaded and not print_cached_path(guard_pair, [group.out]):
+              request = ('guard', group_index, client_as, guard,
+                         timestamp, sample)
+              if args.plan_lookups:
+                planner.add(args.tag, guard, request)
+              else:
+                lookup(request)
+
+          if not group.streams.add(guard_slot, exit_slot, timestamp):
             skipped += 1
-            log.debug("Skipping {0} because we've seen this stream before")
+            log.debug("Skipping {0} because we've seen this stream before"
+                      .format((client_as, guard, exit, destination)))
 
-        PROC_STARTED += 2
+    # Lookups held back by --plan-lookups go out now
+    planner.dispatch(lookup)
 
-      fin.close()
+    # Let outstanding lookups finish before reporting
+    searcher.shutdown()
   except KeyboardInterrupt:
     log.warn("Shutting down")
     searcher.shutdown()
     pass
   finally:
+    close_path_cache()
     log.info("Printing streams")
-    for stream in unique_streams:
-      print("@STREAM_CTR|{0}::{1}|{2}::{3}|{count}|{timestamp}"
-            .format(*stream,
-                    count=unique_streams[stream]['ctr'],
-                    timestamp=unique_streams[stream]['first_observation']))
-
-    print("@TOTAL_STREAMS|{0}".format(PROC_STARTED / 2))
-
-    for pairing in completed_lookups:
-      print("@PAIR_COUNTER|{0}|{1}"
-            .format(pairing, completed_lookups[pairing]))
-
-
-class Path(object):
-  def __init__(self, origin, dest, path, ixps):
-    self.origin = origin
-    self.dest = dest
-    self.path = frozenset(path.split())
-    if ixps == "-":
-      self.ixps = frozenset([])
-    else:
-      ixpids = [ixp.split(":")[0] for ixp in ixps.split()]
-      self.ixps = frozenset(ixpids)
+    for group in groups:
+      for guard_slot, exit_slot, count, first_seen in group.streams:
+        group.out.stream(group.lookups.pair(guard_slot),
+                         exit_lookups.pair(exit_slot),
+                         count, first_seen)
 
+      group.out.total_streams(PROC_STARTED / 2)
 
-class NewPath(object):
-  def __init__(self, origin, dest, path, ixps, metaixps):
-    self.origin = origin
-    self.dest = dest
-    self.path = frozenset(path.split())
-    if ixps == "-":
-      self.ixps = frozenset([])
-    else:
-      ixpids = [ixp for ixp in ixps.split()]
-      self.ixps = frozenset(ixpids)
-    if metaixps == "-":
-      self.metaixps = frozenset([])
-    else:
-      ixpids = [ixp for ixp in metaixps.split()]
-      self.metaixps = frozenset(ixpids)
+      for pairing, count in itertools.chain(group.lookups, exit_lookups):
+        group.out.pair_counter(pairing, count)
 
-result = None
-PATH_WAITING = dict()
+      group.out.close()
 
 
 def analyze(args):
-  global result
-  global PATH_WAITING
-  paths = dict()
-
-  with open(args.paths) as fin:
-    for line in fin:
-      fields = line.strip().split("|")
-      if fields[0] != '@PATH':
-        log.debug("Skipping non-path line: {0}".format(line))
-      else:
-        origin, dest = fields[1].split("::")
-        paths[fields[1]] = NewPath(origin, dest, fields[2], fields[3], fields[4])
+  """ Count, for every sample, the streams each client's
+  top-k AS, IXP and MetaIXP adversaries could observe.
+  """
+  try:
+    from inettopology.asmap.extra.torps.adversary import (AdversaryEngine,
+                                                          ResultSink)
+  except ImportError:
+    log.error("'numpy' not found. Try 'pip install numpy'")
+    sys.exit(1)
 
-  log.info("Read {0} paths ".format(len(paths)))
+  if not args.output_dir and not args.results:
+    log.error("Nowhere to write results. Give --results, --output_dir "
+              "or both")
+    sys.exit(1)
 
-  with open(args.badguys) as fin:
-    badguys = json.load(fin)
+  from inettopology.asmap.extra.torps.pathtable import PathTable
 
-  result = dict()
-  result['sample_globals'] = [x for x in itertools.repeat({"stream_count": 0, "fail_count": 0}, args.samples)]
-  for AS in badguys:
-    result[AS] = dict()
-
-    as_adversaries = dict()
-    if "AS" in badguys[AS]:
-      this_AS_badases = badguys[AS]["AS"]
-      for i in xrange(len(this_AS_badases)):
-        as_adversaries[frozenset(this_AS_badases[:i+1])] =list()
-        for sample in xrange(args.samples):
-          as_adversaries[frozenset(this_AS_badases[:i+1])].append({
-            'comp_time': None,
-            'guard_time': None,
-            'exit_time': None,
-            "comp_ctr": 0,
-            'guard_ctr': 0,
-            'exit_ctr': 0,
-            'good_ctr': 0
-            })
-    result[AS]['as_result'] = as_adversaries
-
-    ixp_adversaries = dict()
-    if "IXP" in badguys[AS]:
-      for i in xrange(len(badguys[AS]["IXP"])):
-        ixp_adversaries[frozenset(badguys[AS]["IXP"][:i+1])] = list()
-        for sample in xrange(args.samples):
-          ixp_adversaries[frozenset(badguys[AS]["IXP"][:i+1])].append({
-            'comp_time': None,
-            'guard_time': None,
-            'exit_time': None,
-            "comp_ctr": 0,
-            'guard_ctr': 0,
-            'exit_ctr': 0,
-            'good_ctr': 0
-            })
-
-    result[AS]['ixp_result'] = ixp_adversaries
-
-    mixp_adversaries = dict()
-    if "MetaIXP" in badguys[AS]:
-      for i in xrange(len(badguys[AS]["MetaIXP"])):
-        mixp_adversaries[frozenset(badguys[AS]["MetaIXP"][:i+1])] = list()
-        for sample in xrange(args.samples):
-          mixp_adversaries[frozenset(badguys[AS]["MetaIXP"][:i+1])].append({
-            'comp_time': None,
-            'guard_time': None,
-            'exit_time': None,
-            "comp_ctr": 0,
-            'guard_ctr': 0,
-            'exit_ctr': 0,
-            'good_ctr': 0
-            })
-    result[AS]['metaixp_result'] = mixp_adversaries
-
-    #outfiles[AS] = open("{0}/{1}.adversary.{2}.results".format(args.output_dir,
-                                                               #os.path.basename(args.datafile),
-                                                               #AS), 'w')
+  paths = PathTable.load(args.paths)
 
-  i = 0
-  missing_paths = set()
-  data = open(args.datafile, "r", -1)
-  timer = time.time()
-  try:
-    next(data)
-    for line in data:
-      i += 1
-      if i % 10000 == 0:
-        newtime = time.time()
-        log.info("Read %d lines (%0.2f second iteration)\n"%(i, newtime-timer))
-        timer = newtime
-      sample, timestamp, guard, middle, exit, destination = line.split()[:6]
-
-      #if first_timestamp is None:
-        #first_timestamp = float(timestamp)
-
-      timestamp = int(float(timestamp))
-      sample = int(sample)
+  with open(args.badguys) as fin:
+    badguys = json.load(fin)
 
-      result['sample_globals'][sample]['stream_count'] += 1
+  engine = AdversaryEngine(badguys, paths, args.samples)
+  sink = None
+  if args.results:
+    sink = ResultSink(engine, args.results, args.checkpoint_interval)
+  ckpt = checkpoint.from_args(args)
 
-      try:
-        exit_path = paths["%s::%s"%(exit, destination)]
-      except KeyError:
-        if "%s::%s"%(exit, destination) not in missing_paths:
-          sys.stderr.write("MISSING_PATH|{0}::{1}|{2}|{3}\n".format(exit, destination, sample, timestamp))
-          missing_paths.add("%s::%s"%(exit, destination))
-        exit_path = None
-
-      for client_AS, results in result.iteritems():
-        if client_AS == 'sample_globals':
-          continue # we don't actually want that
-        try:
-          guard_path = paths["%s::%s"%(client_AS, guard)]
-        except KeyError:
-          if "%s::%s"%(client_AS, guard) not in missing_paths:
-            sys.stderr.write("MISSING_PATH|{0}::{1}|{2}|{3}\n".format(client_AS, guard, sample, timestamp))
-            missing_paths.add("%s::%s"%(client_AS, guard))
-          guard_path = None
-
-        if guard_path is None or exit_path is None:
-          result['sample_globals'][sample]['fail_count'] += 1
-          continue
+  if args.jobs > 1:
+    analyze_sharded(engine, sink, ckpt, args)
+    return
 
-        for as_adversary in results['as_result']:
-          check_safety(results, 'as_result', as_adversary, guard_path.path, exit_path.path, timestamp, sample)
+  def report_missing(key, sample, timestamp):
+    sys.stderr.write("MISSING_PATH|{0}|{1}|{2}\n".format(key, sample, timestamp))
 
-        for ixp_adversary in results['ixp_result']:
-          check_safety(results, 'ixp_result', ixp_adversary, guard_path.ixps, exit_path.ixps, timestamp, sample)
+  data = trace.open_trace(args.datafile)
+  start = 0
+  missing_paths = set()
+  if args.resume:
+    state = ckpt.load()
+    if state['mode'] != 'serial':
+      log.error("Checkpoint was made with --jobs; resume with --jobs")
+      sys.exit(1)
+    engine.load_state(state['engine'])
+    start = state['position']
+    missing_paths = state['missing']
+
+  def save_checkpoint():
+    ckpt.save({'mode': 'serial',
+               'position': data.position,
+               'missing': missing_paths,
+               'engine': engine.state()})
+
+  def progress():
+    if sink is not None:
+      sink.maybe_checkpoint()
+    if ckpt is not None and ckpt.due():
+      save_checkpoint()
 
-        for meta_ixp_adversary in results['metaixp_result']:
-          check_safety(results, 'metaixp_result', meta_ixp_adversary, guard_path.metaixps, exit_path.metaixps, timestamp, sample)
+  try:
+    analyze_rows(engine, data.rows(start), report_missing,
+                 progress=progress, missing_paths=missing_paths)
 
   except KeyboardInterrupt:
     log.warn("Writing incomplete results\n")
-    print_results(result, args)
+    write_results(engine, sink, args)
 
   except Exception as e:
     traceback.print_exc()
     raise
 
   else:
-    print_results(result, args)
+    write_results(engine, sink, args)
+    if ckpt is not None:
+      save_checkpoint()
 
 
-def ad_hoc_callback(waiting_jobs, paths, results, pathtype, meta_ixps, pathid):
-  def callback(data):
-    global result
+def export_results(args):
+  """ Write the text results files for a --results file """
+  try:
+    from inettopology.asmap.extra.torps.adversary import SavedResults
+  except ImportError:
+    log.error("'numpy' not found. Try 'pip install numpy'")
+    sys.exit(1)
 
-    if data['type'] == "error":
-      print("@ERROR|{1}|{0}".format(data['msg'], pathid))
-      for results, wait_id in PATH_WAITING[pathid]:
-        job = waiting_jobs[wait_id]
-        timestamp = wait_id[5]
-        sample = wait_id[4]
-
-        result['sample_globals'][sample]['fail_count'] += 1
-        del waiting_jobs[wait_id]
-      return
+  print_results(SavedResults(args.datafile), args)
 
-    if data['path'] is None:
-      print("@ERROR|{1}|{0}".format("Path not computed", pathid))
-      for results, wait_id in PATH_WAITING[pathid]:
-        job = waiting_jobs[wait_id]
-        timestamp = wait_id[5]
-        sample = wait_id[4]
-        result['sample_globals'][sample]['fail_count'] += 1
-        del waiting_jobs[wait_id]
-      return
 
-    if len(data['ixps']) == 0:
-      ixpline =  "-"
-    else:
-      ixpline = " ".join(["{0}:({1}, {2}):{3}".format(ixp, ixpdata['as1'], ixpdata['as2'], ixpdata['confidence'].split()[0])
-                            for ixp, ixpdata in data['ixps'].iteritems()])
-
-    log.info("Missing path found for {0}::{1}. Will notify {2} waiting on it".format(
-             pathid[0], pathid[1], len(PATH_WAITING[pathid])))
-    for results, wait_id in PATH_WAITING[pathid]:
-      job = waiting_jobs[wait_id]
-      timestamp = wait_id[5]
-      sample = wait_id[4]
-
-      if pathtype == "guard" :
-        if job[0] is not None:
-          log.info("Conflict")
-          continue
-        else:
-          job[0] = Path(wait_id[0], wait_id[1], data['path'], ixpline)
-          paths["%s::%s" % (wait_id[0], wait_id[1])] = job[0]
+def write_results(engine, sink, args):
+  engine.flush()
+  if sink is not None:
+    sink.checkpoint()
+  if args.output_dir:
+    print_results(engine, args)
 
-      elif pathtype == "exit" :
-        if job[1] is not None:
-          log.info("Conflict")
-          continue
-        else:
-          job[1] = Path(wait_id[2], wait_id[3], data['path'], ixpline)
-          paths["%s::%s" % (wait_id[2], wait_id[3])] = job[1]
 
-      if not all(job):
-        continue
+def analyze_rows(engine, rows, report_missing, progress=None,
+                 missing_paths=None):
+  """ Feed every stream in :rows: to :engine:, calling
+  :report_missing: with the key, sample and timestamp of
+  the first stream that needs each path not in the engine
+  or already in :missing_paths:.
+
+  :progress: is called every 10000 rows, between rows.
+  """
+  i = 0
+  if missing_paths is None:
+    missing_paths = set()
+  timer = time.time()
+  for sample, timestamp, guard, middle, exit, destination in rows:
+    exit_key = "%s::%s" % (exit, destination)
+    exit_pid = engine.path_id(exit_key)
+    if exit_pid < 0 and exit_key not in missing_paths:
+      report_missing(exit_key, sample, timestamp)
+      missing_paths.add(exit_key)
+
+    guard_pids = dict()
+    for client_AS in engine.clients:
+      guard_key = "%s::%s" % (client_AS, guard)
+      guard_pids[client_AS] = engine.path_id(guard_key)
+      if guard_pids[client_AS] < 0 and guard_key not in missing_paths:
+        report_missing(guard_key, sample, timestamp)
+        missing_paths.add(guard_key)
+
+    engine.observe(sample, timestamp, exit_pid, guard_pids)
+
+    i += 1
+    if i % 10000 == 0:
+      newtime = time.time()
+      log.info("Read %d lines (%0.2f second iteration)\n"%(i, newtime-timer))
+      timer = newtime
+      if progress is not None:
+        progress()
+
+
+# Shared with the shard workers, which inherit it when forked
+SHARD_STATE = None
+
+
+def _analyze_shard(shard):
+  engine, datafile = SHARD_STATE
+  # Workers are reused, so start each shard from nothing
+  engine.clear()
+  missing = list()
+
+  def report_missing(key, sample, timestamp):
+    missing.append((key, sample, timestamp))
+
+  analyze_rows(engine, trace.read_trace(datafile, shard), report_missing)
+  return engine.counters(), missing
+
+
+def analyze_sharded(engine, sink, ckpt, args):
+  """ Split the trace into shards and analyze them with a
+  pool of --jobs processes, which share the path table and
+  adversaries in :engine:.
+
+  Shard results are merged in shard order as they finish,
+  so the output is the same as a serial run's. Checkpoints
+  record the shards merged so far.
+  """
+  import multiprocessing
+  global SHARD_STATE
+
+  shards = args.jobs * 4
+  done = 0
+  reported = set()
+  if args.resume:
+    state = ckpt.load()
+    if state['mode'] != 'sharded':
+      log.error("Checkpoint was made without --jobs; resume without it")
+      sys.exit(1)
+    engine.load_state(state['engine'])
+    shards = state['shards']
+    done = state['done']
+    reported = state['reported']
 
-      guard_path = job[0]
-      exit_path = job[1]
+  def save_checkpoint():
+    ckpt.save({'mode': 'sharded',
+               'shards': shards,
+               'done': done,
+               'reported': reported,
+               'engine': engine.state()})
 
-      for as_adversary in results['as_result']:
-        check_safety(results, 'as_result', as_adversary, guard_path.path, exit_path.path, timestamp, sample)
+  SHARD_STATE = (engine, args.datafile)
+  pool = multiprocessing.Pool(args.jobs)
 
-      for ixp_adversary in results['ixp_result']:
-        check_safety(results, 'ixp_result', ixp_adversary, guard_path.ixps, exit_path.ixps, timestamp, sample)
+  try:
+    results = pool.imap(_analyze_shard,
+                        [(index, shards) for index in xrange(done, shards)])
+    for counters, missing in results:
+      engine.merge(counters)
+      for key, sample, timestamp in missing:
+        if key not in reported:
+          reported.add(key)
+          sys.stderr.write("MISSING_PATH|{0}|{1}|{2}\n".format(key, sample, timestamp))
+      done += 1
+      log.info("Merged shard {0}/{1}".format(done, shards))
+      if sink is not None:
+        sink.maybe_checkpoint()
+      if ckpt is not None and ckpt.due():
+        save_checkpoint()
+    pool.close()
+    if ckpt is not None:
+      save_checkpoint()
 
-      for meta_ixp_adversary in results['metaixp_result']:
-        guard_meta_ixps = set(map(lambda x: meta_ixps.get(x, None), guard_path.ixps))
-        exit_meta_ixps = set(map(lambda x: meta_ixps.get(x, None), guard_path.ixps))
-        check_safety(results, 'metaixp_result', meta_ixp_adversary, guard_meta_ixps, exit_meta_ixps, timestamp, sample)
+  except KeyboardInterrupt:
+    log.warn("Writing incomplete results\n")
+    pool.terminate()
 
-      del waiting_jobs[wait_id]
-    del PATH_WAITING[pathid]
+  except Exception:
+    pool.terminate()
+    raise
 
-  return callback
+  finally:
+    pool.join()
+    SHARD_STATE = None
 
-def print_results(result, args):
-  for AS in result:
-    if AS == 'sample_globals':
-      with open("{0}/client.sample.{1}.globals".format(
-          args.output_dir,
-          args.filetag if args.filetag else os.path.basename(args.datafile)), 'w') as fout:
-        fout.write("# sample stream_count fail_count\n")
-        for i, sample in enumerate(result['sample_globals']):
-          fout.write("{0} {stream_count} {fail_count}\n".format(i, **sample))
+  write_results(engine, sink, args)
 
-    else:
-      for adversary, samples in result[AS]['as_result'].iteritems():
-        outfile = open("{0}/client.{1}.as_adversary.{2}.{3}.results".format(
-                        args.output_dir,
-                        AS,
-                        "top{0}".format(len(adversary)),
-                        args.filetag if args.filetag else os.path.basename(args.datafile)
-                       ), 'w')
 
-        outfile.write("# sample comp_time guard_time exit_time comp_ctr guard_ctr exit_ctr good_ctr\n")
-        for sample_num, sample in enumerate(samples):
-          outfile.write("{0} {1} {2} {3} {4} {5} {6} {7}\n".format(
-                          sample_num + args.sample_start,
-                          sample['comp_time'],
-                          sample['guard_time'],
-                          sample['exit_time'],
-                          sample['comp_ctr'],
-                          sample['guard_ctr'],
-                          sample['exit_ctr'],
-                          sample['good_ctr']
-                          ))
-        outfile.close()
+def print_results(engine, args):
+  from inettopology.asmap.extra.torps.adversary import NO_TIME
 
-      for adversary, samples in result[AS]['ixp_result'].iteritems():
-        outfile = open("{0}/client.{1}.ixp_adversary.{2}.{3}.results".format(
-                        args.output_dir,
-                        AS,
-                        "top{0}".format(len(adversary)),
-                        args.filetag if args.filetag else os.path.basename(args.datafile)
-                       ), 'w')
+  filetag = args.filetag if args.filetag else os.path.basename(args.datafile)
 
-        outfile.write("# sample comp_time guard_time exit_time comp_ctr guard_ctr exit_ctr good_ctr\n")
-        for sample_num, sample in enumerate(samples):
-          outfile.write("{0} {1} {2} {3} {4} {5} {6} {7}\n".format(
-                          sample_num + args.sample_start,
-                          sample['comp_time'],
-                          sample['guard_time'],
-                          sample['exit_time'],
-                          sample['comp_ctr'],
-                          sample['guard_ctr'],
-                          sample['exit_ctr'],
-                          sample['good_ctr']
-                          ))
-        outfile.close()
+  with open("{0}/client.sample.{1}.globals".format(
+      args.output_dir, filetag), 'w') as fout:
+    fout.write("# sample stream_count fail_count\n")
+    for i in xrange(engine.samples):
+      fout.write("{0} {1} {2}\n".format(i, engine.stream_count[i],
+                                        engine.fail_count[i]))
+
+  def fmt_time(ts):
+    return None if ts == NO_TIME else ts
 
-      for adversary, samples in result[AS]['metaixp_result'].iteritems():
-        outfile = open("{0}/client.{1}.metaixp_adversary.{2}.{3}.results".format(
+  for AS in engine.clients:
+    for result_type, table in engine.tables[AS].iteritems():
+      for k in xrange(1, len(table) + 1):
+        outfile = open("{0}/client.{1}.{2}_adversary.{3}.{4}.results".format(
                         args.output_dir,
                         AS,
-                        "top{0}".format(len(adversary)),
-                        args.filetag if args.filetag else os.path.basename(args.datafile) 
+                        result_type.split("_")[0],
+                        "top{0}".format(k),
+                        filetag
                        ), 'w')
 
+        result = table.result(k)
         outfile.write("# sample comp_time guard_time exit_time comp_ctr guard_ctr exit_ctr good_ctr\n")
-        for sample_num, sample in enumerate(samples):
+        for sample_num in xrange(engine.samples):
           outfile.write("{0} {1} {2} {3} {4} {5} {6} {7}\n".format(
                           sample_num + args.sample_start,
-                          sample['comp_time'],
-                          sample['guard_time'],
-                          sample['exit_time'],
-                          sample['comp_ctr'],
-                          sample['guard_ctr'],
-                          sample['exit_ctr'],
-                          sample['good_ctr']
+                          fmt_time(result['comp_time'][sample_num]),
+                          fmt_time(result['guard_time'][sample_num]),
+                          fmt_time(result['exit_time'][sample_num]),
+                          result['comp_ctr'][sample_num],
+                          result['guard_ctr'][sample_num],
+                          result['exit_ctr'][sample_num],
+                          result['good_ctr'][sample_num]
                           ))
         outfile.close()
-
-def check_safety(results, result_type, adversary, guard_path, exit_path, timestamp, sample):
-  safe = True
-  have_guard = False
-  sample_dict = results[result_type][adversary][sample]
-  if guard_path & adversary:
-    curr_timestamp = sample_dict['guard_time'] 
-    if curr_timestamp is None or timestamp < curr_timestamp:
-      sample_dict['guard_time'] = timestamp
-    sample_dict['guard_ctr'] +=1
-    safe = False
-    have_guard = True
-
-  if exit_path & adversary:
-    curr_timestamp = sample_dict['exit_time'] 
-    if curr_timestamp is None or timestamp < curr_timestamp:
-      sample_dict['exit_time'] = timestamp
-    sample_dict['exit_ctr'] +=1
-    safe = False
-
-    if have_guard:
-      curr_timestamp = sample_dict['comp_time'] 
-      if curr_timestamp is None or timestamp < curr_timestamp:
-        sample_dict['comp_time'] = timestamp
-      sample_dict['comp_ctr'] +=1
-
-  if safe:
-    sample_dict['good_ctr'] +=1
-
-
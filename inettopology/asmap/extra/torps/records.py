@@ -0,0 +1,331 @@
+import sys
+import json
+import threading
+import Queue
+import logging
+
+log = logging.getLogger(__name__)
+
+""" Preprocessed path records
+
+torps.preprocess and torps.infer_path write one record per
+path, stream, client mapping and pair count. Records can be
+written either as the original pipe-delimited text:
+
+  @PATH|<src>::<dst>|<AS path>|<IXPs or ->|<MetaIXPs or ->
+  @STREAM_CTR|<client AS>::<guard>|<exit>::<dest>|<count>|<first seen>
+  @CLIENT_MAPPING|<sample>|<client AS>
+  @TOTAL_STREAMS|<count>
+  @PAIR_COUNTER|('<src>', '<dst>')|<count>
+  @ERROR|<where>|<message>
+
+or as JSON lines, with one array per record, holding a
+record type and then the same fields in the same order. In
+JSON, ASNs in paths are integers, and IXPs and MetaIXPs are
+given by integer IDs. Each ID is defined by a NAME record
+before its first use:
+
+  ["n",0,"ixp3"]
+  ["n",1,"org_M1"]
+  ["p","100","1.0.0.2",[30,40,50],[0],[1]]
+
+:text_lines: turns either format back into text.
+"""
+
+FORMATS = ('text', 'jsonl')
+
+# JSON record types
+NAME = "n"
+PATH = "p"
+STREAM = "s"
+CLIENT_MAPPING = "c"
+TOTAL_STREAMS = "t"
+PAIR_COUNTER = "pc"
+ERROR = "e"
+TEXT = "x"
+
+# Records are handed to the writer thread in blocks this big
+BLOCK_SIZE = 1 << 20
+# Blocks which may be waiting to be written
+MAX_PENDING_BLOCKS = 4
+
+
+class RecordWriter(object):
+  """ Buffer records for :out:, and write them out in blocks of
+  BLOCK_SIZE bytes from a separate thread, so writes don't
+  hold up lookups.
+
+  :flush: and :tell: wait for every block to be written.
+  Subclasses encode the records.
+  """
+
+  def __init__(self, out, block_size=BLOCK_SIZE):
+    self.out = out
+    self.block_size = block_size
+    self._buffer = []
+    self._size = 0
+    self._blocks = None
+    self._thread = None
+    self._error = None
+
+  def _write(self, data):
+    self._buffer.append(data)
+    self._size += len(data)
+    if self._size >= self.block_size:
+      self._send()
+
+  def _send(self):
+    if not self._buffer:
+      return
+    if self._thread is None:
+      self._blocks = Queue.Queue(maxsize=MAX_PENDING_BLOCKS)
+      self._thread = threading.Thread(target=self._writer)
+      self._thread.daemon = True
+      self._thread.start()
+    self._check()
+    self._blocks.put("".join(self._buffer))
+    self._buffer = []
+    self._size = 0
+
+  def _writer(self):
+    while True:
+      block = self._blocks.get()
+      try:
+        if block is None:
+          return
+        if self._error is None:
+          self.out.write(block)
+      except Exception as e:
+        self._error = e
+      finally:
+        self._blocks.task_done()
+
+  def _check(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def flush(self):
+    self._send()
+    if self._thread is not None:
+      self._blocks.join()
+    self._check()
+    self.out.flush()
+
+  def tell(self):
+    self.flush()
+    return self.out.tell()
+
+  def close(self):
+    self.flush()
+    if self._thread is not None:
+      self._blocks.put(None)
+      self._thread.join()
+      self._thread = None
+    if self.out is not sys.stdout:
+      self.out.close()
+
+  def state(self):
+    """ Whatever is needed to append to this output later """
+    return None
+
+  def restore(self, state):
+    pass
+
+
+class TextWriter(RecordWriter):
+
+  def path(self, endpoints, path, ixpline, metaixpline):
+    self._write("@PATH|{0}::{1}|{2}|{3}|{4}\n".format(
+                endpoints[0], endpoints[1], path, ixpline, metaixpline))
+
+  def stream(self, guard, exit, count, timestamp):
+    self._write("@STREAM_CTR|{0}::{1}|{2}::{3}|{4}|{5}\n".format(
+                guard[0], guard[1], exit[0], exit[1], count, timestamp))
+
+  def client_mapping(self, sample, client_as):
+    self._write("@CLIENT_MAPPING|{0}|{1}\n".format(sample, client_as))
+
+  def total_streams(self, count):
+    self._write("@TOTAL_STREAMS|{0}\n".format(count))
+
+  def pair_counter(self, pair, count):
+    self._write("@PAIR_COUNTER|{0}|{1}\n".format(tuple(pair), count))
+
+  def error(self, where, msg):
+    self._write("@ERROR|{0}|{1}\n".format(where, msg))
+
+  def text(self, line):
+    """ Write a record given as a line of text """
+    self._write(line)
+
+
+def _encode_asn(asn):
+  if asn.isdigit() and str(int(asn)) == asn:
+    return int(asn)
+  return asn
+
+
+def _number(field):
+  try:
+    return int(field)
+  except ValueError:
+    return float(field)
+
+
+def _split(field):
+  if field is None or field == "-":
+    return []
+  return field.split()
+
+
+class JsonWriter(RecordWriter):
+
+  def __init__(self, out, block_size=BLOCK_SIZE):
+    super(JsonWriter, self).__init__(out, block_size)
+    self.names = dict()
+
+  def _record(self, *record):
+    self._write(json.dumps(record, separators=(',', ':')) + "\n")
+
+  def _ids(self, names):
+    ids = []
+    for name in names:
+      try:
+        ids.append(self.names[name])
+      except KeyError:
+        name_id = self.names[name] = len(self.names)
+        self._record(NAME, name_id, name)
+        ids.append(name_id)
+    return ids
+
+  def path(self, endpoints, path, ixpline, metaixpline):
+    if path is None or path == "None":
+      path = None
+    else:
+      path = [_encode_asn(asn) for asn in path.split()]
+    self._record(PATH, endpoints[0], endpoints[1], path,
+                 self._ids(_split(ixpline)), self._ids(_split(metaixpline)))
+
+  def stream(self, guard, exit, count, timestamp):
+    self._record(STREAM, guard[0], guard[1], exit[0], exit[1],
+                 count, timestamp)
+
+  def client_mapping(self, sample, client_as):
+    self._record(CLIENT_MAPPING, sample, client_as)
+
+  def total_streams(self, count):
+    self._record(TOTAL_STREAMS, count)
+
+  def pair_counter(self, pair, count):
+    self._record(PAIR_COUNTER, pair[0], pair[1], count)
+
+  def error(self, where, msg):
+    self._record(ERROR, where, msg)
+
+  def text(self, line):
+    """ Write a record given as a line of text """
+    fields = line.rstrip("\n").split("|")
+    rtype = fields[0]
+    if rtype == "@PATH":
+      self.path(fields[1].split("::"), fields[2], fields[3],
+                fields[4] if len(fields) > 4 else "-")
+    elif rtype == "@STREAM_CTR":
+      self.stream(fields[1].split("::"), fields[2].split("::"),
+                  _number(fields[3]), _number(fields[4]))
+    elif rtype == "@CLIENT_MAPPING":
+      self.client_mapping(int(fields[1]), fields[2])
+    elif rtype == "@TOTAL_STREAMS":
+      self.total_streams(int(fields[1]))
+    elif rtype == "@ERROR":
+      self.error(fields[1], "|".join(fields[2:]))
+    else:
+      self._record(TEXT, line)
+
+  def state(self):
+    return self.names
+
+  def restore(self, state):
+    self.names = state
+
+
+def open_writer(out, fmt='text'):
+  """ Return a RecordWriter which writes :fmt: records to the
+  file object :out: """
+  if fmt == 'jsonl':
+    return JsonWriter(out)
+  return TextWriter(out)
+
+
+def _str(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def _to_text(record, names):
+  record = map(_str, record)
+  rtype = record[0]
+  if rtype == PATH:
+    src, dst, path, ixps, metaixps = record[1:]
+    if path is None:
+      path = "None"
+    else:
+      path = " ".join(str(_str(asn)) for asn in path)
+    ixps = " ".join(names[i] for i in ixps) or "-"
+    metaixps = " ".join(names[i] for i in metaixps) or "-"
+    return "@PATH|{0}::{1}|{2}|{3}|{4}\n".format(src, dst, path,
+                                                 ixps, metaixps)
+  elif rtype == STREAM:
+    return "@STREAM_CTR|{0}::{1}|{2}::{3}|{4}|{5}\n".format(*record[1:])
+  elif rtype == CLIENT_MAPPING:
+    return "@CLIENT_MAPPING|{0}|{1}\n".format(*record[1:])
+  elif rtype == TOTAL_STREAMS:
+    return "@TOTAL_STREAMS|{0}\n".format(*record[1:])
+  elif rtype == PAIR_COUNTER:
+    return "@PAIR_COUNTER|{0}|{1}\n".format(tuple(record[1:3]), record[3])
+  elif rtype == ERROR:
+    return "@ERROR|{0}|{1}\n".format(*record[1:])
+  elif rtype == TEXT:
+    return record[1]
+  raise ValueError("Unknown record type '{0}'".format(rtype))
+
+
+def is_jsonl(filename):
+  """ Whether :filename: holds JSON records """
+  with open(filename) as fin:
+    for line in fin:
+      if line.strip():
+        return line.startswith("[")
+  return False
+
+
+def text_lines(fin, names=None):
+  """ Yield every record in :fin: as a line of text, whichever
+  format it was written in.
+
+  :fin: may be any iterable of lines. IXP names defined by
+  JSON records are kept in :names:, so a file can be read in
+  several goes.
+  """
+  if names is None:
+    names = dict()
+  for line in fin:
+    if not line.startswith("["):
+      yield line
+      continue
+    record = json.loads(line)
+    if record[0] == NAME:
+      names[record[1]] = _str(record[2])
+    else:
+      yield _to_text(record, names)
+
+
+def export(args):
+  """ Write the records in each datafile to :args.output: as
+  text """
+  with open(args.output, 'w') as fout:
+    for fname in args.datafile:
+      with open(fname) as fin:
+        for line in text_lines(fin):
+          fout.write(line)
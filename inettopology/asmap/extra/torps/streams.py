@@ -0,0 +1,116 @@
+import array
+
+
+class Interner(object):
+  """ Map values to dense integer IDs and back """
+
+  def __init__(self, values=()):
+    self.values = list(values)
+    self._ids = dict((value, idx) for idx, value in enumerate(self.values))
+
+  def id(self, value):
+    try:
+      return self._ids[value]
+    except KeyError:
+      idx = len(self.values)
+      self._ids[value] = idx
+      self.values.append(value)
+      return idx
+
+  def get(self, value, default=None):
+    """ The ID of :value:, without interning it """
+    return self._ids.get(value, default)
+
+  def __getitem__(self, idx):
+    return self.values[idx]
+
+  def __len__(self):
+    return len(self.values)
+
+
+class PairCounter(object):
+  """ Count occurrences of (src, dst) endpoint pairs.
+
+  Endpoints are interned with :endpoints:, which may be
+  shared between several counters.
+  """
+
+  def __init__(self, endpoints):
+    self.endpoints = endpoints
+    self._slots = dict()
+    self.srcs = array.array('I')
+    self.dsts = array.array('I')
+    self.counts = array.array('L')
+
+  def add(self, src, dst):
+    """ Count one occurrence of (:src:, :dst:). Returns the
+    slot for the pair and whether it was new.
+    """
+    src_id = self.endpoints.id(src)
+    dst_id = self.endpoints.id(dst)
+    key = (src_id << 32) | dst_id
+    try:
+      slot = self._slots[key]
+    except KeyError:
+      slot = len(self.counts)
+      self._slots[key] = slot
+      self.srcs.append(src_id)
+      self.dsts.append(dst_id)
+      self.counts.append(1)
+      return slot, True
+
+    self.counts[slot] += 1
+    return slot, False
+
+  def pair(self, slot):
+    return (self.endpoints[self.srcs[slot]], self.endpoints[self.dsts[slot]])
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __iter__(self):
+    """ Yield ((src, dst), count) for every pair """
+    for slot in xrange(len(self.counts)):
+      yield self.pair(slot), self.counts[slot]
+
+
+class StreamCounter(object):
+  """ Count streams, identified by the slots of their
+  client-guard and exit-destination pairs, along with the
+  timestamp each was first seen at.
+  """
+
+  def __init__(self):
+    self._slots = dict()
+    self.guards = array.array('I')
+    self.exits = array.array('I')
+    self.counts = array.array('L')
+    self.first_seen = array.array('l')
+
+  def add(self, guard_slot, exit_slot, timestamp):
+    """ Count one occurrence of a stream. Returns True if it
+    hadn't been seen before.
+    """
+    key = (guard_slot << 32) | exit_slot
+    try:
+      slot = self._slots[key]
+    except KeyError:
+      self._slots[key] = len(self.counts)
+      self.guards.append(guard_slot)
+      self.exits.append(exit_slot)
+      self.counts.append(1)
+      self.first_seen.append(timestamp)
+      return True
+
+    self.counts[slot] += 1
+    return False
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __iter__(self):
+    """ Yield (guard_slot, exit_slot, count, first_seen)
+    for every stream """
+    for slot in xrange(len(self.counts)):
+      yield (self.guards[slot], self.exits[slot],
+             self.counts[slot], self.first_seen[slot])
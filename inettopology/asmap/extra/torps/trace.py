@@ -0,0 +1,205 @@
+import os
+import sys
+import array
+import logging
+
+log = logging.getLogger(__name__)
+
+""" Columnar trace format
+
+A converted trace is a directory holding one NumPy array
+per column of the Path Simulator output, plus the list of
+endpoints the IP columns index into:
+
+  sample.npy        int32   sample number
+  timestamp.npy     int64   seconds since the epoch
+  guard.npy         int32   index into endpoints.txt
+  middle.npy        int32   "
+  exit.npy          int32   "
+  destination.npy   int32   "
+  endpoints.txt             one IP per line
+
+The arrays are memory-mapped when read, so repeated passes
+over a trace skip text parsing entirely.
+"""
+
+COLUMNS = ("sample", "timestamp", "guard", "middle", "exit", "destination")
+ENDPOINT_COLUMNS = ("guard", "middle", "exit", "destination")
+ENDPOINTS_FILE = "endpoints.txt"
+
+# Rows are materialized from the arrays this many at a time
+CHUNK_SIZE = 65536
+
+
+def _numpy():
+  try:
+    import numpy
+  except ImportError:
+    log.error("'numpy' not found. Try 'pip install numpy'")
+    sys.exit(1)
+  return numpy
+
+
+def is_columnar(path):
+  return os.path.isfile(os.path.join(path, ENDPOINTS_FILE))
+
+
+def _parse(line):
+  sample, timestamp, guard, middle, exit, destination = line.split()[:6]
+  return (int(sample), int(float(timestamp)),
+          guard, middle, exit, destination)
+
+
+class TextTrace(object):
+  """ A Path Simulator text output. Positions in it are byte
+  offsets.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.size = os.path.getsize(path)
+    self.position = 0
+
+  def __len__(self):
+    return self.size
+
+  def rows(self, start=0, stop=None):
+    """ Yield (sample, timestamp, guard, middle, exit,
+    destination) for every row starting within the byte
+    range [:start:, :stop:). The header belongs to the
+    range starting at 0. :position: is kept just past the
+    last row yielded. Each call reads from its own handle
+    on the file.
+    """
+    stop = self.size if stop is None else stop
+    with open(self.path) as fin:
+      if start == 0:
+        fin.readline()
+      else:
+        # Skip the line we landed in, unless it starts here
+        fin.seek(start - 1)
+        fin.readline()
+
+      self.position = fin.tell()
+      while self.position < stop:
+        line = fin.readline()
+        if not line:
+          break
+        self.position += len(line)
+        yield _parse(line)
+
+
+class ColumnarTrace(object):
+  """ A converted trace, with its columns memory-mapped from
+  the directory at :path:. Positions in it are row numbers.
+  """
+
+  def __init__(self, path):
+    np = _numpy()
+    self.path = path
+    self.columns = dict()
+    for column in COLUMNS:
+      self.columns[column] = np.load(
+          os.path.join(path, "{0}.npy".format(column)), mmap_mode='r')
+
+    with open(os.path.join(path, ENDPOINTS_FILE)) as fin:
+      self.endpoints = [line.rstrip("\n") for line in fin]
+    self.position = 0
+
+  def __len__(self):
+    return len(self.columns['sample'])
+
+  def rows(self, start=0, stop=None):
+    """ Yield (sample, timestamp, guard, middle, exit,
+    destination) for rows :start: to :stop:, with the IP
+    columns resolved back to strings. :position: is kept
+    just past the last row yielded.
+    """
+    endpoints = self.endpoints
+    stop = len(self) if stop is None else stop
+    self.position = start
+    for offset in xrange(start, stop, CHUNK_SIZE):
+      end = min(offset + CHUNK_SIZE, stop)
+      chunk = [self.columns[column][offset:end].tolist()
+               for column in COLUMNS]
+      for sample, timestamp, guard, middle, exit, destination in zip(*chunk):
+        self.position += 1
+        yield (sample, timestamp,
+               endpoints[guard], endpoints[middle],
+               endpoints[exit], endpoints[destination])
+
+
+def open_trace(path):
+  """ Open the trace at :path:, which may be either a Path
+  Simulator text output or a directory created by :convert:.
+  """
+  if is_columnar(path):
+    return ColumnarTrace(path)
+  return TextTrace(path)
+
+
+def read_trace(path, shard=None):
+  """ Yield (sample, timestamp, guard, middle, exit,
+  destination) for every stream in the trace at :path:.
+  Samples and timestamps are ints, endpoints are strings.
+
+  If :shard: is an (index, count) tuple, only yield that
+  part of the trace. Shards are cut by row for converted
+  traces and by byte offset for text ones, and the
+  :count: shards together cover every row exactly once.
+  """
+  trace = open_trace(path)
+  if shard is None:
+    return trace.rows()
+  index, count = shard
+  return trace.rows(len(trace) * index / count,
+                    len(trace) * (index + 1) / count)
+
+
+def convert(infile, outdir):
+  """ Convert the Path Simulator output in :infile: to a
+  columnar trace in :outdir:.
+  """
+  np = _numpy()
+
+  if not os.path.isdir(outdir):
+    os.makedirs(outdir)
+
+  endpoint_ids = dict()
+  endpoints = list()
+  columns = {
+      'sample': array.array('i'),
+      'timestamp': array.array('l'),
+      'guard': array.array('i'),
+      'middle': array.array('i'),
+      'exit': array.array('i'),
+      'destination': array.array('i'),
+  }
+  dtypes = {'timestamp': np.int64}
+
+  for i, row in enumerate(TextTrace(infile).rows()):
+    columns['sample'].append(row[0])
+    columns['timestamp'].append(row[1])
+    for column, endpoint in zip(ENDPOINT_COLUMNS, row[2:]):
+      try:
+        idx = endpoint_ids[endpoint]
+      except KeyError:
+        idx = endpoint_ids[endpoint] = len(endpoints)
+        endpoints.append(endpoint)
+      columns[column].append(idx)
+
+    if i > 0 and i % 1000000 == 0:
+      log.info("Read {0} rows, {1} endpoints".format(i, len(endpoints)))
+
+  for column in COLUMNS:
+    values = np.asarray(columns[column],
+                        dtype=dtypes.get(column, np.int32))
+    np.save(os.path.join(outdir, "{0}.npy".format(column)), values)
+
+  # Written last, since its presence marks a complete trace
+  with open(os.path.join(outdir, ENDPOINTS_FILE), 'w') as fout:
+    for endpoint in endpoints:
+      fout.write("{0}\n".format(endpoint))
+
+  log.info("Converted {0} rows with {1} endpoints to {2}"
+           .format(len(columns['sample']), len(endpoints), outdir))
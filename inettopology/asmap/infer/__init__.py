@@ -21,8 +21,30 @@ def add_cmdline_args(subp, parents):
                             help="The RIB tags to include above the base",
                             nargs='+', required=True)
   infer_parser.add_argument("--inferrer_count", "-c",
-                            help="The number of inferrers per tag",
+                            help="The number of inferrers per tag. Use 0 "
+                                 "to only serve requests using inferrers "
+                                 "started by another server",
                             default=1, type=int)
+  infer_parser.add_argument("--bind",
+                            help="The address to listen on "
+                                 "(default: 0.0.0.0)",
+                            default="0.0.0.0")
+  infer_parser.add_argument("--port",
+                            help="The port to listen on (default: 9323)",
+                            default=9323, type=int)
+  infer_parser.add_argument("--reuse-port",
+                            help="Set SO_REUSEPORT on the listening socket "
+                                 "so several servers can share one port",
+                            action="store_true")
+  infer_parser.add_argument("--max-handlers",
+                            help="The most requests to handle at once "
+                                 "(default: 1000)",
+                            default=1000, type=int)
+  infer_parser.add_argument("--max-queued",
+                            help="The most connections to hold while "
+                                 "waiting for a handler. Any more are "
+                                 "told the server is busy (default: 500)",
+                            default=500, type=int)
   infer_parser.add_argument("--inferrer_bin",
                             help="The binary to use for inference.",
                             default="./as_infer")
@@ -30,6 +52,19 @@ def add_cmdline_args(subp, parents):
                             help="Include the capability to translate IPs "
                                  "using a MaxMind GeoIP database",
                             metavar="GEOIP_DB")
+  infer_parser.add_argument("--packed-paths",
+                            help="Have inferrers store paths as packed "
+                                 "integer arrays rather than text",
+                            action="store_true")
+  infer_parser.add_argument("--warm-snapshot",
+                            help="Load the results in this snapshot (from "
+                                 "'infer-dump') while starting up",
+                            metavar="FILE")
+  infer_parser.add_argument("--warm-destinations",
+                            help="Infer paths to the destinations listed in "
+                                 "this file while starting up. Each line is "
+                                 "'<dst>' or '<tag> <dst>'",
+                            metavar="FILE")
   existing_elems = infer_parser.add_mutually_exclusive_group()
   existing_elems.add_argument("--force",
                               help="Leave existing elements in the queue",
@@ -39,6 +74,29 @@ def add_cmdline_args(subp, parents):
                               action="store_true")
   infer_parser.set_defaults(func=_gao_inference_helper)
 
+  dump_parser = subp.add_parser("infer-dump",
+                                help="Write inferred results to a snapshot "
+                                     "for 'infer --warm-snapshot'",
+                                parents=parents)
+  dump_parser.add_argument("--tags",
+                           help="The RIB tags to dump results for",
+                           nargs='+', required=True)
+  dump_parser.add_argument("output", help="The snapshot file to write")
+  dump_parser.set_defaults(func=_dump_results)
+
+  stats_parser = subp.add_parser("infer-stats",
+                                 help="Summarize the time inferrers spent "
+                                      "on recent destinations",
+                                 parents=parents)
+  stats_parser.add_argument("--tags",
+                            help="The RIB tags to summarize",
+                            nargs='+', required=True)
+  stats_parser.add_argument("--slowest",
+                            help="How many of the slowest destinations "
+                                 "to list (default: 10)",
+                            default=10, type=int)
+  stats_parser.set_defaults(func=_infer_stats)
+
 
 def _gao_inference_helper(args):
   """ A helper to allow not importing gao_inference unless
@@ -49,6 +107,17 @@ def _gao_inference_helper(args):
   except ImportError:
     logger.error("'gevent' not found. Try 'pip install gevent'. "
                  "Note that 'gevent' doesn't work with PyPy")
+    return
 
   import inettopology.asmap.infer.server as infer_server
   infer_server.start_inference_service(args)
+
+
+def _dump_results(args):
+  import inettopology.asmap.infer.snapshot as snapshot
+  snapshot.dump_results(args)
+
+
+def _infer_stats(args):
+  import inettopology.asmap.infer.jobstats as jobstats
+  jobstats.print_stats(args)
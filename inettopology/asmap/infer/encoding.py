@@ -0,0 +1,73 @@
+import sys
+import array
+
+""" Encodings of inferred paths
+
+The inferrer stores each path either as text, a space
+separated list of ASNs, or when run with --packed, as
+PACKED_MAGIC followed by each ASN as a little-endian
+uint32 (see Path::packed in c_extensions/inferrer).
+
+ASNs in packed paths, and in paths sent to clients which
+asked for msgpack, are encoded the same way as in the
+inferrer: dotted ASNs 'X.Y' become DOTTED_BASE + X * 10000 + Y.
+"""
+
+PACKED_MAGIC = "\0AP1"
+DOTTED_BASE = 500000
+
+
+def encode_asn(asn):
+  """ Encode the ASN string :asn: as an integer, as
+  ASN_encode does """
+  if "." in asn:
+    high, low = asn.split(".", 1)
+    return DOTTED_BASE + 10000 * int(high) + int(low.ljust(4, "0"))
+  return int(asn)
+
+
+def decode_asn(asn):
+  """ The ASN string for the encoded ASN :asn: """
+  if asn > DOTTED_BASE:
+    asn -= DOTTED_BASE
+    return "{0}.{1:04d}".format(asn / 10000, asn % 10000)
+  return str(asn)
+
+
+def is_packed(value):
+  return value is not None and value.startswith(PACKED_MAGIC)
+
+
+def pack_path(asns):
+  """ Pack the encoded ASNs :asns: as the inferrer does """
+  arr = array.array('I', asns)
+  if sys.byteorder == 'big':
+    arr.byteswap()
+  return PACKED_MAGIC + arr.tostring()
+
+
+def path_array(value):
+  """ The encoded ASNs of the stored path :value:, in either
+  encoding, as an array of unsigned ints. Packed paths are
+  read straight into the array. """
+  if is_packed(value):
+    arr = array.array('I')
+    arr.fromstring(value[len(PACKED_MAGIC):])
+    if sys.byteorder == 'big':
+      arr.byteswap()
+    return arr
+  return array.array('I', (encode_asn(asn) for asn in value.split()))
+
+
+def path_asns(value):
+  """ The ASN strings along the stored path :value: """
+  if is_packed(value):
+    return [decode_asn(asn) for asn in path_array(value)]
+  return value.split()
+
+
+def path_string(value):
+  """ The stored path :value: as text """
+  if is_packed(value):
+    return " ".join(path_asns(value))
+  return value
@@ -0,0 +1,90 @@
+import json
+import logging
+log = logging.getLogger(__name__)
+
+""" Inference job records
+
+Each inferrer pushes a record of every destination it infers
+routes to onto JOBS_KEY for its tag, keeping the newest
+JOB_HISTORY (see c_extensions/inferrer/infer.cc):
+
+  {"tag": <ribtag>, "dst": <destination AS>, "pid": <inferrer>,
+   "started": <epoch seconds>, "wait": <seconds queued, or null>,
+   "compute": <seconds inferring>, "sources": <paths stored>,
+   "bytes": <size of the stored result>}
+"""
+
+JOBS_KEY = "inference:jobs:{0}"
+
+FIELDS = ('wait', 'compute', 'sources', 'bytes')
+PERCENTILES = (50, 90, 99)
+
+
+def load_jobs(r, tag):
+  """ The job records for :tag:, newest first """
+  jobs = list()
+  for record in r.lrange(JOBS_KEY.format(tag), 0, -1):
+    try:
+      jobs.append(json.loads(record))
+    except ValueError:
+      log.warn("Skipping unreadable job record '{0}'".format(record))
+  return jobs
+
+
+def percentile(ordered, pct):
+  if not ordered:
+    return None
+  idx = min(len(ordered) - 1, int(len(ordered) * pct / 100.0))
+  return ordered[idx]
+
+
+def summarize(jobs):
+  """ Percentiles and totals of each of FIELDS over :jobs: """
+  summary = dict()
+  for field in FIELDS:
+    values = sorted(job[field] for job in jobs if job.get(field) is not None)
+    summary[field] = dict(('p{0}'.format(pct), percentile(values, pct))
+                          for pct in PERCENTILES)
+    summary[field]['max'] = values[-1] if values else None
+    summary[field]['total'] = sum(values)
+  return summary
+
+
+def _fmt(value):
+  if value is None:
+    return "-"
+  if isinstance(value, float):
+    return "{0:.3f}".format(value)
+  return str(value)
+
+
+def print_stats(args):
+  import inettopology.util.structures as redis_structures
+
+  r = redis_structures.ConnectionInfo(**args.redis).instantiate()
+  for tag in args.tags:
+    jobs = load_jobs(r, tag)
+    print("Tag {0}: {1} jobs".format(tag, len(jobs)))
+    if not jobs:
+      continue
+
+    span = max(job['started'] + job['compute'] for job in jobs)
+    span -= min(job['started'] for job in jobs)
+    summary = summarize(jobs)
+    print("  {0:<10}{1}".format("", "".join(
+          "{0:>12}".format(col)
+          for col in ["p{0}".format(p) for p in PERCENTILES] + ['max'])))
+    for field in FIELDS:
+      print("  {0:<10}{1}".format(field, "".join(
+            "{0:>12}".format(_fmt(summary[field][col]))
+            for col in ["p{0}".format(p) for p in PERCENTILES] + ['max'])))
+    if span > 0:
+      print("  {0:.2f} inferrers busy on average over {1:.0f} seconds"
+            .format(summary['compute']['total'] / span, span))
+
+    print("  Slowest destinations:")
+    slowest = sorted(jobs, key=lambda job: job['compute'], reverse=True)
+    for job in slowest[:args.slowest]:
+      print("    {0:<12} compute {1}s  wait {2}s  {3} sources  {4} bytes"
+            .format(job['dst'], _fmt(job['compute']), _fmt(job['wait']),
+                    job['sources'], job['bytes']))
@@ -10,17 +10,53 @@ import logging
 logger = logging.getLogger(__name__)
 
 from inettopology import SilentExit
+from inettopology.asmap import DBKEYS
 import inettopology.util as utils
 import inettopology.util.structures as redis_structures
+import inettopology.asmap.infer.snapshot as snapshot
+import inettopology.asmap.infer.encoding as encoding
 
 import gevent
+import gevent.event
+import gevent.pool
+import gevent.queue
 import gevent.socket
-from gevent import monkey
-monkey.patch_all()
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 CHECK_VF_SCRIPT = None
 wait_queue = None
-GREENLETS = dict()
+
+# Handlers allowed to run at once, and accepted connections
+# allowed to wait for one to finish. Connections beyond that
+# are told the server is busy.
+MAX_HANDLERS = 1000
+MAX_QUEUED = 500
+
+# Hot destinations to warm up at once
+WARM_CONCURRENCY = 16
+
+# The longest a handler waits for an inference result. Clients
+# can ask for less with a 'deadline' in their request.
+INFERENCE_TIMEOUT = 180
+
+# How long a server's claim on scheduling the inference for a
+# destination lasts. Matches the time handlers wait for a result.
+CLAIM_LEASE = INFERENCE_TIMEOUT
+
+# Failures remembered by the NegativeCache, and for how many
+# seconds. A destination with no known routes stays that way
+# as long as a computed result would be kept (the EXPIRE in
+# c_extensions/inferrer/infer.cc).
+NO_PATH = 'no_path'
+NO_HANDLER = 'no_handler'
+TRANSLATION = 'translation'
+NEGATIVE_TTLS = {NO_PATH: 600,
+                 NO_HANDLER: 10,
+                 TRANSLATION: 3600}
 
 
 class SocketTimeout(Exception):
@@ -37,6 +73,10 @@ class RequestHelper(object):
   def err_resp(msg):
     return json.dumps({'type': 'error', 'msg': "{0}".format(msg)})
 
+  @staticmethod
+  def busy_resp():
+    return json.dumps({'type': 'error', 'msg': "Server busy", 'busy': True})
+
   @staticmethod
   def resp_obj(tag, src, dst, path):
     return {'type': 'response', 'tag': tag,
@@ -44,39 +84,152 @@ class RequestHelper(object):
 
 
 class TranslationError(Exception):
-  def __init__(self, ip):
+  """ :cached: is True if the translation is known to fail
+  from the negative cache, rather than from a lookup """
+
+  def __init__(self, ip, cached=False):
     self.ip = ip
+    self.cached = cached
 
   def msg(self):
     return "Failed to translate '{0}' to AS".format(self.ip)
 
 
+class NegativeCache(object):
+  """ Remember requests which failed, by :kind: of failure,
+  for NEGATIVE_TTLS[kind] seconds, so that asking again fails
+  fast instead of costing a full lookup.
+  """
+
+  def __init__(self, ttls=NEGATIVE_TTLS, sweep_interval=60):
+    self.ttls = ttls
+    self.entries = dict()
+    self.sweep_interval = sweep_interval
+    self._last_sweep = time.time()
+
+  def add(self, kind, key, value=True):
+    now = time.time()
+    self.entries[(kind, key)] = (now + self.ttls[kind], value)
+    if now - self._last_sweep >= self.sweep_interval:
+      self.sweep(now)
+
+  def get(self, kind, key):
+    """ Return what was remembered about :key:, or None """
+    try:
+      expiry, value = self.entries[(kind, key)]
+    except KeyError:
+      return None
+    if expiry < time.time():
+      del self.entries[(kind, key)]
+      return None
+    return value
+
+  def sweep(self, now=None):
+    """ Forget everything which has expired """
+    now = now or time.time()
+    for entry, (expiry, value) in self.entries.items():
+      if expiry < now:
+        del self.entries[entry]
+    self._last_sweep = now
+
+  def __len__(self):
+    return len(self.entries)
+
+
 class InferenceGreenletServer(object):
   """ A greenlet servers which listens for
   inference requests and has :handler: handle each one
   that arrives.
+
+  At most :max_handlers: run at once. Up to :max_queued:
+  more connections wait their turn, and any beyond that
+  are rejected straight away with a 'busy' error.
   """
 
   _s = None
 
-  def __init__(self, server_address, handler):
+  def __init__(self, server_address, handler, reuse_port=False,
+               max_handlers=MAX_HANDLERS, max_queued=MAX_QUEUED):
+    self.handler = handler
+    self.pool = gevent.pool.Pool(max_handlers)
+    self.pending = gevent.queue.Queue(maxsize=max_queued)
+    self.background = gevent.pool.Group()
+    self.accepted = 0
+    self.rejected = 0
+    self.started = time.time()
+    self.warmup = None
+
     self._s = gevent.socket.socket()
-    self._s.bind(('0.0.0.0', 9323))
+    self._s.setsockopt(gevent.socket.SOL_SOCKET,
+                       gevent.socket.SO_REUSEADDR, 1)
+    if reuse_port:
+      if not hasattr(gevent.socket, 'SO_REUSEPORT'):
+        raise Exception("SO_REUSEPORT is not supported on this platform")
+      self._s.setsockopt(gevent.socket.SOL_SOCKET,
+                         gevent.socket.SO_REUSEPORT, 1)
+    self._s.bind(server_address)
 
   def start(self):
-    self._s.listen(500)
+    self._s.listen(self.pending.maxsize)
+    self.background.spawn(self._dispatch)
     while True:
       cli, addr = self._s.accept()
-      greenlet = gevent.spawn(greenlet_handle, cli, self)
-      GREENLETS[id(greenlet)] = greenlet
+      try:
+        self.pending.put_nowait(cli)
+        self.accepted += 1
+      except gevent.queue.Full:
+        self.rejected += 1
+        self.background.spawn(self._reject, cli)
+
+  def _dispatch(self):
+    """ Hand queued connections to the handler, as the pool
+    has room for them """
+    try:
+      while True:
+        cli = self.pending.get()
+        self.pool.spawn(self.handler, cli, self)
+    except gevent.GreenletExit:
+      return
+
+  def _reject(self, cli):
+    try:
+      cli.sendall(RequestHelper.busy_resp())
+    except gevent.socket.error:
+      pass
+    finally:
+      cli.close()
+
+  def spawn(self, func, *args):
+    """ Run :func: alongside the server until it shuts down """
+    return self.background.spawn(func, *args)
+
+  def stats(self):
+    return {'type': 'stats',
+            'handlers': len(self.pool),
+            'max_handlers': self.pool.size,
+            'queued': self.pending.qsize(),
+            'max_queued': self.pending.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'waiting': wait_queue.num_waiting if wait_queue else 0,
+            'events': len(wait_queue.events) if wait_queue else 0,
+            'negative_cached': len(self.negative),
+            'warmup': self.warmup,
+            'uptime': time.time() - self.started}
 
   def shutdown(self):
-    gevent.killall(GREENLETS.itervalues())
+    self.pool.kill()
+    self.background.kill()
 
   def translate_addresses(self, request):
 
     self.log.debug("Translating {0}".format(request))
 
+    for end in ('src', 'dst'):
+      if (request[end][1] == 'IP'
+          and self.negative.get(TRANSLATION, request[end][0])):
+        raise TranslationError(request[end], cached=True)
+
     if request['src'][1] == 'IP':
       try:
         src_as = self.geoipdata.org_by_addr(request['src'][0])
@@ -108,7 +261,7 @@ class InferenceGreenletServer(object):
         self.log.warn("Failed to translate destination '{0}' "
                       "from IP to AS for request {1}"
                       .format(request['dst'], request))
-        raise TranslationError(request['src'])
+        raise TranslationError(request['dst'])
     elif request['src'][1] == 'AS':
       request['dst'] = request['dst'][0]
     else:
@@ -123,10 +276,12 @@ class ProcessingEventQueue(object):
   for processing
   """
 
-  def __init__(self, logger):
+  def __init__(self, logger, status_interval=10):
     self.events = dict()
     self.num_waiting = 0
     self.log = logger
+    self.status_interval = status_interval
+    self._last_status = 0
 
   def register_event(self, event_tag, event):
     """
@@ -146,6 +301,14 @@ class ProcessingEventQueue(object):
       return True
 
   def log_status(self):
+    """
+    Log the number of waiting handlers, at most once
+    every :status_interval: seconds.
+    """
+    now = time.time()
+    if now - self._last_status < self.status_interval:
+      return
+    self._last_status = now
     self.log.info("ProcessingEventQueue: Have {0} handlers "
                   "waiting on {1} events"
                   .format(self.num_waiting, len(self.events)))
@@ -156,8 +319,8 @@ class ProcessingEventQueue(object):
     registered to event_tag
     """
     if event_tag not in self.events:
-      self.log.info("Asked to fire events for {0}, "
-                    "which has no listeners".format(event_tag))
+      self.log.debug("Asked to fire events for {0}, "
+                     "which has no listeners".format(event_tag))
       return
 
     self.log.debug("Firing events for {0} listeners of {1}"
@@ -168,34 +331,65 @@ class ProcessingEventQueue(object):
 
     del self.events[event_tag]
 
+  def unregister_event(self, event_tag, event):
+    """
+    Stop waiting on event_tag with :event:.
+
+    returns how many are still waiting on event_tag
+    """
+    try:
+      events = self.events[event_tag]
+      events.remove(event)
+    except (KeyError, ValueError):
+      # Already fired
+      return 0
+
+    self.num_waiting -= 1
+    if not events:
+      del self.events[event_tag]
+    return len(events)
+
+  def fire_batch(self, event_tags):
+    """
+    Fire the event handlers for every tag in :event_tags:
+    """
+    for event_tag in event_tags:
+      self.fire(event_tag)
+
 
 def start_inference_service(args):
   """
   Start up an inference service for AS Paths.
-  """
-  import gevent
 
-  redis_info = redis_structures.ConnectionInfo(**args.redis)
+  This is the only command that monkey-patches the
+  process with gevent, and it does so after the LogSink
+  has been forked so the sink runs unpatched.
+  """
   log_rinfo = redis_structures.ConnectionInfo(**args.redis)
-  r = redis_info.instantiate()
-  r.ping()
-  r.ping()
-  r.set("testblashdls", "sinweljkrfs")
   logsink = redis_structures.LogSink('route_inference',
                                      log_rinfo,
                                      ["route_inference"],
                                      args.log)
+  tag_inferrers = dict()
   try:
     logsink.start()
 
+    from gevent import monkey
+    monkey.patch_all()
+
+    # Connections have to be created after patching so
+    # they're cooperative.
+    redis_info = redis_structures.ConnectionInfo(**args.redis)
+    r = redis_info.instantiate()
+    r.ping()
+
     log = redis_structures.Logger(redis_info,
                                   'route_inference',
                                   "controller",
                                   redis_structures.Logger.INFO)
 
-    tag_inferrers = dict()
-
     ixpdata = None
+    geoipdata = None
 
     if args.translate_ips:
       log.info("Loading GeoIP database.")
@@ -211,6 +405,11 @@ def start_inference_service(args):
     for tag in args.tags:
       pq = redis_structures.ProcessingQueue(r,
                                             "{0}_procqueue".format(tag))
+      if args.inferrer_count == 0:
+        if not pq.has_listeners():
+          log.warn("No inferrers are running for {0}".format(tag))
+        continue
+
       if len(pq) > 0:
 
         log.info("There are {0} elements in the processing queue for {1}. "
@@ -225,28 +424,37 @@ def start_inference_service(args):
                    "--reset to clear them out")
           raise SilentExit()
       for i in xrange(args.inferrer_count):
-        inf = _start_inferrer(args.inferrer_bin, tag)
+        inf = _start_inferrer(args.inferrer_bin, tag, args.packed_paths)
         try:
           tag_inferrers[tag].append(inf)
         except KeyError:
           tag_inferrers[tag] = [inf]
 
-    if not any(tag_inferrers.itervalues()):
+    if args.inferrer_count > 0 and not any(tag_inferrers.itervalues()):
       log.error("No inferrers started successfully")
       raise SilentExit()
 
-    server = InferenceGreenletServer(('0.0.0.0', 9323), greenlet_handle)
+    server = InferenceGreenletServer((args.bind, args.port),
+                                     greenlet_handle,
+                                     reuse_port=args.reuse_port,
+                                     max_handlers=args.max_handlers,
+                                     max_queued=args.max_queued)
     #server = InferenceServer(('0.0.0.0', 9323), RequestHelper)
     server.r = r
     server.redis_info = redis_info
     server.ixpdata = ixpdata
     server.geoipdata = geoipdata
     server.log = log
+    server.tags = args.tags
+    server.negative = NegativeCache()
 
-    result_watcher_gr = gevent.spawn(watch_query_results, server)
-    GREENLETS[id(result_watcher_gr)] = result_watcher_gr
+    server.spawn(watch_query_results, server)
+    if args.warm_snapshot or args.warm_destinations:
+      server.spawn(warm_up, server, log,
+                   args.warm_snapshot, args.warm_destinations)
 
-    log.info("Starting server listening on 9323")
+    log.info("Starting server listening on {0}:{1}"
+             .format(args.bind, args.port))
     try:
       server.start()
       server.join()
@@ -280,13 +488,16 @@ def start_inference_service(args):
     os.kill(logsink.pid, signal.SIGKILL)
 
 
-def _start_inferrer(infer_proc, ribtag):
+def _start_inferrer(infer_proc, ribtag, packed=False):
   """ Start the inference binary :infer_proc: and
-  ask it to infer for :ribtag:
+  ask it to infer for :ribtag:, storing packed paths
+  if :packed:
   """
 
   cmd = [infer_proc, "-r", ribtag,
          "--procqueue", "{0}_procqueue".format(ribtag)]
+  if packed:
+    cmd.append("--packed")
   logger.info("Starting inferrer as '{0}'\n".format(" ".join(cmd)))
   pid = subprocess.Popen(cmd,
                          stderr=open("{0}_inferrer.log".format(ribtag), 'w'))
@@ -315,13 +526,11 @@ def greenlet_handle(sock, server):
                               timeout_exc=SocketTimeout())
     except SocketTimeout as e:
       log.info("Closing timed out socket\n")
-      sock.close()
       return
 
     res = sock.recv(1024)
     if not res:
       log.warn("Socket Error\n")
-      sock.close()
       return
 
     data = res.strip()
@@ -332,6 +541,14 @@ def greenlet_handle(sock, server):
                        .format(data))
       return sock.sendall(RequestHelper.err_resp("Unparseable"))
 
+    wire = req.get('encoding', 'json')
+    if wire == 'msgpack' and msgpack is None:
+      return sock.sendall(RequestHelper.err_resp("This server can't send "
+                                                 "msgpack. Ask for json"))
+
+    if 'type' in req and req['type'] == 'stats':
+      return send_response(sock, server.stats(), wire)
+
     if 'type' not in req or req['type'] != 'request':
       sys.stderr.write("Received malformed request: '{0}'\n"
                        .format(data))
@@ -340,6 +557,9 @@ def greenlet_handle(sock, server):
     try:
       req = server.translate_addresses(req)
     except TranslationError as e:
+      # Re-adding cached failures would keep them from ever expiring
+      if not e.cached:
+        server.negative.add(TRANSLATION, e.ip[0])
       return sock.sendall(RequestHelper.err_resp(e.msg()))
 
     if not req:
@@ -348,30 +568,135 @@ def greenlet_handle(sock, server):
       return sock.sendall(RequestHelper.err_resp("Malformed Types"))
 
     resp = mk_inference_request(server, log,
-                                req['tag'], req['src'], req['dst'])
-
-    if server.ixpdata and resp['type'] != 'error' and resp['path']:
-      for as1, as2 in utils.pairwise(resp['path'].split()):
-        try:
-          ixp = server.ixpdata[(as1, as2)]
-          resp['ixps'][ixp[0]] = {'as1': as1, 'as2': as2, 'confidence': ixp[1]}
-        except KeyError, e:
-          pass
+                                req['tag'], req['src'], req['dst'],
+                                deadline=req.get('deadline'))
+
+    if resp['type'] != 'error' and resp['path']:
+      if server.ixpdata:
+        path = encoding.path_asns(resp['path'])
+        for as1, as2 in utils.pairwise(path):
+          try:
+            ixp = server.ixpdata[(as1, as2)]
+            resp['ixps'][ixp[0]] = {'as1': as1, 'as2': as2,
+                                    'confidence': ixp[1]}
+          except KeyError, e:
+            pass
+
+      if wire == 'msgpack':
+        resp['path'] = encoding.path_array(resp['path']).tolist()
+      else:
+        resp['path'] = encoding.path_string(resp['path'])
 
     log.debug("Response: '{0}'".format(resp))
-    sock.sendall(json.dumps(resp))
-
-    del GREENLETS[id(gevent.getcurrent())]
+    send_response(sock, resp, wire)
 
   except gevent.GreenletExit:
-    sock.close()
     log.info("socket_handler exiting")
     return
   except Exception as e:
-    sock.close()
     import traceback
     log.info("ERROR {0}\n".format(traceback.format_exception(*sys.exc_info())))
     return
+  finally:
+    sock.close()
+
+
+def send_response(sock, resp, wire='json'):
+  """ Send :resp: on :sock:, encoded as :wire: asks. Paths
+  in msgpack responses are lists of encoded ASNs (see
+  encoding.py) """
+  if wire == 'msgpack':
+    sock.sendall(msgpack.packb(resp))
+  else:
+    sock.sendall(json.dumps(resp))
+
+
+def warm_up(server, log, snapshot_file=None, hot_file=None,
+            concurrency=WARM_CONCURRENCY, status_interval=10):
+  """ Warm up :server: while it serves requests.
+
+  Results in :snapshot_file: (see snapshot.dump) are stored
+  for any destination which doesn't have one yet. Then
+  inferences are requested for each destination in
+  :hot_file:, :concurrency: at a time. Each line of
+  :hot_file: is either a destination, which is warmed for
+  every tag, or a tag and a destination.
+
+  Progress is logged every :status_interval: seconds, and
+  reported in the server's stats.
+  """
+  progress = server.warmup = {'loaded': 0, 'inferred': 0,
+                              'unroutable': 0, 'present': 0,
+                              'failed': 0, 'hot': 0, 'done': False}
+  last_status = [time.time()]
+
+  def log_status(force=False):
+    now = time.time()
+    if force or now - last_status[0] >= status_interval:
+      last_status[0] = now
+      log.info("Warm-up: {loaded} results loaded from snapshot, "
+               "{inferred}/{hot} hot destinations inferred "
+               "({unroutable} with no routes, {present} already present, "
+               "{failed} failed)"
+               .format(**progress))
+
+  try:
+    if snapshot_file:
+      with open(snapshot_file) as fin:
+        with server.r.pipeline(transaction=False) as pipe:
+          for tag, dst, paths in snapshot.read(fin):
+            if tag not in server.tags or not paths:
+              continue
+            if server.r.exists(snapshot.RESULT_KEY.format(tag, dst)):
+              progress['present'] += 1
+              continue
+            snapshot.store(pipe, tag, dst, paths)
+            progress['loaded'] += 1
+            if progress['loaded'] % 100 == 0:
+              pipe.execute()
+              log_status()
+          pipe.execute()
+
+    if hot_file:
+      destinations = list()
+      with open(hot_file) as fin:
+        for line in fin:
+          fields = line.split()
+          if not fields or fields[0].startswith("#"):
+            continue
+          if len(fields) == 1:
+            destinations.extend((tag, fields[0]) for tag in server.tags)
+          elif fields[0] in server.tags:
+            destinations.append((fields[0], fields[1]))
+      progress['hot'] = len(destinations)
+
+      def warm(tag, dst):
+        result_key = snapshot.RESULT_KEY.format(tag, dst)
+        if server.r.exists(result_key):
+          progress['present'] += 1
+          return
+        if await_inference(server, log, tag, dst) is not None:
+          progress['failed'] += 1
+        elif server.r.exists(result_key):
+          progress['inferred'] += 1
+        else:
+          # Nothing stored means there are no known routes
+          server.negative.add(NO_PATH, "{0}|{1}".format(tag, dst))
+          progress['unroutable'] += 1
+        log_status()
+
+      pool = gevent.pool.Pool(concurrency)
+      for tag, dst in destinations:
+        pool.spawn(warm, tag, dst)
+      pool.join()
+
+  except IOError as e:
+    log.error("Failed to warm up: {0}".format(e))
+  except gevent.GreenletExit:
+    return
+
+  progress['done'] = True
+  log_status(force=True)
 
 
 def watch_query_results(server):
@@ -379,80 +704,169 @@ def watch_query_results(server):
   Listen for notification that an inference has
   completed, then allow the handler to respond to the
   original request
+
+  Each tag has its own notification channel, so we only
+  hear about the tags this server has inferrers for. Any
+  notifications which have already arrived when we wake
+  up are fired together as one batch.
   """
 
   global wait_queue
   wait_queue = ProcessingEventQueue(server.log)
   try:
     listener = server.r.pubsub()
-    listener.subscribe(['inference:query_status'])
+    listener.subscribe([DBKEYS.QUERY_STATUS(tag) for tag in server.tags])
 
     for item in listener.listen():
-      if item['type'] == 'message':
-        wait_queue.fire(item['data'])
-        wait_queue.log_status()
+      if item['type'] != 'message':
+        continue
+
+      batch = set([item['data']])
+      pending = listener.get_message()
+      while pending is not None:
+        if pending['type'] == 'message':
+          batch.add(pending['data'])
+        pending = listener.get_message()
+
+      wait_queue.fire_batch(batch)
+      wait_queue.log_status()
+
+      # Results are in, so nobody needs to hold a claim on
+      # scheduling them, or count who's waiting, anymore.
+      with server.r.pipeline() as pipe:
+        for event_tag in batch:
+          ribtag, dst = event_tag.split("|", 1)
+          claims = redis_structures.ClaimSet(server.r,
+                                             "inference:{0}".format(ribtag))
+          claims.release(dst, pipe=pipe)
+          waiters = redis_structures.WaiterCount(
+              server.r, "inference:{0}".format(ribtag), INFERENCE_TIMEOUT)
+          waiters.clear(dst, pipe=pipe)
+        pipe.execute()
   except gevent.GreenletExit:
     server.log.info("query_watcher exiting")
     return
 
 
-def mk_inference_request(server, log, ribtag, as1, as2):
-  """ Make an inference request to one of the
-  inferrers for the path between :as1: and :as2:
-  tagged by :ribtag:.
+def await_inference(server, log, ribtag, as2, timeout=INFERENCE_TIMEOUT):
+  """ Have one of the inferrers for :ribtag: infer the paths
+  to :as2:, unless someone already asked for that, and wait
+  up to :timeout: seconds for it to finish.
+
+  If every handler waiting on the destination gives up before
+  it's been started on, the inference is taken back off the
+  queue.
+
+  Returns None once the inference has finished, or else a
+  message saying why not.
   """
 
   # Processing all sources to one destination, so
   # the event tag is the ribtag plus the destination.
   event_tag = "{0}|{1}".format(ribtag, as2)
+  result_key = "result:{0}:inferred_to:{1}".format(ribtag, as2)
   global wait_queue
 
-  path = server.r.hget("result:{0}:inferred_to:{1}"
-                       .format(ribtag, as2), as1)
-
-  if path:
-    return RequestHelper.resp_obj(ribtag, as1, as2, path)
-
-  # If None was returned, but the key is in the database,
-  # then there is no known path.
-  searched = server.r.exists("result:{0}:inferred_to:{1}".format(ribtag, as2))
-  if not path and searched:
-    return RequestHelper.resp_obj(ribtag, as1, as2, None)
+  no_handler = server.negative.get(NO_HANDLER, ribtag)
+  if no_handler:
+    return no_handler
 
   # Check if we already requested that someone process this
   # instead of asking again
   wait_for = gevent.event.Event()
   wait_for.clear()
 
-  if wait_queue.register_event(event_tag, wait_for) is True:
-    # True means we're the only one in the event, so we better actually
-    # schedule processing.
+  procqueue = redis_structures.ProcessingQueue(
+      server.r,
+      "{0}_procqueue".format(ribtag),
+      track_seen=False)
+  claims = redis_structures.ClaimSet(server.r,
+                                     "inference:{0}".format(ribtag))
+  waiters = redis_structures.WaiterCount(server.r,
+                                         "inference:{0}".format(ribtag),
+                                         INFERENCE_TIMEOUT)
 
-    log.debug("Requesting computation of {1} from {0}_procqueue"
-              .format(event_tag, ribtag))
+  if wait_queue.register_event(event_tag, wait_for) is True:
+    # True means we're the only one in this process waiting on the
+    # event. Another server may already have scheduled it though, so
+    # only schedule processing if we can claim it.
 
-    procqueue = redis_structures.ProcessingQueue(
-        server.r,
-        "{0}_procqueue".format(ribtag),
-        track_seen=False)
     if not procqueue.has_listeners():
       log.debug("There is no handler for {0}.".format(ribtag))
-      return RequestHelper.err_resp_obj("No handler exists for tag '{0}'"
-                                        .format(ribtag))
-
-    procqueue.add(as2)
+      wait_queue.unregister_event(event_tag, wait_for)
+      msg = "No handler exists for tag '{0}'".format(ribtag)
+      server.negative.add(NO_HANDLER, ribtag, msg)
+      return msg
+
+    waiters.join(as2)
+    if claims.claim(as2, CLAIM_LEASE):
+      log.debug("Requesting computation of {1} from {0}_procqueue"
+                .format(event_tag, ribtag))
+      procqueue.add(as2)
+    else:
+      log.debug("Computation for {0} already claimed by another server. "
+                "Waiting for result".format(event_tag))
+      # The result may have landed before we subscribed to hear about it.
+      if server.r.exists(result_key):
+        wait_queue.fire(event_tag)
   else:
+    waiters.join(as2)
     log.debug("Computation for {0} already requested. Waiting for result"
               .format(event_tag))
 
-  wait_for.wait(180)
+  wait_for.wait(timeout)
   log.debug("Got inferrer response with tag {0}".format(event_tag))
 
   if not wait_for.isSet():
-    return RequestHelper.err_resp_obj("Inference server didn't respond "
-                                      "in 180 seconds")
+    wait_queue.unregister_event(event_tag, wait_for)
+    if waiters.leave(as2) == 0 and procqueue.cancel(as2):
+      log.debug("Everyone waiting on {0} gave up. Cancelled its inference"
+                .format(event_tag))
+      claims.release(as2)
+    return "Inference server didn't respond in {0:g} seconds".format(timeout)
+
+  return None
+
+
+def mk_inference_request(server, log, ribtag, as1, as2, deadline=None):
+  """ Make an inference request to one of the
+  inferrers for the path between :as1: and :as2:
+  tagged by :ribtag:.
+
+  Waits up to :deadline: seconds for the result, and never
+  more than INFERENCE_TIMEOUT.
+  """
+
+  event_tag = "{0}|{1}".format(ribtag, as2)
+  result_key = "result:{0}:inferred_to:{1}".format(ribtag, as2)
+
+  path = server.r.hget(result_key, as1)
+
+  if path:
+    return RequestHelper.resp_obj(ribtag, as1, as2, path)
+
+  # If None was returned, but the key is in the database,
+  # then there is no known path.
+  searched = server.r.exists(result_key)
+  if not path and searched:
+    return RequestHelper.resp_obj(ribtag, as1, as2, None)
+
+  # The inferrer doesn't store anything for destinations
+  # it knows no routes to, so we have to remember them.
+  if server.negative.get(NO_PATH, event_tag):
+    return RequestHelper.resp_obj(ribtag, as1, as2, None)
+
+  try:
+    timeout = min(float(deadline), INFERENCE_TIMEOUT)
+  except (TypeError, ValueError):
+    timeout = INFERENCE_TIMEOUT
+
+  error = await_inference(server, log, ribtag, as2, timeout)
+  if error is not None:
+    return RequestHelper.err_resp_obj(error)
 
-  path = server.r.hget("result:{0}:inferred_to:{1}"
-                       .format(ribtag, as2), as1)
+  path = server.r.hget(result_key, as1)
+  if path is None and not server.r.exists(result_key):
+    server.negative.add(NO_PATH, event_tag)
 
   return RequestHelper.resp_obj(ribtag, as1, as2, path)
@@ -0,0 +1,73 @@
+import json
+import logging
+import inettopology.asmap.infer.encoding as encoding
+log = logging.getLogger(__name__)
+
+""" Snapshots of inferred results
+
+Each line of a snapshot holds the paths inferred to one
+destination, as text, in a JSON object:
+
+  {"tag": <ribtag>, "dst": <destination AS>,
+   "paths": {<source AS>: <path>, ...}}
+
+:dump: writes the results stored in Redis to a snapshot, and
+the inference server can be warmed up from one.
+"""
+
+RESULT_KEY = "result:{0}:inferred_to:{1}"
+# How long the inferrer keeps results (the EXPIRE in
+# c_extensions/inferrer/infer.cc)
+RESULT_TTL = 600
+
+
+def dump(r, tags, fout):
+  """ Write every result stored for :tags: to :fout:. Returns
+  how many destinations were written.
+  """
+  count = 0
+  for tag in tags:
+    prefix = RESULT_KEY.format(tag, "")
+    for key in r.scan_iter(match=prefix + "*", count=1000):
+      paths = r.hgetall(key)
+      if not paths:
+        # Expired since we found it
+        continue
+      paths = dict((src, encoding.path_string(path))
+                   for src, path in paths.iteritems())
+      fout.write(json.dumps({'tag': tag,
+                             'dst': key[len(prefix):],
+                             'paths': paths}))
+      fout.write("\n")
+      count += 1
+  return count
+
+
+def read(fin):
+  """ Yield (tag, dst, paths) for each destination in the
+  snapshot :fin: """
+  for line in fin:
+    if not line.strip():
+      continue
+    record = json.loads(line)
+    yield (str(record['tag']), str(record['dst']),
+           dict((str(src), str(path))
+                for src, path in record['paths'].iteritems()))
+
+
+def store(r, tag, dst, paths, ttl=RESULT_TTL):
+  """ Store :paths: as the result for :dst: in :r:, which
+  may be a pipeline, to expire after :ttl: seconds """
+  key = RESULT_KEY.format(tag, dst)
+  r.hmset(key, paths)
+  r.expire(key, ttl)
+
+
+def dump_results(args):
+  import inettopology.util.structures as redis_structures
+
+  r = redis_structures.ConnectionInfo(**args.redis).instantiate()
+  with open(args.output, 'w') as fout:
+    count = dump(r, args.tags, fout)
+  log.info("Wrote results for {0} destinations to {1}"
+           .format(count, args.output))
@@ -1,3 +1,4 @@
+import argparse
 import itertools
 import time
 
@@ -120,3 +121,9 @@ class Color:
     @classmethod
     def wrapformat(self, fmt, color, *args, **kwargs):
       return color + fmt.format(*args, **kwargs) + Color.ENDC
+
+
+class RedisArgAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    args = [conv(arg) for conv, arg in zip((str, int, int), values.split(":"))]
+    setattr(namespace, self.dest, dict(zip(('host', 'port', 'db'), args)))
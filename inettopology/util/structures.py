@@ -3,17 +3,13 @@ import socket
 import time
 import redis
 import redis.connection
-import argparse
 import logging
 log = logging.getLogger(__name__)
 
-__all__ = ["Collection", "ProcessingQueue", "KeyedCollection", "Logger"]
+from inettopology.util.general import RedisArgAction
 
-
-class RedisArgAction(argparse.Action):
-  def __call__(self, parser, namespace, values, option_string=None):
-    args = [conv(arg) for conv, arg in zip((str, int, int), values.split(":"))]
-    setattr(namespace, self.dest, dict(zip(('host', 'port', 'db'), args)))
+__all__ = ["Collection", "ProcessingQueue", "KeyedCollection", "Logger",
+           "ClaimSet", "WaiterCount"]
 
 
 class Collection(object):
@@ -210,14 +206,79 @@ class PriorityQueue(object):
 
 
 class ProcessingQueue(object):
+  """
+  A queue of elements to be processed, shared through Redis.
+
+  Elements are only queued once at a time. Taking an element
+  leases it for :lease: seconds, during which it is held in
+  an in-progress set. The worker should :ack: it when done,
+  and :touch: it to keep the lease while it's still working.
+  Leases which run out are put back on the queue the next time
+  anyone takes an element, so the work of a worker which dies
+  is picked up by another.
+  """
+
+  # Seconds an element is leased to whoever takes it. Must
+  # match RQUEUE_LEASE in c_extensions/inferrer/structures.h
+  LEASE = 30
+
+  # Like Collection.add_lua, but also notes when the element
+  # was first queued
+  add_lua = """
+  local sadd_result
+  sadd_result = redis.call("SADD", KEYS[1], ARGV[1])
+  if sadd_result == 1 then
+    redis.call("LPUSH", KEYS[2], ARGV[1])
+    redis.call("HSETNX", KEYS[3], ARGV[1], ARGV[2])
+  end
+  return sadd_result
+  """
+
+  pop_lua = """
+  local expired = redis.call("ZRANGEBYSCORE", KEYS[3], "-inf", ARGV[1])
+  for _, element in ipairs(expired) do
+    redis.call("ZREM", KEYS[3], element)
+    if redis.call("SADD", KEYS[2], element) == 1 then
+      redis.call("RPUSH", KEYS[1], element)
+    end
+  end
+  local element = redis.call("RPOP", KEYS[1])
+  if not element then
+    return false
+  end
+  redis.call("SREM", KEYS[2], element)
+  redis.call("ZADD", KEYS[3], tonumber(ARGV[1]) + tonumber(ARGV[2]), element)
+  return element
+  """
 
-  def __init__(self, r, prefix, track_seen=True, is_listener=False):
+  cancel_lua = """
+  if redis.call("LREM", KEYS[1], 0, ARGV[1]) > 0 then
+    redis.call("SREM", KEYS[2], ARGV[1])
+    redis.call("HDEL", KEYS[3], ARGV[1])
+    return 1
+  end
+  return 0
+  """
+
+  touch_lua = """
+  if redis.call("ZSCORE", KEYS[1], ARGV[2]) then
+    redis.call("ZADD", KEYS[1], ARGV[1], ARGV[2])
+    return 1
+  end
+  return 0
+  """
+
+  def __init__(self, r, prefix, track_seen=True, is_listener=False,
+               lease=LEASE):
     self._do_list = "procqueue:{0}:list".format(prefix)
     self._done_list = "procqueue:{0}:done".format(prefix)
     self._set = "procqueue:{0}:set".format(prefix)
     self._unique_entry_set = "procqueue:{0}:infilter".format(prefix)
+    self._in_progress = "procqueue:{0}:inprogress".format(prefix)
+    self._enqueued = "procqueue:{0}:enqueued".format(prefix)
     self.listener_key = "procqueue:{0}:meta:have_listener".format(prefix)
     self.track_seen = track_seen
+    self.lease = lease
 
     if isinstance(r, redis.Redis):
       self._redis = r
@@ -226,7 +287,12 @@ class ProcessingQueue(object):
     else:
       raise TypeError("Expected Redis Connection or ConnectionInfo")
 
-    self._add_script = self._redis.register_script(Collection.add_lua)
+    self._add_script = self._redis.register_script(ProcessingQueue.add_lua)
+    self._pop_script = self._redis.register_script(ProcessingQueue.pop_lua)
+    self._touch_script = self._redis.register_script(
+        ProcessingQueue.touch_lua)
+    self._cancel_script = self._redis.register_script(
+        ProcessingQueue.cancel_lua)
 
   def was_processed(self, element):
     return True if self._redis.sismember(self._set, element) == 1 else False
@@ -243,31 +309,65 @@ class ProcessingQueue(object):
     self._redis.delete(self._unique_entry_set)
     self._redis.delete(self._done_list)
     self._redis.delete(self._do_list)
+    self._redis.delete(self._in_progress)
+    self._redis.delete(self._enqueued)
+
+  def _lease_next(self):
+    return self._pop_script(keys=[self._do_list, self._unique_entry_set,
+                                  self._in_progress],
+                            args=[int(time.time()), self.lease])
 
   def get_next(self):
     """
-    Retrieves the next element from the processing list
-    that has not already been seen. Adds that element
+    Retrieves and leases the next element from the processing
+    list that has not already been seen. Adds that element
     to the processed list.
 
     If the list is empty, returns None
     """
-    element = self._redis.rpop(self._do_list)
-    if element is None:
-      return None
+    element = self._lease_next()
     if self.track_seen:
-      while self._redis.sadd(self._set, element) == 0:
-        element = self._redis.rpop(self._do_list)
-        if element:
-          self._redis.srem(self._unique_entry_set(element))
-      self._redis.lpush(self._done_list, element)
+      while element is not None and self._redis.sadd(self._set, element) == 0:
+        self.ack(element)
+        element = self._lease_next()
+      if element is not None:
+        self._redis.lpush(self._done_list, element)
 
-    self._redis.srem(self._unique_entry_set(element))
     return element
 
+  def ack(self, element):
+    """
+    Mark :element: as finished, ending its lease
+    """
+    with self._redis.pipeline() as pipe:
+      pipe.zrem(self._in_progress, element)
+      pipe.hdel(self._enqueued, element)
+      pipe.execute()
+
+  def touch(self, element):
+    """
+    Renew the lease on :element:. Returns False if it had
+    already run out.
+    """
+    result = self._touch_script(keys=[self._in_progress],
+                                args=[int(time.time()) + self.lease, element])
+    return result == 1
+
+  def cancel(self, element):
+    """
+    Take :element: back off the queue, if nobody has started
+    on it yet. Returns True if it was cancelled.
+    """
+    result = self._cancel_script(keys=[self._do_list,
+                                       self._unique_entry_set,
+                                       self._enqueued],
+                                 args=[element])
+    return result == 1
+
   def add(self, element, pipe=None):
-    return self._add_script(keys=[self._unique_entry_set, self._do_list],
-                            args=[element],
+    return self._add_script(keys=[self._unique_entry_set, self._do_list,
+                                  self._enqueued],
+                            args=[element, time.time()],
                             client=pipe)
 
   def add_from(self, elements):
@@ -279,10 +379,96 @@ class ProcessingQueue(object):
   def __len__(self):
     return self._redis.llen(self._do_list)
 
+  def in_progress(self):
+    """
+    The number of elements currently leased
+    """
+    return self._redis.zcard(self._in_progress)
+
+  def queued_at(self, element):
+    """
+    When :element: was first queued, or None if it isn't
+    """
+    when = self._redis.hget(self._enqueued, element)
+    return float(when) if when is not None else None
+
   def num_processed(self):
     return self._redis.scard(self._set)
 
 
+class ClaimSet(object):
+  """
+  A set of leased claims stored in Redis.
+
+  The first caller to claim an element holds it until
+  it is released or the lease runs out, which lets
+  several processes agree on which of them does a
+  piece of work.
+  """
+
+  def __init__(self, r, prefix):
+    self._prefix = prefix
+    self._r = r
+
+  def _key(self, element):
+    return "claims:{0}:{1}".format(self._prefix, element)
+
+  def claim(self, element, lease, owner=1):
+    """
+    Claim :element: for :lease: seconds. Returns True if
+    we got the claim, False if someone else holds it.
+    """
+    result = self._r.set(self._key(element), owner, nx=True, ex=lease)
+    return True if result else False
+
+  def release(self, element, pipe=None):
+    r = pipe if pipe else self._r
+    r.delete(self._key(element))
+
+  def is_claimed(self, element):
+    return True if self._r.exists(self._key(element)) else False
+
+
+class WaiterCount(object):
+  """
+  Counts, stored in Redis, of how many handlers are waiting
+  on each element, across every process sharing :prefix:.
+
+  Counts expire :ttl: seconds after the last handler joined,
+  so handlers which die without leaving can't keep one
+  alive forever.
+  """
+
+  def __init__(self, r, prefix, ttl):
+    self._prefix = prefix
+    self._r = r
+    self.ttl = ttl
+
+  def _key(self, element):
+    return "waiters:{0}:{1}".format(self._prefix, element)
+
+  def join(self, element):
+    with self._r.pipeline() as pipe:
+      pipe.incr(self._key(element))
+      pipe.expire(self._key(element), self.ttl)
+      count, _ = pipe.execute()
+    return count
+
+  def leave(self, element):
+    """
+    Stop waiting on :element:. Returns how many are still
+    waiting.
+    """
+    count = self._r.decr(self._key(element))
+    if count <= 0:
+      self._r.delete(self._key(element))
+    return max(count, 0)
+
+  def clear(self, element, pipe=None):
+    r = pipe if pipe else self._r
+    r.delete(self._key(element))
+
+
 class ConnectionInfo(object):
 
   def __init__(self, **kwargs):
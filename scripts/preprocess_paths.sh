@@ -20,21 +20,25 @@ shift
 
 declare -a asns=()
 
+prefix=$outdir/${label}.samples${filestart}_$endfile
+
 echo "Planning to process files:  $(seq -s ' ' $filestart $endfile)..."
-echo "Will write to $outdir/${label}.[asn].samples${filestart}_$endfile.aspaths.out"
+echo "Will write to ${prefix}.[asn].aspaths.out"
 read -p "Are you sure? " -n 1 -r
 if [[ $REPLY =~ ^[Yy]$ ]]
 then
   echo
       # do dangerous stuff
+  client_args=""
   while [[ "$#" -gt 0 ]]; do
     asns=( ${asns[@]} $1 )
-    files=$(for f in $(seq $filestart $endfile); do echo simulate.typical.*-samples.$f.out; done)
-    (inettopology extra torps.preprocess --client_as ${1} ribs_20130330 $files 2> $outdir/${label}.${1}.samples${filestart}_$endfile.aspaths.log > $outdir/${label}.${1}.samples${filestart}_$endfile.aspaths.out )& 
+    client_args="$client_args --client_as $1"
     shift
   done
 
-  wait 
+  # A single pass over the trace files handles every client AS
+  files=$(for f in $(seq $filestart $endfile); do echo simulate.typical.*-samples.$f.out; done)
+  inettopology extra torps.preprocess $client_args --output-prefix $prefix ribs_20130330 $files 2> ${prefix}.aspaths.log
 
   read -r -d '' msg <<MSG
   ASNs: ${asns[@]}